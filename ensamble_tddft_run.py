@@ -6,7 +6,12 @@ import numpy as np
 import matplotlib.pyplot as plt
 from tqdm import trange, tqdm
 from src.training.models_adiabatic import Energy_XXZX, Energy_reduction_XXZX
-from src.qutip_lab.qutip_class import SpinOperator, SpinHamiltonian, SteadyStateSolver
+from src.qutip_lab.qutip_class import (
+    SpinOperator,
+    SpinHamiltonian,
+    SteadyStateSolver,
+    GroundStateSolver,
+)
 
 from src.tddft_methods.kohm_sham_utils import (
     compute_the_gradient,
@@ -15,7 +20,10 @@ from src.tddft_methods.kohm_sham_utils import (
     initialize_psi_from_z_and_x,
     nonlinear_ensamble_schrodinger_step,
 )
+from src.tddft_methods.kohm_sham_propagator import KohmShamPropagator
 from src.gradient_descent import GradientDescentKohmSham
+from src.trajectory_store import TrajectoryStore
+from src.warm_start_cache import WarmStartCache
 import qutip
 from typing import List
 import os
@@ -106,6 +114,12 @@ tf = 10.0
 time = torch.linspace(0.0, tf, steps)
 dt = time[1] - time[0]
 
+# adaptive time step (KohmShamPropagator.run_adaptive) instead of the fixed dt, the results are
+# reported on the same time grid. It is cheaper than the fixed step for tolerance >= 1e-4 (see run_adaptive)
+adaptive = False
+adaptive_tolerance = 1e-4
+field_tolerance = 1e-8
+
 ndata = 10
 rates = np.linspace(0.0, 0.2, ndata)
 
@@ -137,6 +151,9 @@ m_qutip_tot = np.append(
 # is the driving periodic?
 periodic = False
 
+# number of time steps between two chunks of the trajectory store
+checkpoint_every = 100
+
 # define the initial external field
 # zz x quench style (?)
 hi = torch.ones((2, l))
@@ -165,13 +182,30 @@ gd = GradientDescentKohmSham(
     device="cpu",
     n_init=torch.mean(z_target, dim=0),
     h=hi,
+    # quasi newton minimization, converged in tens of iterations (epochs is the maximum)
+    optimizer="lbfgs",
+    # initial guess from the ground states of the previous runs (same functional, nearest field)
+    warm_start=WarmStartCache("data/kohm_sham_approach/warm_start_cache.npz"),
 )
 
 
 zi = gd.run()
 zi = torch.from_numpy(zi)[0]
 
+if periodic:
+    file_name = f"data/kohm_sham_approach/results/tddft_periodic_uniform_zzxxzx_model_h_0_5_omega_0_2_ti_0_tf_{tf:.0f}_hi_{hi[0,0].item():.4f}_delta_{delta[0,0].item():.4f}_omegai_{hi[1,0].item():.1f}_delta_{delta[1,0].item():.1f}_steps_{steps}_self_consistent_steps_{self_consistent_step}_ndata_{ndata}_exp_{exponent_algorithm}"
+else:
+    file_name = f"data/kohm_sham_approach/results/ensamble_schrodinger_equation/tddft_quench_uniform_model_h_0_2_omega_0_2_ti_0_tf_{tf:.0f}_hi_{hi[0,0].item():.4f}_hf_{hf[0,0].item():.4f}_omegai_{hi[1,0].item():.1f}_omegaf_{hf[1,0].item():.1f}_steps_{steps}_self_consistent_steps_{self_consistent_step}_ndata_{ndata}_exp_{exponent_algorithm}"
+
+# the trajectories are saved in chunks of time steps and a run can be resumed
+store = TrajectoryStore(path=file_name + "_store", flush_every=checkpoint_every)
+store.write_static(rates=rates, time=time.detach().numpy())
+
+# sparse Lanczos ground state, warm started from the previous sample
+gs_solver = GroundStateSolver()
 for q, rate in enumerate(rates):
+    if store.saved_length(q) == time.shape[0] - 1:
+        continue
     # Qutip Dynamics
     # Hamiltonian
     ham0 = SpinHamiltonian(
@@ -188,8 +222,9 @@ for q, rate in enumerate(rates):
         index=[("z", i) for i in range(l)], coupling=hi[0].detach().numpy(), size=l
     )
 
-    eng, psi0 = np.linalg.eigh(ham0.qutip_op + hamExtZ.qutip_op + hamExtX.qutip_op)
-    psi0 = qutip.Qobj(psi0[:, 0], shape=psi0.shape, dims=([[2 for i in range(l)], [1]]))
+    eng, psi0 = gs_solver.ground_state(
+        ham0.qutip_op + hamExtZ.qutip_op + hamExtX.qutip_op
+    )
 
     print("real ground state energy=", eng[0])
     # to check if we have the same outcome with the Crank-Nicholson algorithm
@@ -290,8 +325,61 @@ for q, rate in enumerate(rates):
     print(compute_the_magnetization(psi=psi))
     print(compute_the_magnetization(psi=np.conj(psi)))
 
+    # resume from the last chunk
+    start = store.saved_length(q)
+    if start > 0:
+        psis = list(torch.from_numpy(store.state(q)["psis"]))
+
+    if adaptive:
+        # psi is real (y=0), so the two states of the ensamble coincide and they evolve as a single
+        # Kohm-Sham state with its own effective fields
+        propagator = KohmShamPropagator(
+            energy=energy,
+            dt=dt.item(),
+            self_consistent_step=self_consistent_step,
+            compiled=True,
+        )
+        results = propagator.run_adaptive(
+            psi=psis[0].unsqueeze(0),
+            h=h[start:].unsqueeze(0),
+            time=time[start:],
+            tolerance=adaptive_tolerance,
+            field_tolerance=field_tolerance,
+        )
+        print(propagator.stats)
+        z_tot[q, start:-1] = results["z"][0, :-1].detach().numpy()
+        x_tot[q, start:-1] = results["x"][0, :-1].detach().numpy()
+        y_tot[q, start:-1] = results["y"][0, :-1].detach().numpy()
+        eng_tot[q, start:-1] = results["energy"][0, :-1].detach().numpy()
+        gradients_tot[q, start:-1, 1] = -1 * results["omega_eff"][0, :-1].numpy()
+        gradients_tot[q, start:-1, 0] = -1 * results["h_eff"][0, :-1].numpy()
+        eng_qutip_tot[q, start:-1] = (
+            energy(torch.from_numpy(m_qutip_tot[q, start:-1]), h[start:-1])
+            .detach()
+            .numpy()
+        )
+        psis = [propagator.psi[0], propagator.psi[0].clone()]
+
+        store.extend(
+            trajectory=q,
+            state={"psis": np.stack(psis)},
+            x_qutip=x_qutip_tot[q, start:-1],
+            z_qutip=z_qutip_tot[q, start:-1],
+            z=z_tot[q, start:-1],
+            x=x_tot[q, start:-1],
+            y=y_tot[q, start:-1],
+            y_qutip=y_qutip_tot[q, start:-1],
+            potential=h_tot[q, start:-1],
+            energy_x=eng_tot_x[q, start:-1],
+            energy_z=eng_tot_z[q, start:-1],
+            energy=eng_tot[q, start:-1],
+            energy_qutip=eng_qutip_tot[q, start:-1],
+            gradient=gradients_tot[q, start:-1],
+        )
+        continue
+
     t_bar = tqdm(enumerate(time))
-    for i in trange(time.shape[0] - 1):
+    for i in trange(start, time.shape[0] - 1):
         t = time[i]
         eng_qutip = energy(
             torch.from_numpy(m_qutip_tot[q, i]).unsqueeze(0), h[i].unsqueeze(0)
@@ -306,6 +394,8 @@ for q, rate in enumerate(rates):
             dt=dt,
             eta=None,
             exponent_algorithm=exponent_algorithm,
+            # energy and effective fields compiled once for the (1, 2, l) input
+            compiled=True,
         )
 
         eng_tot[q, i] = eng
@@ -317,40 +407,22 @@ for q, rate in enumerate(rates):
         gradients_tot[q, i, 1, :] = -1 * omega_eff[0].detach().numpy()
         gradients_tot[q, i, 0, :] = -1 * h_eff[0].detach().numpy()
 
-        if periodic:
-            np.savez(
-                f"data/kohm_sham_approach/results/tddft_periodic_uniform_zzxxzx_model_h_0_5_omega_0_2_ti_0_tf_{tf:.0f}_hi_{hi[0,0].item():.4f}_delta_{delta[0,0].item():.4f}_omegai_{hi[1,0].item():.1f}_delta_{delta[1,0].item():.1f}_steps_{steps}_self_consistent_steps_{self_consistent_step}_ndata_{ndata}_exp_{exponent_algorithm}",
-                x_qutip=x_qutip_tot[:, :i],
-                z_qutip=z_qutip_tot[:, :i],
-                z=z_tot[:, :i],
-                x=x_tot[:, :i],
-                y=y_tot[:, :i],
-                y_qutip=y_qutip_tot[:, :i],
-                potential=h_tot[:, :i],
-                energy_x=eng_tot_x[:, :i],
-                energy_z=eng_tot_z[:, :i],
-                energy=eng_tot[:, :i],
-                energy_qutip=eng_qutip_tot[:, :i],
-                gradient=gradients_tot[:, :i],
-                rates=rates,
-                time=time[:i],
-            )
+        store.append(
+            trajectory=q,
+            state={"psis": np.stack(psis)},
+            x_qutip=x_qutip_tot[q, i],
+            z_qutip=z_qutip_tot[q, i],
+            z=z_tot[q, i],
+            x=x_tot[q, i],
+            y=y_tot[q, i],
+            y_qutip=y_qutip_tot[q, i],
+            potential=h_tot[q, i],
+            energy_x=eng_tot_x[q, i],
+            energy_z=eng_tot_z[q, i],
+            energy=eng_tot[q, i],
+            energy_qutip=eng_qutip_tot[q, i],
+            gradient=gradients_tot[q, i],
+        )
+    store.flush(q)
 
-        else:
-            np.savez(
-                f"data/kohm_sham_approach/results/ensamble_schrodinger_equation/tddft_quench_uniform_model_h_0_2_omega_0_2_ti_0_tf_{tf:.0f}_hi_{hi[0,0].item():.4f}_hf_{hf[0,0].item():.4f}_omegai_{hi[1,0].item():.1f}_omegaf_{hf[1,0].item():.1f}_steps_{steps}_self_consistent_steps_{self_consistent_step}_ndata_{ndata}_exp_{exponent_algorithm}",
-                x_qutip=x_qutip_tot[:, :i],
-                z_qutip=z_qutip_tot[:, :i],
-                z=z_tot[:, :i],
-                x=x_tot[:, :i],
-                y=y_tot[:, :i],
-                y_qutip=y_qutip_tot[:, :i],
-                potential=h_tot[:, :i],
-                energy_x=eng_tot_x[:, :i],
-                energy_z=eng_tot_z[:, :i],
-                energy=eng_tot[:, :i],
-                energy_qutip=eng_qutip_tot[:, :i],
-                gradient=gradients_tot[:, :i],
-                rates=rates,
-                time=time[:i],
-            )
+store.export_npz(file_name, length=steps)
@@ -1,14 +1,21 @@
 import numpy as np
 import matplotlib.pyplot as plt
 from tqdm import trange, tqdm
-from src.qutip_lab.qutip_class import SpinOperator, SpinHamiltonian, SteadyStateSolver
+from src.qutip_lab.qutip_class import (
+    SpinOperator,
+    SpinHamiltonian,
+    SteadyStateSolver,
+    GroundStateSolver,
+)
 from scipy.fft import fft, ifft
 from scipy.sparse.linalg import eigsh
 import qutip
 from qutip.metrics import fidelity
-from typing import List
+from typing import Dict, List
 from qutip import propagator
 import os
+from src.qutip_lab.parallel_dataset import ParallelDatasetGenerator
+from src.qutip_lab.qutip_evolution import ExactPropagator
 
 
 def generate_smooth_gaussian_noise(
@@ -64,6 +71,10 @@ class Driving:
 # hyperparameters
 
 nbatch = 1
+# seed of the dataset and number of processes
+seed = 42
+n_workers = os.cpu_count()
+shard_size = 500
 
 batch_size = 20000
 l = 8
@@ -80,14 +91,6 @@ steps = 200
 tf = 20.0
 time = np.linspace(0.0, tf, steps)
 
-# z_qutip_tot = np.zeros((nbatch * nbatch * batch_size, steps, l))
-z_qutip_tot = []
-h_eff_tot = []
-h_tot = []
-current_qutip_tot = []
-current_derivative_tot = []
-x_sp_tot = []
-
 ham0 = SpinHamiltonian(
     direction_couplings=[("x", "x")],
     pbc=True,
@@ -99,6 +102,9 @@ hamExtX = SpinOperator(index=[("x", i) for i in range(l)], coupling=[omega] * l,
 
 obs: List[qutip.Qobj] = []
 current_obs: List[qutip.Qobj] = []
+# the same observables as SpinOperator (for the bitmask expectation values)
+spin_obs: List[SpinOperator] = []
+spin_current_obs: List[SpinOperator] = []
 
 for i in range(l):
     z_op = SpinOperator(index=[("z", i)], coupling=[1.0], size=l, verbose=1)
@@ -111,10 +117,23 @@ for i in range(l):
 
     obs.append(z_op.qutip_op)
     current_obs.append(current.qutip_op)
+    spin_obs.append(z_op)
+    spin_current_obs.append(current)
 
 hi = np.ones((time.shape[0], l))  # we fix the initial field to be 1J
 
-for idx in trange(0, batch_size):
+
+# sparse Lanczos ground state (one per worker, reset for each sample)
+gs_solver = GroundStateSolver()
+# Krylov propagator of H = ham0 + hamExtX + sum_i h_i(t) z_i
+exact_propagator = ExactPropagator(
+    ham0.qutip_op + hamExtX.qutip_op, drivings=obs, e_ops=spin_obs + spin_current_obs
+)
+
+
+def generate_sample(idx: int) -> Dict[str, np.ndarray]:
+    # no warm start from the previous sample of the worker: the sample only depends on its seed
+    gs_solver.reset()
 
     # rate = np.random.uniform(0.3, 1.0)
 
@@ -132,36 +151,19 @@ for idx in trange(0, batch_size):
 
     hamExtZ = SpinOperator(index=[("z", i) for i in range(l)], coupling=h[0], size=l)
 
-    eng, psi0 = (ham0.qutip_op + hamExtZ.qutip_op + hamExtX.qutip_op).eigenstates(
-        eigvals=1
+    eng, psi0 = gs_solver.ground_state(
+        ham0.qutip_op + hamExtZ.qutip_op + hamExtX.qutip_op
     )
-    psi0 = psi0[
-        0
-    ]  # qutip.Qobj(psi0[:, 0], shape=psi0.shape, dims=([[2 for i in range(l)], [1]]))
-
-    print("real ground state energy=", eng[0])
-
-    hamiltonian = [ham0.qutip_op + hamExtX.qutip_op]
-
-    for i in range(l):
-        drive_z = Driving(
-            h=h,
-            dt=time[1] - time[0],
-            idx=i,
-        )
-
-        hamiltonian.append([obs[i], drive_z.field])
-
-    # evolution and
 
-    output = qutip.sesolve(hamiltonian, psi0, time, e_ops=obs + current_obs)
+    # exact evolution with the field piecewise constant on the time grid
+    expect, _ = exact_propagator.evolve(psi0, time, h)
 
     current_exp = np.zeros((steps, l))
     z_exp = np.zeros_like(current_exp)
 
     for r in range(l):
-        z_exp[:, r] = output.expect[r]
-        current_exp[:, r] = output.expect[l + r]
+        z_exp[:, r] = expect[r]
+        current_exp[:, r] = expect[l + r]
 
     # Current derivative
     current_derivative = np.gradient(current_exp, time, axis=0)
@@ -174,33 +176,26 @@ for idx in trange(0, batch_size):
     current_derivative = np.gradient(current_exp, time, axis=0)
     h_eff = (0.25 * current_derivative + z_exp) / (x_sp + 10**-4)
 
-    # update the database
-    h_eff_tot.append(h_eff)
-    h_tot.append(h)
-    z_qutip_tot.append(z_exp)
-    current_qutip_tot.append(current_exp)
-    x_sp_tot.append(x_sp)
-    current_derivative_tot.append(current_derivative)
-
-    if idx % 1000 == 0:
-        np.savez(
-            f"data/dataset_h_eff/xxzx_model/dataset_random_rate_random_amplitude_01-08_fixed_initial_state_nbatch_{nbatch}_batchsize_{batch_size}_steps_{steps}_tf_{tf}_l_{l}_240620",
-            current=np.asarray(current_qutip_tot),
-            z=np.asarray(z_qutip_tot),
-            h_eff=np.asarray(h_eff_tot),
-            current_derivative=np.asarray(current_derivative_tot),
-            h=np.asarray(h_tot),
-            x_sp=np.asarray(x_sp_tot),
-            time=time,
-        )
-
-np.savez(
-    f"data/dataset_h_eff/xxzx_model/dataset_random_rate_random_amplitude_01-08_fixed_initial_state_nbatch_{nbatch}_batchsize_{batch_size}_steps_{steps}_tf_{tf}_l_{l}_240620",
-    current=current_qutip_tot,
-    z=z_qutip_tot,
-    h_eff=h_eff_tot,
-    current_derivative=current_derivative_tot,
-    h=h_tot,
-    x_sp=x_sp_tot,
-    time=time,
+    return {
+        "current": current_exp,
+        "z": z_exp,
+        "h_eff": h_eff,
+        "current_derivative": current_derivative,
+        "h": h,
+        "x_sp": x_sp,
+    }
+
+
+# the samples are computed in parallel in shards (each sample with its own seed)
+# and an interrupted run is resumed from the incomplete shards
+file_name = f"data/dataset_h_eff/xxzx_model/dataset_random_rate_random_amplitude_01-08_fixed_initial_state_nbatch_{nbatch}_batchsize_{batch_size}_steps_{steps}_tf_{tf}_l_{l}_240620"
+generator = ParallelDatasetGenerator(
+    sample_function=generate_sample,
+    n_dataset=batch_size,
+    path=file_name + "_shards",
+    seed=seed,
+    n_workers=n_workers,
+    shard_size=shard_size,
 )
+generator.run()
+generator.merge(file_name, time=time)
@@ -6,7 +6,12 @@ import numpy as np
 import matplotlib.pyplot as plt
 from tqdm import trange, tqdm
 from src.training.models_adiabatic import Energy_XXZX, Energy_reduction_XXZX
-from src.qutip_lab.qutip_class import SpinOperator, SpinHamiltonian, SteadyStateSolver
+from src.qutip_lab.qutip_class import (
+    SpinOperator,
+    SpinHamiltonian,
+    SteadyStateSolver,
+    GroundStateSolver,
+)
 
 from src.tddft_methods.kohm_sham_utils import (
     compute_the_gradient,
@@ -18,6 +23,7 @@ from src.tddft_methods.kohm_sham_utils import (
     initialize_psi_from_xyz,
 )
 from src.gradient_descent import GradientDescentKohmSham
+from src.trajectory_store import TrajectoryStore
 import qutip
 from typing import List
 import os
@@ -132,6 +138,9 @@ m_qutip_tot = np.append(
 # is the driving periodic?
 periodic = False
 
+# number of time steps between two chunks of the trajectory store
+checkpoint_every = 100
+
 # define the initial external field
 # zz x quench style (?)
 hi = torch.ones((2, l))
@@ -168,7 +177,20 @@ gd = GradientDescentKohmSham(
 zi = gd.run()
 zi = torch.from_numpy(zi)[0]
 
+if periodic:
+    file_name = f"data/kohm_sham_approach/results/heisemberg_approach/heisemberg_tddft_periodic_uniform_model_h_0_5_omega_0_2_ti_0_tf_{tf:.0f}_hi_{hi[0,0].item():.4f}_delta_{delta[0,0].item():.4f}_omegai_{hi[1,0].item():.1f}_delta_{delta[1,0].item():.1f}_steps_{steps}_self_consistent_steps_{self_consistent_step}_ndata_{ndata}_exp_{exponent_algorithm}"
+else:
+    file_name = f"data/kohm_sham_approach/results/heisemberg_approach/heisemberg_tddft_quench_uniform_model_h_0_5_omega_0_2_ti_0_tf_{tf:.0f}_hi_{hi[0,0].item():.4f}_hf_{hf[0,0].item():.4f}_omegai_{hi[1,0].item():.1f}_omegaf_{hf[1,0].item():.1f}_steps_{steps}_self_consistent_steps_{self_consistent_step}_ndata_{ndata}_exp_{exponent_algorithm}"
+
+# the trajectories are saved in chunks of time steps and a run can be resumed
+store = TrajectoryStore(path=file_name + "_store", flush_every=checkpoint_every)
+store.write_static(rates=rates, time=time.detach().numpy())
+
+# sparse Lanczos ground state, warm started from the previous sample
+gs_solver = GroundStateSolver()
 for q, rate in enumerate(rates):
+    if store.saved_length(q) == time.shape[0] - 1:
+        continue
     # Qutip Dynamics
     # Hamiltonian
     ham0 = SpinHamiltonian(
@@ -185,9 +207,9 @@ for q, rate in enumerate(rates):
         index=[("z", i) for i in range(l)], coupling=hi[0].detach().numpy(), size=l
     )
 
-    eng, psi0 = np.linalg.eigh(ham0.qutip_op + hamExtZ.qutip_op + hamExtX.qutip_op)
-    print(np.linalg.norm(psi0[:, 0]))
-    psi0 = qutip.Qobj(psi0[:, 0], shape=psi0.shape, dims=([[2 for i in range(l)], [1]]))
+    eng, psi0 = gs_solver.ground_state(
+        ham0.qutip_op + hamExtZ.qutip_op + hamExtX.qutip_op
+    )
     print("psi0 norm=", psi0.norm())
     print("real ground state energy=", eng[0])
     # to check if we have the same outcome with the Crank-Nicholson algorithm
@@ -310,7 +332,11 @@ for q, rate in enumerate(rates):
 
     # uniform condition (brute force)
     m = m.unsqueeze(0)  # the batch dimension
-    for i in trange(time.shape[0] - 1):
+    # resume from the last chunk
+    start = store.saved_length(q)
+    if start > 0:
+        m = torch.from_numpy(store.state(q)["m"])
+    for i in trange(start, time.shape[0] - 1):
         t = time[i]
         #  Kohm Sham step 2) Build up the fields
         m = heisemberg_evolution_runge_kutta_step(m=m, h=h, energy=energy, dt=dt, idx=i)
@@ -318,27 +344,18 @@ for q, rate in enumerate(rates):
         z_tot[q, i, :] = m[0, 2].detach().numpy()
         x_tot[q, i, :] = m[0, 0].detach().numpy()
 
-        if periodic:
-            np.savez(
-                f"data/kohm_sham_approach/results/heisemberg_approach/heisemberg_tddft_periodic_uniform_model_h_0_5_omega_0_2_ti_0_tf_{tf:.0f}_hi_{hi[0,0].item():.4f}_delta_{delta[0,0].item():.4f}_omegai_{hi[1,0].item():.1f}_delta_{delta[1,0].item():.1f}_steps_{steps}_self_consistent_steps_{self_consistent_step}_ndata_{ndata}_exp_{exponent_algorithm}",
-                x_qutip=x_qutip_tot,
-                z_qutip=z_qutip_tot,
-                z=z_tot,
-                x=x_tot,
-                potential=h_tot,
-                rates=rates,
-            )
+        store.append(
+            trajectory=q,
+            state={"m": m.detach().numpy()},
+            x_qutip=x_qutip_tot[q, i],
+            z_qutip=z_qutip_tot[q, i],
+            z=z_tot[q, i],
+            x=x_tot[q, i],
+            potential=h_tot[q, i],
+        )
+    store.flush(q)
 
-        else:
-            np.savez(
-                f"data/kohm_sham_approach/results/heisemberg_approach/heisemberg_tddft_quench_uniform_model_h_0_5_omega_0_2_ti_0_tf_{tf:.0f}_hi_{hi[0,0].item():.4f}_hf_{hf[0,0].item():.4f}_omegai_{hi[1,0].item():.1f}_omegaf_{hf[1,0].item():.1f}_steps_{steps}_self_consistent_steps_{self_consistent_step}_ndata_{ndata}_exp_{exponent_algorithm}",
-                x_qutip=x_qutip_tot,
-                z_qutip=z_qutip_tot,
-                z=z_tot,
-                x=x_tot,
-                potential=h_tot,
-                rates=rates,
-            )
+store.export_npz(file_name, length=steps)
 
 # %% Visualize results
 
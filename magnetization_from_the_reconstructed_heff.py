@@ -111,7 +111,10 @@ for q in trange(nbatch):
     zi = torch.tensor(z_exact[q * batch_size : (q + 1) * (batch_size), 0])
     # print(zi.shape)
     # initial magnetization
-    z_evolution = zi.clone().unsqueeze(1)
+    # preallocated evolution of z (batch x time x size)
+    z_evolution = torch.zeros((zi.shape[0], steps, l), dtype=torch.double)
+    z_evolution[:, 0] = zi
+    model.reset_stream()
 
     psi = initialize_psi_from_z_parallel(z=-1 * zi)
 
@@ -120,6 +123,9 @@ for q in trange(nbatch):
 
     h_eff = torch.zeros((h.shape[0], steps, l))
     t_bar = tqdm(enumerate(time))
+    h_total = torch.tensor(h[:, :steps]) + torch.tensor(
+        heff[q * batch_size : (q + 1) * (batch_size), :steps]
+    )
     for i in trange(steps - 1):
         t = time[i]
         psi, df, z_evolution = (
@@ -127,12 +133,12 @@ for q in trange(nbatch):
                 psi=psi,
                 model=model,
                 i=i,
-                h=torch.tensor(h[:, :steps])
-                + torch.tensor(heff[q * batch_size : (q + 1) * (batch_size), :steps]),
-                full_z=z_evolution,  # full z in size x time
+                h=h_total,
+                full_z=z_evolution,  # full z in batch x time x size
                 self_consistent_step=self_consistent_step,
                 dt=dt,
                 exponent_algorithm=exponent_algorithm,
+                streaming=True,
             )
         )
         h_eff[:, i] = df
@@ -6,13 +6,19 @@ import numpy as np
 import matplotlib.pyplot as plt
 from tqdm import trange, tqdm
 from src.training.models_adiabatic import Energy_XXZX, Energy_reduction_XXZX
-from src.qutip_lab.qutip_class import SpinOperator, SpinHamiltonian, SteadyStateSolver
+from src.qutip_lab.qutip_class import (
+    SpinOperator,
+    SpinHamiltonian,
+    SteadyStateSolver,
+    GroundStateSolver,
+)
 
 from src.tddft_methods.kohm_sham_utils import (
     nonlinear_master_equation_step,
     compute_the_gradient,
 )
 from src.gradient_descent import GradientDescentKohmSham, GradientDescent
+from src.trajectory_store import TrajectoryStore
 import qutip
 from typing import List
 import os
@@ -134,6 +140,9 @@ m_qutip_tot = np.append(
 # is the driving periodic?
 periodic = False
 
+# number of time steps between two chunks of the trajectory store
+checkpoint_every = 100
+
 # define the initial external field
 # zz x quench style (?)
 hi = torch.ones((3, l))
@@ -175,7 +184,20 @@ zi = gd.run()
 zi = torch.from_numpy(zi)[0]
 
 
+if periodic:
+    file_name = f"data/kohm_sham_approach/results/master_equation/tddft_periodic_uniform_zzxxzx_model_h_0_5_omega_0_2_ti_0_tf_{tf:.0f}_hi_{hi[0,0].item():.4f}_delta_{delta[0,0].item():.4f}_omegai_{hi[1,0].item():.1f}_delta_{delta[1,0].item():.1f}_steps_{steps}_self_consistent_steps_{self_consistent_step}_ndata_{ndata}_exp_{exponent_algorithm}"
+else:
+    file_name = f"data/kohm_sham_approach/results/master_equation/tddft_quench_uniform_model_zzxyz_h_0_2_omega_0_2_ti_0_tf_{tf:.0f}_hi_{hi[0,0].item():.4f}_hf_{hf[0,0].item():.4f}_omegai_{hi[1,0].item():.1f}_omegaf_{hf[1,0].item():.1f}_steps_{steps}_self_consistent_steps_{self_consistent_step}_ndata_{ndata}_exp_{exponent_algorithm}"
+
+# the trajectories are saved in chunks of time steps and a run can be resumed
+store = TrajectoryStore(path=file_name + "_store", flush_every=checkpoint_every)
+store.write_static(rates=rates, time=time.detach().numpy())
+
+# sparse Lanczos ground state, warm started from the previous sample
+gs_solver = GroundStateSolver()
 for q, rate in enumerate(rates):
+    if store.saved_length(q) == time.shape[0] - 1:
+        continue
     # Qutip Dynamics
     # Hamiltonian
     ham0 = SpinHamiltonian(
@@ -195,10 +217,9 @@ for q, rate in enumerate(rates):
         index=[("y", i) for i in range(l)], coupling=hi[1].detach().numpy(), size=l
     )
 
-    eng, psi0 = np.linalg.eigh(
+    eng, psi0 = gs_solver.ground_state(
         ham0.qutip_op + hamExtZ.qutip_op + hamExtY.qutip_op + hamExtX.qutip_op
     )
-    psi0 = qutip.Qobj(psi0[:, 0], shape=psi0.shape, dims=([[2 for i in range(l)], [1]]))
 
     print("real ground state energy=", eng[0])
 
@@ -322,8 +343,13 @@ for q, rate in enumerate(rates):
     # psi[:, 1] = torch.from_numpy(y_qutip_tot[q, 0]).double()
     # psi[:, 2] = torch.from_numpy(z_qutip_tot[q, 0]).double()
 
+    # resume from the last chunk
+    start = store.saved_length(q)
+    if start > 0:
+        psi = torch.from_numpy(store.state(q)["psi"])
+
     t_bar = tqdm(enumerate(time))
-    for i in trange(time.shape[0] - 1):
+    for i in trange(start, time.shape[0] - 1):
         t = time[i]
         #  Kohm Sham step 2) Build up the fields
         psi, engx, engz, omega_eff, delta_eff, h_eff = nonlinear_master_equation_step(
@@ -346,39 +372,22 @@ for q, rate in enumerate(rates):
         gradients_tot[q, i, 2, :] = -1 * h_eff[0].detach().numpy()
         gradients_tot[q, i, 1, :] = -1 * delta_eff[0].detach().numpy()
 
-        if periodic:
-            np.savez(
-                f"data/kohm_sham_approach/results/master_equation/tddft_periodic_uniform_zzxxzx_model_h_0_5_omega_0_2_ti_0_tf_{tf:.0f}_hi_{hi[0,0].item():.4f}_delta_{delta[0,0].item():.4f}_omegai_{hi[1,0].item():.1f}_delta_{delta[1,0].item():.1f}_steps_{steps}_self_consistent_steps_{self_consistent_step}_ndata_{ndata}_exp_{exponent_algorithm}",
-                x_qutip=x_qutip_tot,
-                z_qutip=z_qutip_tot,
-                y_qutip=y_qutip_tot,
-                z=z_tot,
-                x=x_tot,
-                y=y_tot,
-                potential=h_tot,
-                energy_x=eng_tot_x,
-                energy_z=eng_tot_z,
-                energy=eng_tot,
-                energy_qutip=eng_qutip_tot,
-                gradient=gradients_tot,
-                rates=rates,
-            )
+        store.append(
+            trajectory=q,
+            state={"psi": psi.detach().numpy()},
+            x_qutip=x_qutip_tot[q, i],
+            z_qutip=z_qutip_tot[q, i],
+            y_qutip=y_qutip_tot[q, i],
+            z=z_tot[q, i],
+            x=x_tot[q, i],
+            y=y_tot[q, i],
+            potential=h_tot[q, i],
+            energy_x=eng_tot_x[q, i],
+            energy_z=eng_tot_z[q, i],
+            energy=eng_tot[q, i],
+            energy_qutip=eng_qutip_tot[q, i],
+            gradient=gradients_tot[q, i],
+        )
+    store.flush(q)
 
-        else:
-            np.savez(
-                f"data/kohm_sham_approach/results/master_equation/tddft_quench_uniform_model_zzxyz_h_0_2_omega_0_2_ti_0_tf_{tf:.0f}_hi_{hi[0,0].item():.4f}_hf_{hf[0,0].item():.4f}_omegai_{hi[1,0].item():.1f}_omegaf_{hf[1,0].item():.1f}_steps_{steps}_self_consistent_steps_{self_consistent_step}_ndata_{ndata}_exp_{exponent_algorithm}",
-                x_qutip=x_qutip_tot[:, :i],
-                z_qutip=z_qutip_tot[:, :i],
-                z=z_tot[:, :i],
-                x=x_tot[:, :i],
-                y=y_tot[:, :i],
-                y_qutip=y_qutip_tot[:, :i],
-                potential=h_tot[:, :i],
-                energy_x=eng_tot_x[:, :i],
-                energy_z=eng_tot_z[:, :i],
-                energy=eng_tot[:, :i],
-                energy_qutip=eng_qutip_tot[:, :i],
-                gradient=gradients_tot[:, :i],
-                time=time[:i],
-                rates=rates,
-            )
+store.export_npz(file_name, length=steps)
@@ -1,4 +1,9 @@
-from src.qutip_lab.qutip_class import SpinOperator, SpinHamiltonian, SteadyStateSolver
+from src.qutip_lab.qutip_class import (
+    SpinOperator,
+    SpinHamiltonian,
+    SteadyStateSolver,
+    GroundStateSolver,
+)
 import numpy as np
 import qutip
 from tqdm import tqdm, trange
@@ -7,6 +12,8 @@ import matplotlib.pyplot as plt
 import argparse
 from scipy.fft import fft, ifft
 from src.qutip_lab.utils import counting_multiplicity
+from src.qutip_lab.parallel_dataset import ParallelDatasetGenerator
+from src.qutip_lab.qutip_evolution import ExactPropagator
 
 parser = argparse.ArgumentParser()
 
@@ -112,10 +119,17 @@ parser.add_argument(
 parser.add_argument(
     "--checkpoint",
     type=int,
-    help="number of time step before a checkpoint (default=100)",
+    help="number of samples of a shard of the dataset (default=100)",
     default=100,
 )
 
+parser.add_argument(
+    "--n_workers",
+    type=int,
+    help="number of processes that generate the samples (default=number of cores)",
+    default=None,
+)
+
 parser.add_argument(
     "--noise_type",
     type=str,
@@ -289,24 +303,33 @@ elif args.noise_type == "uniform":
         + f"_uniform_size_{size}_tf_{args.tf}_dt_{args.dt}_rate_{args.rate}_h0_{args.h0}_hf_{args.hf}_n_dataset_{n_dataset}"
     )
 
-# initialization of the return value
-z: np.ndarray = np.zeros((n_dataset, t_resolution, size))
-hs: np.ndarray = np.zeros((n_dataset, t_resolution, size))
-x: np.ndarray = np.zeros((n_dataset, t_resolution, size))
-
-
 # define the initial exp value
 obs: List[qutip.Qobj] = []
 obs_x: List[qutip.Qobj] = []
+# the same observables as SpinOperator (for the bitmask expectation values)
+spin_obs: List[SpinOperator] = []
+spin_obs_x: List[SpinOperator] = []
 for i in range(size):
     z_op = SpinOperator(index=[("z", i)], coupling=[1.0], size=size, verbose=1)
     # print(f"x[{i}]=", x.qutip_op, "\n")
     x_op = SpinOperator(index=[("x", i)], coupling=[1.0], size=size, verbose=1)
     obs.append(z_op.qutip_op)
     obs_x.append(x_op.qutip_op)
+    spin_obs.append(z_op)
+    spin_obs_x.append(x_op)
+
+
+# sparse Lanczos ground state (one per worker, reset for each sample)
+gs_solver = GroundStateSolver()
+
 
+def generate_sample(sample: int) -> Dict[str, np.ndarray]:
+    # no warm start from the previous sample of the worker: the sample only depends on its seed
+    gs_solver.reset()
+    z: np.ndarray = np.zeros((t_resolution, size))
+    hs: np.ndarray = np.zeros((t_resolution, size))
+    x: np.ndarray = np.zeros((t_resolution, size))
 
-for sample in trange(n_dataset):
     # define the initial time independent Hamiltonian
 
     # if args.noise_type == "gaussian" and sample % args.n_initial_field == 0:
@@ -325,7 +348,6 @@ for sample in trange(n_dataset):
 
     # define the time dependent part
     # initialize the driving
-    print(f"noise={args.noise_type}")
     if args.noise_type == "uniform":
         h0 = args.h0  # np.random.uniform(-2, 2, size=1)
         hf = args.hf
@@ -347,13 +369,8 @@ for sample in trange(n_dataset):
         # define the term \sum_i h_i z_i
 
         # compute the initial state as groundstate of H0
-        eng, psi0 = np.linalg.eigh(ham0.qutip_op + hamExt.qutip_op)
-        # psi0 = counting_multiplicity(psi0, eng)
-        # we take into account symmetries even if there shouldn't be
-        # degeneracies
-        psi0 = qutip.Qobj(
-            psi0[:, 0], shape=psi0.shape, dims=([[2 for i in range(size)], [1]])
-        )
+        eng, psi0 = gs_solver.ground_state(ham0.qutip_op + hamExt.qutip_op)
+        # degeneracies are handled by the solver (gs_solver.multiplicity)
 
     # elif args.noise_type == "disorder":
     #     # initial constant field
@@ -373,29 +390,16 @@ for sample in trange(n_dataset):
     #         index=[("z", i) for i in range(size)], coupling=h0, size=size
     #     )
 
-    # define the instance
-    ham = [ham0.qutip_op]
-
     # for an inhomogeneous field a loop runs
     # for each site
     for i in range(size):
         # gaussian type
         if args.noise_type == "uniform":
-            driving = DrivingUniformAnnealing(
-                t_final=args.tf,
-                hf=args.hf,
-                h0=args.h0,
-                rate=rate[sample],
-            )
-
             f_t = np.exp(
                 -1 * rate[sample] * t
             )  # (np.exp(1 - rate[sample] * t) - 1) / (np.exp(1) - 1)
 
-            hs[sample, :, i] = (args.h0 - args.hf) * f_t + args.hf
-            # we add the time dependent term in the Hamiltonian
-            # following the Qutip solver requests
-            ham.append([obs[i], driving.field])
+            hs[:, i] = (args.h0 - args.hf) * f_t + args.hf
 
         # periodic type
         # elif args.noise_type == "periodic":
@@ -403,7 +407,7 @@ for sample in trange(n_dataset):
         #         t_resolution=t_resolution, dt=args.dt, a=args.a, omega=args.omega
         #     )
 
-        #     hs[sample, :, i] = driving.h + h0[sample % args.n_initial_field]
+        #     hs[:, i] = driving.h + h0[sample % args.n_initial_field]
         #     # we add the time dependent term in the Hamiltonian
         #     # following the Qutip solver requests
         #     ham.append([obs[i], driving.field])
@@ -418,22 +422,36 @@ for sample in trange(n_dataset):
                 i=i,
             )
 
-            hs[sample, :, :] = driving.h
-            # we add the time dependent term in the Hamiltonian
-            # following the Qutip solver requests
-            ham.append([obs[i], driving.field])
+            hs[:, :] = driving.h
 
-    # solver
-    output = qutip.sesolve(ham, psi0, t, e_ops=obs + obs_x)
+    # exact Krylov evolution of ham0 + sum_i hs_i(t) z_i on the time grid,
+    # the smooth annealing field is evaluated at the midpoint of each step
+    exact_propagator = ExactPropagator(
+        ham0.qutip_op, drivings=obs, e_ops=spin_obs + spin_obs_x
+    )
+    expect, _ = exact_propagator.evolve(
+        psi0, t, hs, midpoint=args.noise_type == "uniform"
+    )
     # upload the outcomes in z (density) and x
     for i in range(size):
-        z[sample, :, i] = output.expect[i]
+        z[:, i] = expect[i]
     for i in range(size):
-        x[sample, :, i] = output.expect[size + i]
+        x[:, i] = expect[size + i]
+
+    return {"density": z, "potential": hs, "transverse_magnetization": x}
 
-    # save it every args.checkpoint times
-    if sample % args.checkpoint == 0:
-        np.savez(file_name, density=z, potential=hs, time=t, transverse_magnetization=x)
+
+# the samples are computed in parallel in shards of args.checkpoint samples
+# (each one with its own seed) and an interrupted run is resumed
+generator = ParallelDatasetGenerator(
+    sample_function=generate_sample,
+    n_dataset=n_dataset,
+    path=file_name + "_shards",
+    seed=args.seed,
+    n_workers=args.n_workers,
+    shard_size=args.checkpoint,
+)
+generator.run()
 
 # global save at the end
-np.savez(file_name, density=z, potential=hs, time=t, transverse_magnetization=x)
+generator.merge(file_name, time=t)
@@ -51,6 +51,8 @@ gd = gd = GradientDescent(
     seed=235,
     logdiffsoglia=10,
     save=True,
+    # all the instances in a single batch of the functional (same results of the loop over the instances)
+    batched=True,
 )
 
 gd.run()
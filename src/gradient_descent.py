@@ -6,14 +6,38 @@ import torch.nn as nn
 import numpy as np
 from src.training.utils import initial_ensamble_random
 from src.tddft_methods.kohm_sham_utils import compute_the_gradient
+from src.minimizers import BatchedLBFGS
+from src.trajectory_store import TrajectoryStore
+from src.warm_start_cache import WarmStartCache, model_fingerprint
 from tqdm import tqdm, trange
 import matplotlib.pyplot as plt
 import random
-from typing import Optional
+from typing import Optional, Union
 
 device = pt.device("cuda" if pt.cuda.is_available() else "cpu")
 
 
+def get_minimizer(
+    optimizer: Union[str, BatchedLBFGS], max_iterations: int
+) -> Optional[BatchedLBFGS]:
+    """None for the fixed lr gradient descent ("gd"), a BatchedLBFGS for "lbfgs" (or the given one)"""
+    if isinstance(optimizer, BatchedLBFGS):
+        return optimizer
+    if optimizer == "gd":
+        return None
+    if optimizer == "lbfgs":
+        return BatchedLBFGS(max_iterations=max_iterations)
+    raise ValueError(f"optimizer {optimizer} not defined, choose either gd or lbfgs")
+
+
+def energy_and_gradient(energy: nn.Module, phi: pt.Tensor, pot: pt.Tensor) -> tuple:
+    """The energies (rows) of the configurations m = cos(phi) and the gradients with respect to phi"""
+    phi = phi.detach().requires_grad_(True)
+    eng = energy(pt.cos(phi), pot).reshape(-1)
+    (grad,) = pt.autograd.grad(eng.sum(), phi)
+    return eng.detach(), grad.detach()
+
+
 # %% THE GRADIENT DESCENT CLASS
 
 
@@ -39,8 +63,25 @@ class GradientDescent:
         device: str,
         n_init: np.array,
         save: bool,
+        batched: bool = False,
+        instances_per_batch: int = 1000,
+        optimizer: Union[str, BatchedLBFGS] = "gd",
+        flush_every: int = 100,
+        warm_start: Optional[WarmStartCache] = None,
     ):
         self.save = save
+        # converged magnetizations of the previous runs, used as initial guesses
+        self.warm_start = warm_start
+        self.fingerprint = None
+        # number of instances between two writes of the results
+        self.flush_every = flush_every
+
+        # "gd" for the fixed lr steps, "lbfgs" (or a BatchedLBFGS) for the quasi newton minimizer
+        self.minimizer = get_minimizer(optimizer, max_iterations=epochs)
+
+        # many instances (x ensambles) in a single batch of the energy functional
+        self.batched = batched
+        self.instances_per_batch = instances_per_batch
 
         self.device = device
         self.num_threads = num_threads
@@ -96,6 +137,10 @@ class GradientDescent:
         self.eng_model_ref = {}
         self.grads = {}
 
+        # preallocated results (epoch -> n_instances x ...) and the append-only store of the results
+        self.n_flushed = {}
+        self.results_store: Optional[TrajectoryStore] = None
+
         self.epochs = epochs
 
     def run(self) -> None:
@@ -110,24 +155,44 @@ class GradientDescent:
         np.random.seed(self.seed)
         random.seed(self.seed)
 
+        # every instance is computed again: new buffers and a new store of the results
+        self.min_engs, self.min_ns, self.grads, self.min_hist = {}, {}, {}, {}
+        self.n_flushed = {}
+        self.results_store = None
+
         # loading the model
         print("loading the model...")
         self.energy = self.energy.to(device=self.device)
         self.energy.eval()
+        if self.warm_start is not None:
+            self.fingerprint = model_fingerprint(self.energy)
         # starting the cycle for each instance
         print("starting the cycle...")
-        for idx in trange(0, self.n_instances):
-            # initialize phi
-            phi = self.initialize_phi()
-            print(f"is leaf={phi.is_leaf}")
+        if self.batched:
+            for start in trange(0, self.n_instances, self.instances_per_batch):
+                idxs = np.arange(
+                    start, min(start + self.instances_per_batch, self.n_instances)
+                )
+                self._batched_gradient_descent(idxs=idxs)
+        else:
+            for idx in trange(0, self.n_instances):
+                # initialize phi
+                phi = self.initialize_phi(idx=idx)
+                print(f"is leaf={phi.is_leaf}")
 
-            # compute the gradient descent
-            # for a single target sample
-            self._single_gradient_descent(phi=phi, idx=idx)
+                # compute the gradient descent
+                # for a single target sample
+                self._single_gradient_descent(phi=phi, idx=idx)
 
-    def initialize_phi(self) -> pt.tensor:
+        if self.warm_start is not None:
+            self.warm_start.save()
+
+    def initialize_phi(self, idx: Optional[int] = None) -> pt.tensor:
         """This routine initialize the phis using the average decomposition of the dataset (up to now, the best initialization ever found)
 
+        With a warm start cache, the first configuration of the ensamble of the instance idx is replaced by the
+        cached magnetization of the same (or of the nearest) external field.
+
         Returns:
             phi[pt.tensor]: [the initialized phis with non zero gradient]
         """
@@ -161,6 +226,10 @@ class GradientDescent:
         # initialize in double and device
         phi = phi.to(dtype=pt.double)
         phi = phi.to(device=self.device)
+        if self.warm_start is not None and idx is not None:
+            m_guess = self.warm_start.get(self.v_target[idx], self.fingerprint)
+            if m_guess is not None and tuple(m_guess.shape) == tuple(phi.shape[1:]):
+                phi[0] = pt.acos(pt.tensor(m_guess, dtype=pt.double))
         # make it a leaft
         phi.requires_grad_(True)
 
@@ -188,6 +257,20 @@ class GradientDescent:
         n_ref = self.n_target[idx]
         pot = pt.tensor(self.v_target[idx], device=self.device)
 
+        if self.minimizer is not None:
+            phi, eng, grad, history = self.minimizer.minimize(
+                lambda x, rows: energy_and_gradient(self.energy, x, pot), phi, verbose=True
+            )
+            self.checkpoints(
+                eng=eng,
+                phi=phi,
+                idx=idx,
+                history=history,
+                epoch=self.epochs - 1,
+                grad=grad.cpu().numpy(),
+            )
+            return
+
         history = pt.tensor([], device=self.device)
 
         # exact_history = np.array([])
@@ -242,6 +325,117 @@ class GradientDescent:
             eng=eng, phi=phi, idx=idx, history=history, epoch=epoch, grad=grad
         )
 
+    def _batched_gradient_descent(self, idxs: np.ndarray) -> None:
+        """The gradient descent of a set of instances at once: the n_ensambles initial configurations of
+        each instance are stacked in a single (instances*ensambles, ...) batch, so the energy functional
+        is called once per epoch for all of them.
+
+        Each row has its own learning rate. With early stopping a row whose energy changes less than diffsoglia
+        gets a zero learning rate (as in _single_gradient_descent) and, after the evaluation of its final energy,
+        it is removed from the batch. The results of each instance are then saved with checkpoints.
+
+        Args:
+            idxs (np.ndarray): the indices of the instances
+        """
+        n_rows = idxs.shape[0] * self.n_ensambles
+        # rows ordered as (instance, ensamble)
+        phi = pt.cat([self.initialize_phi(idx=idx).detach() for idx in idxs], dim=0)
+        pot = pt.tensor(self.v_target[idxs], device=self.device)
+        pot = pot.repeat_interleave(self.n_ensambles, dim=0)
+
+        # results of all the rows (filled when a row is removed from the batch)
+        phi_final = pt.zeros_like(phi)
+        eng_final = pt.zeros(n_rows, dtype=pt.double, device=self.device)
+        grad_final = pt.zeros_like(phi)
+        history_epochs = [0] + list(range(10000, self.epochs, 10000))
+        history = pt.full(
+            (len(history_epochs), n_rows), np.nan, dtype=pt.double, device=self.device
+        )
+
+        if self.minimizer is not None:
+            phi_final, eng_final, grad_final, history = self.minimizer.minimize(
+                lambda x, rows: energy_and_gradient(self.energy, x, pot[rows]), phi
+            )
+            self._save_batch(idxs, phi_final, eng_final, grad_final, history)
+            return
+
+        active = pt.arange(n_rows, device=self.device)
+        lr = (10**self.loglr) * pt.ones(n_rows, device=self.device)
+        eng_old = pt.zeros(n_rows, dtype=pt.double, device=self.device)
+
+        t_iterator = tqdm(range(self.epochs), leave=False)
+        for epoch in t_iterator:
+            eng, phi, grad = self.batched_gradient_descent_step(
+                phi=phi, pot=pot, lr=lr
+            )
+
+            if epoch in history_epochs:
+                history[history_epochs.index(epoch), active] = eng
+
+            # the rows with a zero lr did not move: their results are final
+            done = (lr == 0) | (epoch == self.epochs - 1)
+            if pt.any(done):
+                phi_final[active[done]] = phi[done]
+                eng_final[active[done]] = eng[done]
+                grad_final[active[done]] = grad[done]
+                keep = pt.logical_not(done)
+                active, phi, pot, lr = active[keep], phi[keep], pot[keep], lr[keep]
+                eng, eng_old = eng[keep], eng_old[keep]
+            if active.shape[0] == 0:
+                break
+
+            if self.early_stopping:
+                lr[pt.abs(eng - eng_old) < self.diffsoglia] = 0
+            if self.variable_lr:
+                lr = lr * self.ratio  # ONLY WITH FIXED EPOCHS
+            eng_old = eng
+
+            t_iterator.set_description(f"active rows={active.shape[0]}")
+
+        # the energies of the removed rows do not change anymore
+        history = pt.where(pt.isnan(history), eng_final[None, :], history)
+        self._save_batch(idxs, phi_final, eng_final, grad_final, history)
+
+    def _save_batch(
+        self,
+        idxs: np.ndarray,
+        phi: pt.Tensor,
+        eng: pt.Tensor,
+        grad: pt.Tensor,
+        history: pt.Tensor,
+    ) -> None:
+        """checkpoints of each instance of a batch (rows ordered as (instance, ensamble))"""
+        for i, idx in enumerate(idxs):
+            rows = slice(i * self.n_ensambles, (i + 1) * self.n_ensambles)
+            self.checkpoints(
+                eng=eng[rows],
+                phi=phi[rows],
+                idx=int(idx),
+                history=history[:, rows],
+                epoch=self.epochs - 1,
+                grad=grad[rows].cpu().numpy(),
+            )
+
+    def batched_gradient_descent_step(
+        self, phi: pt.tensor, pot: pt.Tensor, lr: pt.Tensor
+    ) -> tuple:
+        """Gradient step of a batch of configurations with a learning rate for each row
+
+        Arguments:
+        phi[pt.tensor]: [the angles of the magnetization (rows x ...)]
+        pot[pt.tensor]: [the external fields of the rows]
+        lr[pt.tensor]: [the learning rates (rows)]
+
+        Returns:
+            eng[pt.tensor]: [the energy values computed before the step]
+            phi[pt.tensor]: [the angles after the step]
+            grad[pt.tensor]: [the gradient before the step]
+        """
+        eng, grad = energy_and_gradient(self.energy, phi, pot)
+        with pt.no_grad():
+            phi = phi - lr.view(-1, *([1] * (phi.dim() - 1))) * grad
+        return eng, phi, grad
+
     def gradient_descent_step(self, phi: pt.tensor, pot: pt.Tensor) -> tuple:
         """This routine computes the step of the gradient using both the positivity and the nomralization constrain
 
@@ -260,9 +454,12 @@ class GradientDescent:
         eng.backward(pt.ones_like(eng))
 
         with pt.no_grad():
-            grad = phi.grad
+            # a copy, phi.grad is zeroed in place below
+            grad = phi.grad.clone()
 
-            phi -= self.lr * grad
+            # with early stopping the lr has one value per configuration of the ensamble
+            lr = self.lr.view(-1, *([1] * (phi.dim() - 1))) if self.lr.dim() > 0 else self.lr
+            phi -= lr * grad
             phi.grad.zero_()
 
         return eng.clone().detach(), phi, grad.detach().cpu().numpy()
@@ -329,6 +526,11 @@ class GradientDescent:
     ) -> None:
         """This function is a checkpoint save.
 
+        The results of the instance are written in place in buffers preallocated for all the instances.
+        Every flush_every instances (and at the last one) the new rows are appended to the store
+        data/gd_data/results_<session> (see TrajectoryStore) and the eng_, density_ and history_ .npz files
+        are written with the instances computed so far.
+
         Args:
         eng[np.array]: the set of energies for each initial configuration obtained after the gradient descent
         phi[pt.tensor]: the set of sqrt density profiles for each initial configuration obtained after the gradient descent
@@ -368,49 +570,87 @@ class GradientDescent:
 
         phi_min = phi[idx_min]
         grad_min = grad[idx_min]
-        history_min = history[:, idx_min]
+        history_min = history[:, idx_min].cpu().numpy().reshape(-1)
 
         # exact_history_min = exact_history[idx_min]
-        # append to the values
-        if idx == 0:
-            self.min_engs[epoch] = eng_min
-            self.min_hist[epoch] = history_min.cpu().numpy().reshape(1, -1)
-
-        else:
-            self.min_engs[epoch] = np.append(self.min_engs[epoch], eng_min)
-            self.min_hist[epoch] = np.append(
-                self.min_hist[epoch], history_min.cpu().numpy().reshape(1, -1)
+        # the buffers of the results are allocated for all the instances at the first one
+        if epoch not in self.min_engs:
+            self.min_engs[epoch] = np.zeros(self.n_instances)
+            self.min_ns[epoch] = np.zeros((self.n_instances,) + tuple(phi_min.shape))
+            self.grads[epoch] = np.zeros((self.n_instances,) + grad_min.shape)
+            self.min_hist[epoch] = np.zeros((self.n_instances, self._history_length()))
+            self.n_flushed[epoch] = 0
+
+        self.min_engs[epoch][idx] = eng_min
+        self.min_ns[epoch][idx] = np.cos(phi_min.cpu().detach().numpy())
+        if self.warm_start is not None:
+            self.warm_start.put(
+                self.v_target[idx], self.fingerprint, self.min_ns[epoch][idx]
             )
+        self.grads[epoch][idx] = grad_min
+        # the histories are padded with the final energy (constant after the convergence)
+        width = self.min_hist[epoch].shape[1]
+        self.min_hist[epoch][idx, : min(width, history_min.shape[0])] = history_min[
+            :width
+        ]
+        self.min_hist[epoch][idx, history_min.shape[0] :] = history_min[-1]
 
         # self.min_exct_hist.append(exact_history_min)
 
-        if idx == 0:
-            self.min_ns[epoch] = np.cos(phi_min.cpu().detach().numpy())
-            self.grads[epoch] = grad_min
-        else:
-            self.min_ns[epoch] = np.vstack(
-                (self.min_ns[epoch], np.cos(phi_min.cpu().detach().numpy()))
-            )
-            self.grads[epoch] = np.vstack((self.grads[epoch], grad_min))
-
         # save the numpy values
         if self.save:
-            if idx != 0:
-                np.savez(
-                    "data/gd_data/eng_" + session_name,
-                    min_energy=self.min_engs[epoch],
-                    gs_energy=self.e_target[0 : (self.min_engs[epoch].shape[0])],
-                )
-                np.savez(
-                    "data/gd_data/density_" + session_name,
-                    min_density=self.min_ns[epoch],
-                    gs_density=self.n_target[0 : self.min_ns[epoch].shape[0]],
-                    gradient=self.grads[epoch],
-                )
-                np.savez(
-                    "data/gd_data/history_" + session_name,
-                    history=self.min_hist[epoch],
-                )
+            n_results = idx + 1
+            last = n_results == self.n_instances
+            if n_results - self.n_flushed[epoch] >= self.flush_every or last:
+                self._flush_results(session_name, epoch, n_results)
+
+    def _history_length(self) -> int:
+        """Number of recorded energies of a minimization (epoch 0 and every 10000 epochs, or the iterations of the minimizer)"""
+        if self.minimizer is not None:
+            return self.minimizer.max_iterations + 1
+        return len([0] + list(range(10000, self.epochs, 10000)))
+
+    def _flush_results(self, session_name: str, epoch: int, n_results: int) -> None:
+        """Append the results of the instances computed since the last write to the store of the session
+        (one chunk with the new rows only, so the I/O is linear in the number of instances) and write the
+        eng_, density_ and history_ .npz files of the first n_results instances"""
+        path = "data/gd_data/results_" + session_name
+        if self.results_store is None or self.results_store.path != path:
+            self.results_store = TrajectoryStore(path=path)
+            # run() computes every instance again: the results of a previous run are removed
+            self.results_store.clear()
+        start = self.n_flushed[epoch]
+        if n_results > start:
+            self.results_store.extend(
+                trajectory=0,
+                min_energy=self.min_engs[epoch][start:n_results],
+                gs_energy=self.e_target[start:n_results],
+                min_density=self.min_ns[epoch][start:n_results],
+                gs_density=self.n_target[start:n_results],
+                gradient=self.grads[epoch][start:n_results],
+                history=self.min_hist[epoch][start:n_results],
+            )
+        self.n_flushed[epoch] = n_results
+
+        np.savez(
+            "data/gd_data/eng_" + session_name,
+            min_energy=self.min_engs[epoch][:n_results],
+            gs_energy=self.e_target[0:n_results],
+        )
+        np.savez(
+            "data/gd_data/density_" + session_name,
+            min_density=self.min_ns[epoch][:n_results].reshape(
+                -1, self.min_ns[epoch].shape[-1]
+            ),
+            gs_density=self.n_target[0:n_results],
+            gradient=self.grads[epoch][:n_results].reshape(
+                -1, self.grads[epoch].shape[-1]
+            ),
+        )
+        np.savez(
+            "data/gd_data/history_" + session_name,
+            history=self.min_hist[epoch][:n_results],
+        )
 
 
 class GradientDescentKohmSham:
@@ -424,8 +664,17 @@ class GradientDescentKohmSham:
         device: str,
         n_init: np.array,
         h: np.array,
+        optimizer: Union[str, BatchedLBFGS] = "gd",
+        warm_start: Optional[WarmStartCache] = None,
     ):
         self.device = device
+
+        # converged magnetizations of the previous runs, used as initial guesses
+        self.warm_start = warm_start
+        self.fingerprint = None
+
+        # "gd" for the fixed lr steps, "lbfgs" (or a BatchedLBFGS) for the quasi newton minimizer
+        self.minimizer = get_minimizer(optimizer, max_iterations=epochs)
         self.num_threads = num_threads
         self.seed = seed
 
@@ -457,6 +706,8 @@ class GradientDescentKohmSham:
         print("loading the model...")
         self.energy = self.energy.to(device=self.device)
         self.energy.eval()
+        if self.warm_start is not None:
+            self.fingerprint = model_fingerprint(self.energy)
         # starting the cycle for each instance
         print("starting the cycle...")
 
@@ -468,6 +719,10 @@ class GradientDescentKohmSham:
         # for a single target sample
         z = self._single_gradient_descent(phi=phi)
 
+        if self.warm_start is not None:
+            self.warm_start.put(np.asarray(self.h), self.fingerprint, z[0])
+            self.warm_start.save()
+
         return z
 
     def initialize_phi(self) -> pt.tensor:
@@ -480,6 +735,11 @@ class GradientDescentKohmSham:
         # sqrt of the initial configuration
 
         m_init = pt.tensor(self.n_init, dtype=pt.double).unsqueeze(0)
+        # the cached magnetization of the same (or of the nearest) field
+        if self.warm_start is not None:
+            m_guess = self.warm_start.get(np.asarray(self.h), self.fingerprint)
+            if m_guess is not None and tuple(m_guess.shape) == tuple(m_init.shape[1:]):
+                m_init = pt.tensor(m_guess, dtype=pt.double).unsqueeze(0)
 
         phi = pt.acos(m_init)
         print(phi.shape)
@@ -512,6 +772,15 @@ class GradientDescentKohmSham:
 
         pot = pt.tensor(self.h, device=self.device).unsqueeze(0)
 
+        if self.minimizer is not None:
+            phi, eng, grad, history = self.minimizer.minimize(
+                lambda x, rows: energy_and_gradient(self.energy, x, pot), phi, verbose=True
+            )
+            print(
+                f"eng={eng[0].item():.8f} after {self.minimizer.iterations[0].item()} iterations"
+            )
+            return np.cos(phi.detach().cpu().numpy())
+
         # exact_history = np.array([])
 
         eng_old = pt.tensor(0, device=self.device)
@@ -550,7 +819,8 @@ class GradientDescentKohmSham:
         eng.backward(pt.ones_like(eng))
 
         with pt.no_grad():
-            grad = phi.grad
+            # a copy, phi.grad is zeroed in place below
+            grad = phi.grad.clone()
 
             phi -= self.lr * grad
             phi.grad.zero_()
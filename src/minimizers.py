@@ -0,0 +1,186 @@
+import torch as pt
+from typing import Callable, Tuple
+from tqdm import trange
+
+
+class BatchedLBFGS:
+    def __init__(
+        self,
+        history_size: int = 10,
+        max_iterations: int = 500,
+        energy_tolerance: float = 1e-10,
+        gradient_tolerance: float = 1e-6,
+        c1: float = 1e-4,
+        max_line_search: int = 30,
+    ) -> None:
+        """L-BFGS minimizer of a batch of independent problems (e.g. the ground states of many instances
+        and initial configurations in the angle parametrization phi = acos(m)).
+
+        Each row of the batch has its own curvature history, its own backtracking line search (Armijo condition)
+        and its own convergence: a row is converged when the energy change of an iteration is smaller than
+        energy_tolerance and the maximum of the gradient is smaller than gradient_tolerance, and then it is
+        not evaluated anymore.
+
+        Args:
+            history_size (int): number of stored curvature pairs. Defaults to 10.
+            max_iterations (int): maximum number of iterations. Defaults to 500.
+            energy_tolerance (float): tolerance on the energy change. Defaults to 1e-10.
+            gradient_tolerance (float): tolerance on the maximum of the gradient. Defaults to 1e-6.
+            c1 (float): sufficient decrease parameter of the line search. Defaults to 1e-4.
+            max_line_search (int): maximum number of halvings of the step. Defaults to 30.
+        """
+        self.history_size = history_size
+        self.max_iterations = max_iterations
+        self.energy_tolerance = energy_tolerance
+        self.gradient_tolerance = gradient_tolerance
+        self.c1 = c1
+        self.max_line_search = max_line_search
+
+        # number of iterations of each row of the last minimization
+        self.iterations = None
+
+    def _direction(
+        self,
+        g: pt.Tensor,
+        s: pt.Tensor,
+        y: pt.Tensor,
+        rho: pt.Tensor,
+        valid: pt.Tensor,
+    ) -> pt.Tensor:
+        """Two loop recursion (rows x n), the pairs are ordered from the oldest to the newest"""
+        q = g.clone()
+        alpha = pt.zeros_like(rho)
+        for i in range(self.history_size - 1, -1, -1):
+            a = valid[:, i] * rho[:, i] * (s[:, i] * q).sum(-1)
+            q = q - a[:, None] * y[:, i]
+            alpha[:, i] = a
+
+        # scale of the initial hessian from the newest pair, min(1, 1/|g|_1) without pairs
+        sy = (s[:, -1] * y[:, -1]).sum(-1)
+        yy = (y[:, -1] * y[:, -1]).sum(-1)
+        gamma = pt.where(
+            valid[:, -1],
+            sy / pt.clamp(yy, min=1e-300),
+            pt.clamp(1 / pt.clamp(g.abs().sum(-1), min=1e-300), max=1.0),
+        )
+        r = gamma[:, None] * q
+        for i in range(self.history_size):
+            b = valid[:, i] * rho[:, i] * (y[:, i] * r).sum(-1)
+            r = r + s[:, i] * (alpha[:, i] - b)[:, None]
+        return -r
+
+    def minimize(
+        self,
+        closure: Callable[[pt.Tensor, pt.Tensor], Tuple[pt.Tensor, pt.Tensor]],
+        x0: pt.Tensor,
+        verbose: bool = False,
+    ) -> Tuple[pt.Tensor, pt.Tensor, pt.Tensor, pt.Tensor]:
+        """Minimize the energies of the rows of x0
+
+        Args:
+            closure (Callable): closure(x, rows) returns the energies (len(rows)) and the gradients (same shape of x)
+            of the configurations x of the rows of the batch given by the index tensor rows
+            x0 (pt.Tensor): the initial configurations (rows x ...)
+            verbose (bool): progress bar. Defaults to False.
+
+        Returns:
+            x (pt.Tensor): the minimum configurations
+            eng (pt.Tensor): their energies
+            grad (pt.Tensor): their gradients
+            history (pt.Tensor): the energies at each iteration (iterations+1 x rows), constant after the convergence
+        """
+        shape = x0.shape
+        n_rows = shape[0]
+        x = x0.detach().reshape(n_rows, -1).clone()
+        n = x.shape[1]
+        m = self.history_size
+
+        rows = pt.arange(n_rows, device=x.device)
+        eng, grad = closure(x.reshape(shape), rows)
+        grad = grad.reshape(n_rows, -1)
+
+        s = pt.zeros((n_rows, m, n), dtype=x.dtype, device=x.device)
+        y = pt.zeros_like(s)
+        rho = pt.zeros((n_rows, m), dtype=x.dtype, device=x.device)
+        valid = pt.zeros((n_rows, m), dtype=pt.bool, device=x.device)
+
+        history = [eng.clone()]
+        self.iterations = pt.zeros(n_rows, dtype=pt.long, device=x.device)
+        active = pt.ones(n_rows, dtype=pt.bool, device=x.device)
+
+        iterator = (
+            trange(self.max_iterations, leave=False)
+            if verbose
+            else range(self.max_iterations)
+        )
+        for it in iterator:
+            idx = pt.nonzero(active).reshape(-1)
+            if idx.shape[0] == 0:
+                break
+            g = grad[idx]
+            d = self._direction(g, s[idx], y[idx], rho[idx], valid[idx])
+            # restart from the gradient if d is not a descent direction
+            slope = (g * d).sum(-1)
+            restart = slope >= 0
+            if pt.any(restart):
+                scale = pt.clamp(1 / pt.clamp(g.abs().sum(-1), min=1e-300), max=1.0)
+                d[restart] = -scale[restart, None] * g[restart]
+                slope = (g * d).sum(-1)
+                valid[idx[restart]] = False
+
+            # backtracking line search on all the rows at once
+            t = pt.ones(idx.shape[0], dtype=x.dtype, device=x.device)
+            x_new = x[idx].clone()
+            eng_new = eng[idx].clone()
+            grad_new = g.clone()
+            searching = pt.ones(idx.shape[0], dtype=pt.bool, device=x.device)
+            for k in range(self.max_line_search):
+                pending = pt.nonzero(searching).reshape(-1)
+                if pending.shape[0] == 0:
+                    break
+                x_trial = x[idx[pending]] + t[pending, None] * d[pending]
+                eng_trial, grad_trial = closure(
+                    x_trial.reshape(-1, *shape[1:]), idx[pending]
+                )
+                accept = eng_trial <= eng[idx[pending]] + self.c1 * t[
+                    pending
+                ] * slope[pending]
+                accepted = pending[accept]
+                x_new[accepted] = x_trial[accept]
+                eng_new[accepted] = eng_trial[accept]
+                grad_new[accepted] = grad_trial.reshape(pending.shape[0], -1)[accept]
+                searching[accepted] = False
+                t[pending[pt.logical_not(accept)]] *= 0.5
+            # rows without a sufficient decrease do not move and are stopped
+            stalled = searching
+
+            # curvature pairs (kept only if s.y > 0)
+            step = x_new - x[idx]
+            change = grad_new - g
+            sy = (step * change).sum(-1)
+            update = (sy > 1e-300) & pt.logical_not(stalled)
+            upd = idx[update]
+            s[upd] = pt.cat((s[upd, 1:], step[update, None]), dim=1)
+            y[upd] = pt.cat((y[upd, 1:], change[update, None]), dim=1)
+            rho[upd] = pt.cat((rho[upd, 1:], 1 / sy[update, None]), dim=1)
+            valid[upd] = pt.cat(
+                (valid[upd, 1:], pt.ones_like(valid[upd, :1])), dim=1
+            )
+
+            converged = (
+                pt.abs(eng_new - eng[idx]) < self.energy_tolerance
+            ) & (grad_new.abs().max(-1)[0] < self.gradient_tolerance)
+
+            x[idx] = x_new
+            eng[idx] = eng_new
+            grad[idx] = grad_new
+            self.iterations[idx] += 1
+            active[idx[converged | stalled]] = False
+            history.append(eng.clone())
+
+            if verbose:
+                iterator.set_description(
+                    f"active rows={int(active.sum())} eng={eng.mean().item():.8f}"
+                )
+
+        return x.reshape(shape), eng, grad.reshape(shape), pt.stack(history, dim=0)
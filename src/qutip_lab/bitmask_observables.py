@@ -0,0 +1,161 @@
+import numpy as np
+from typing import Dict, List, Optional, Tuple
+from src.qutip_lab.pauli_strings import LOCAL_OPERATORS, local_bit_map
+
+
+def _popcount(x: np.ndarray) -> np.ndarray:
+    if hasattr(np, "bitwise_count"):
+        return np.bitwise_count(x)
+    count = np.zeros_like(x)
+    while np.any(x):
+        count += x & 1
+        x = x >> 1
+    return count
+
+
+def pauli_string_masks(string: Tuple, size: int) -> Tuple[int, int, complex]:
+    """Bitmask form of a Pauli string: P|b> = phase * (-1)^popcount(b & sign) |b ^ flip>
+    (site 0 is the most significant bit, as in qutip.tensor)
+
+    Args:
+        string (Tuple): (direction, site, direction, site, ...) with x, y, z, id
+        size (int): number of sites
+
+    Returns:
+        flip (int): mask of the flipped bits
+        sign (int): mask of the bits that give a -1
+        phase (complex): the global phase
+    """
+    local = {}
+    for k in range(0, len(string), 2):
+        direction, idx = string[k], int(string[k + 1])
+        if idx in local:
+            local[idx] = local[idx] @ LOCAL_OPERATORS[direction]
+        else:
+            local[idx] = LOCAL_OPERATORS[direction]
+
+    flip, sign, phase = 0, 0, 1.0 + 0.0j
+    for idx, matrix in local.items():
+        bit_flip, amplitude = local_bit_map(matrix)
+        if bit_flip[0] != bit_flip[1] or amplitude[0] == 0:
+            raise ValueError(f"{string} is not a Pauli string")
+        # a product of Pauli matrices is diag(1, +-1) times a flip, times a phase
+        ratio = amplitude[1] / amplitude[0]
+        if not (np.isclose(ratio, 1.0) or np.isclose(ratio, -1.0)):
+            raise ValueError(f"{string} is not a Pauli string")
+        shift = size - 1 - idx
+        flip |= int(bit_flip[0]) << shift
+        if np.real(ratio) < 0:
+            sign |= 1 << shift
+        phase *= amplitude[0]
+    return flip, sign, phase
+
+
+def is_pauli_operator(operator) -> bool:
+    """True if the operator is a SpinOperator (index, coupling, size) made of Pauli strings"""
+    if not (all(hasattr(operator, key) for key in ["index", "coupling", "size"])):
+        return False
+    try:
+        for string in operator.index:
+            pauli_string_masks(string, operator.size)
+    except ValueError:
+        return False
+    return True
+
+
+class BitmaskObservables:
+    def __init__(self, observables: List, size: int) -> None:
+        """Expectation values of sums of Pauli strings for a batch of states in the computational basis.
+
+        Each Pauli string is a bit flip mask, a sign mask and a phase, so <psi|P|psi> = phase * sum_b conj(psi[b ^ flip])
+        (-1)^popcount(b & sign) psi[b]. The strings are grouped by flip mask: for each group the overlap conj(psi[b ^ flip]) psi[b]
+        is computed once (|psi|^2 for the diagonal ones, e.g. all the sigma_z) and contracted with the sign table of all the strings
+        of the group in a single matrix product. The cost is linear in the dimension and in the number of flip masks.
+
+        Args:
+            observables (List): SpinOperator or (index, coupling) pairs with the SpinOperator convention
+            size (int): number of sites
+        """
+        self.size = size
+        self.dimension = 2**size
+        self.n_observables = len(observables)
+
+        basis = np.arange(self.dimension, dtype=np.int64)
+        groups: Dict[int, List] = {}
+        for k, observable in enumerate(observables):
+            if isinstance(observable, tuple):
+                index, coupling = observable
+            else:
+                index, coupling = observable.index, observable.coupling
+            for string, c in zip(index, coupling):
+                flip, sign, phase = pauli_string_masks(string, size)
+                groups.setdefault(flip, []).append((sign, phase * c, k))
+
+        # for each flip mask: the gather index, the sign table (dimension x strings)
+        # and the (strings x observables) weights
+        self.groups = []
+        for flip, terms in groups.items():
+            signs = np.stack(
+                [1.0 - 2.0 * (_popcount(basis & sign) % 2) for sign, _, _ in terms],
+                axis=-1,
+            )
+            weights = np.zeros((len(terms), self.n_observables), dtype=np.complex128)
+            for t, (_, weight, k) in enumerate(terms):
+                weights[t, k] += weight
+            self.groups.append((flip, basis ^ flip, signs, weights))
+
+    @classmethod
+    def spin_chain(
+        cls,
+        size: int,
+        directions: Tuple[str] = ("z", "x", "y"),
+        current_coupling: Optional[float] = None,
+        pbc: bool = True,
+    ):
+        """On site magnetizations along directions (in this order, site by site) followed, if current_coupling
+        is given, by the bond currents current_coupling * (x_{i-1} y_i + y_i x_{i+1}) as in the current_obs of the drivers"""
+        observables = []
+        for direction in directions:
+            for i in range(size):
+                observables.append(([(direction, i)], [1.0]))
+        if current_coupling is not None:
+            for i in range(size):
+                if pbc:
+                    index = [("x", (i - 1) % size, "y", i), ("y", i, "x", (i + 1) % size)]
+                    coupling = [current_coupling, current_coupling]
+                else:
+                    index = [
+                        s
+                        for s in [("x", i - 1, "y", i), ("y", i, "x", i + 1)]
+                        if 0 <= s[1] < size and 0 <= s[3] < size
+                    ]
+                    coupling = [current_coupling for s in index]
+                observables.append((index, coupling))
+        return cls(observables, size)
+
+    def expect(self, psi: np.ndarray) -> np.ndarray:
+        """Expectation values
+
+        Args:
+            psi (np.ndarray): a state (dimension) or a batch of states (batch x dimension)
+
+        Returns:
+            np.ndarray: the (real) expectation values (n_observables) or (batch x n_observables)
+        """
+        psi = np.asarray(psi)
+        single = psi.ndim == 1
+        psi = psi.reshape(-1, self.dimension)
+
+        values = np.zeros((psi.shape[0], self.n_observables), dtype=np.complex128)
+        for flip, gather, signs, weights in self.groups:
+            if flip == 0:
+                overlap = np.abs(psi) ** 2
+                strings = overlap @ signs
+            else:
+                overlap = np.conj(psi[:, gather]) * psi
+                strings = overlap.real @ signs + 1j * (overlap.imag @ signs)
+            values += strings @ weights
+
+        values = np.real(values)
+        return values[0] if single else values
+
@@ -0,0 +1,132 @@
+import os
+import queue
+import multiprocessing
+import numpy as np
+from concurrent.futures import ProcessPoolExecutor, wait, FIRST_COMPLETED
+from typing import Callable, Dict, List, Tuple
+from tqdm import tqdm
+from src.trajectory_store import TrajectoryStore
+
+# inherited by the forked workers (so the sample function does not need to be picklable)
+_SAMPLE_FUNCTION: Callable = None
+_PROGRESS: multiprocessing.Queue = None
+
+
+def sample_seed(seed: int, sample: int) -> int:
+    """Deterministic seed of a single sample, independent of the shard and of the worker that computes it"""
+    return int(np.random.SeedSequence([seed, sample]).generate_state(1)[0])
+
+
+def _run_shard(path: str, seed: int, start: int, stop: int, flush_every: int) -> int:
+    store = TrajectoryStore(path=path, flush_every=flush_every)
+    for sample in range(start + store.saved_length(), stop):
+        np.random.seed(sample_seed(seed, sample))
+        store.append(**_SAMPLE_FUNCTION(sample))
+        _PROGRESS.put(1)
+    store.flush()
+    return start
+
+
+class ParallelDatasetGenerator:
+    def __init__(
+        self,
+        sample_function: Callable[[int], Dict[str, np.ndarray]],
+        n_dataset: int,
+        path: str,
+        seed: int,
+        n_workers: int = None,
+        shard_size: int = 100,
+        flush_every: int = 10,
+    ) -> None:
+        """Generates the samples of a dataset with a pool of processes.
+
+        The samples are split in shards of consecutive indices, each shard is computed by a worker and written in its own
+        TrajectoryStore (path/shard_<start>_<stop>), so an interrupted run resumes the incomplete shards from their last chunk.
+        Before each sample the numpy global seed is fixed to sample_seed(seed, sample), thus the dataset does not depend on
+        the number of workers. The workers are forked, so the sample function and the objects it uses (operators,
+        hamiltonians, ...) are inherited from the main process.
+
+        Args:
+            sample_function (Callable[[int], Dict[str, np.ndarray]]): the index of the sample -> the arrays of the sample
+            n_dataset (int): number of samples
+            path (str): the directory of the shards
+            seed (int): the seed of the dataset
+            n_workers (int): number of processes. Defaults to the number of cores.
+            shard_size (int): number of samples of a shard. Defaults to 100.
+            flush_every (int): number of samples between two chunks of a shard. Defaults to 10.
+        """
+        self.sample_function = sample_function
+        self.n_dataset = n_dataset
+        self.path = path
+        self.seed = seed
+        self.n_workers = os.cpu_count() if n_workers is None else n_workers
+        self.shard_size = shard_size
+        self.flush_every = flush_every
+
+        self.shards: List[Tuple[int, int]] = [
+            (start, min(start + shard_size, n_dataset))
+            for start in range(0, n_dataset, shard_size)
+        ]
+
+    def shard_path(self, start: int, stop: int) -> str:
+        return os.path.join(self.path, f"shard_{start:08d}_{stop:08d}")
+
+    def shard_store(self, start: int, stop: int) -> TrajectoryStore:
+        return TrajectoryStore(
+            path=self.shard_path(start, stop), flush_every=self.flush_every
+        )
+
+    def run(self):
+        """Compute the missing samples of all the shards"""
+        global _SAMPLE_FUNCTION, _PROGRESS
+        context = multiprocessing.get_context("fork")
+        _SAMPLE_FUNCTION = self.sample_function
+        _PROGRESS = context.Queue()
+
+        done = {
+            (start, stop): self.shard_store(start, stop).saved_length()
+            for start, stop in self.shards
+        }
+        pending = [shard for shard in self.shards if done[shard] < shard[1] - shard[0]]
+
+        progress = tqdm(
+            total=self.n_dataset, initial=sum(done.values()), desc="samples"
+        )
+        with ProcessPoolExecutor(
+            max_workers=self.n_workers, mp_context=context
+        ) as pool:
+            futures = {
+                pool.submit(
+                    _run_shard,
+                    self.shard_path(start, stop),
+                    self.seed,
+                    start,
+                    stop,
+                    self.flush_every,
+                )
+                for start, stop in pending
+            }
+            while len(futures) > 0:
+                finished, futures = wait(futures, timeout=1.0, return_when=FIRST_COMPLETED)
+                for future in finished:
+                    # raise the exceptions of the workers
+                    future.result()
+                try:
+                    while True:
+                        progress.update(_PROGRESS.get_nowait())
+                except queue.Empty:
+                    pass
+        progress.close()
+
+    def merge(self, file_name: str, **static):
+        """Concatenate the shards (in the order of the samples) in a single .npz file with the static arrays.
+        The index of the shards (first and last sample of each one) is saved as shard_index."""
+        values: Dict[str, List] = {}
+        for start, stop in self.shards:
+            store = self.shard_store(start, stop)
+            if store.saved_length() != stop - start:
+                raise ValueError(f"shard {start}-{stop} is incomplete, call run first")
+            for key, value in store.load_trajectory().items():
+                values.setdefault(key, []).append(value)
+        arrays = {key: np.concatenate(value, axis=0) for key, value in values.items()}
+        np.savez(file_name, **arrays, **static, shard_index=np.asarray(self.shards))
@@ -0,0 +1,151 @@
+from collections import OrderedDict
+from typing import List, Tuple
+import numpy as np
+from scipy import sparse
+
+# single site operators in the qutip convention (basis(2,0) is the spin up of sigmaz)
+LOCAL_OPERATORS = {
+    "x": np.array([[0.0, 1.0], [1.0, 0.0]], dtype=np.complex128),
+    "y": np.array([[0.0, -1.0j], [1.0j, 0.0]], dtype=np.complex128),
+    "z": np.array([[1.0, 0.0], [0.0, -1.0]], dtype=np.complex128),
+    "+": np.array([[0.0, 1.0], [0.0, 0.0]], dtype=np.complex128),
+    "-": np.array([[0.0, 0.0], [1.0, 0.0]], dtype=np.complex128),
+    "id": np.eye(2, dtype=np.complex128),
+}
+
+# maximum memory of the cached operator structures (each string of size L takes ~32 * 2**L bytes)
+PAULI_CACHE_BYTES = 256 * 2**20
+
+# (index, size) -> (rows, columns, values, terms), in order of use
+_pauli_sum_cache: "OrderedDict[Tuple, Tuple[np.ndarray, ...]]" = OrderedDict()
+
+
+def local_bit_map(matrix: np.ndarray) -> Tuple[np.ndarray, np.ndarray]:
+    """Decompose a single site operator with at most one non zero element per column
+    in a bit flip and an amplitude for each value of the input bit.
+
+    Args:
+        matrix (np.ndarray): the (2 x 2) local operator
+
+    Returns:
+        flip (np.ndarray): 1 if the operator flips the bit (for input bit 0 and 1)
+        amplitude (np.ndarray): the matrix element for input bit 0 and 1
+    """
+    flip = np.zeros(2, dtype=np.int64)
+    amplitude = np.zeros(2, dtype=np.complex128)
+    for c in range(2):
+        rows = np.nonzero(matrix[:, c])[0]
+        if len(rows) > 1:
+            raise ValueError(f"local operator {matrix} is not a product of Pauli matrices")
+        if len(rows) == 1:
+            flip[c] = rows[0] ^ c
+            amplitude[c] = matrix[rows[0], c]
+    return flip, amplitude
+
+
+def pauli_string_coo(
+    string: Tuple, size: int
+) -> Tuple[np.ndarray, np.ndarray, np.ndarray]:
+    """Non zero elements of a many body Pauli string (e.g. ("x", 0, "y", 1)) in the computational basis,
+    computed directly from the bit arithmetic of the basis states (site 0 is the most significant bit,
+    as in qutip.tensor). The operators acting on the same site are multiplied in the given order.
+
+    Args:
+        string (Tuple): (direction, site, direction, site, ...)
+        size (int): number of sites
+
+    Returns:
+        rows, columns, values (np.ndarray): coordinates of the non zero elements
+    """
+    local = {}
+    for k in range(0, len(string), 2):
+        direction, idx = string[k], string[k + 1]
+        if idx in local:
+            local[idx] = local[idx] @ LOCAL_OPERATORS[direction]
+        else:
+            local[idx] = LOCAL_OPERATORS[direction]
+
+    columns = np.arange(2**size, dtype=np.int64)
+    rows = columns.copy()
+    values = np.ones(2**size, dtype=np.complex128)
+    for idx, matrix in local.items():
+        flip, amplitude = local_bit_map(matrix)
+        shift = size - 1 - idx
+        bit = (columns >> shift) & 1
+        rows ^= flip[bit] << shift
+        values *= amplitude[bit]
+
+    mask = values != 0
+    return rows[mask], columns[mask], values[mask]
+
+
+def pauli_sum_coo(
+    index: Tuple[Tuple], size: int
+) -> Tuple[np.ndarray, np.ndarray, np.ndarray, np.ndarray]:
+    """The non zero elements of all the strings of a SpinOperator with the term they belong to,
+    so that a new set of couplings only rescales the stored values.
+
+    The results are cached by (index, size) up to PAULI_CACHE_BYTES in total, the least recently used
+    ones are evicted first and a structure larger than the bound is not cached"""
+    key = (index, size)
+    if key in _pauli_sum_cache:
+        _pauli_sum_cache.move_to_end(key)
+        return _pauli_sum_cache[key]
+
+    rows, columns, values, terms = [], [], [], []
+    for k, string in enumerate(index):
+        r, c, v = pauli_string_coo(string, size)
+        rows.append(r)
+        columns.append(c)
+        values.append(v)
+        terms.append(np.full(r.shape[0], k, dtype=np.int64))
+    result = (
+        np.concatenate(rows),
+        np.concatenate(columns),
+        np.concatenate(values),
+        np.concatenate(terms),
+    )
+
+    if _nbytes(result) <= PAULI_CACHE_BYTES:
+        _pauli_sum_cache[key] = result
+        while pauli_cache_bytes() > PAULI_CACHE_BYTES:
+            _pauli_sum_cache.popitem(last=False)
+    return result
+
+
+def _nbytes(arrays: Tuple[np.ndarray, ...]) -> int:
+    return sum(a.nbytes for a in arrays)
+
+
+def pauli_cache_bytes() -> int:
+    """Memory of the cached operator structures"""
+    return sum(_nbytes(value) for value in _pauli_sum_cache.values())
+
+
+def clear_pauli_cache():
+    _pauli_sum_cache.clear()
+
+
+def pauli_sum_csr(index: List[Tuple], coupling: List, size: int) -> sparse.csr_matrix:
+    """CSR matrix of sum_k coupling[k] * index[k] (index as in SpinOperator)
+
+    Args:
+        index (List[Tuple]): list of Pauli strings (direction, site, direction, site, ...)
+        coupling (List): coupling of each string
+        size (int): number of sites
+
+    Returns:
+        sparse.csr_matrix: the (2**size x 2**size) operator
+    """
+    key = tuple(
+        tuple(int(s) if k % 2 == 1 else s for k, s in enumerate(string))
+        for string in index
+    )
+    rows, columns, values, terms = pauli_sum_coo(key, size)
+    coupling = np.asarray(coupling, dtype=np.complex128)[: len(key)]
+    matrix = sparse.csr_matrix(
+        (values * coupling[terms], (rows, columns)), shape=(2**size, 2**size)
+    )
+    # sum_duplicates is done by the conversion, cancellations are removed here
+    matrix.eliminate_zeros()
+    return matrix
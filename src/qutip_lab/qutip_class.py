@@ -1,8 +1,13 @@
 from __future__ import annotations
 import qutip
 from qutip import operators, entropy_vn
-from typing import List, Tuple, Optional, Type, Dict
+from typing import List, Tuple, Optional, Type, Dict, Union
 import numpy as np
+from scipy import sparse
+from scipy.sparse.linalg import eigsh
+from src.qutip_lab.pauli_strings import pauli_sum_csr
+from src.qutip_lab.utils import to_csr
+from src.qutip_lab.symmetries import SymmetrySector, commuting_symmetries
 
 
 # stackoverflow https://stackoverflow.com/questions/5389507/iterating-over-every-two-elements-in-a-list
@@ -175,70 +180,16 @@ class SpinOperator(ManyBodyQutipOperator):
                 self._description + f" ( {self.coupling[k]} ,  {tuple_indices} ) \n"
             )
 
-            coupling = self.coupling[k]
-            # initialize the SpinOperator
-            op_dict: Dict = {}
-            indices: List = []
-            for direction, idx in pairwise(tuple_indices):
-                # define the given
-                # local label operator
-
-                if idx in op_dict.keys():
-                    op_dict[idx] = op_dict[idx] * self._local_obs_dict[direction]
-                else:
-                    op_dict[idx] = self._local_obs_dict[direction]
-                    indices.append(idx)
-
-                # we fix the first part of the chain with
-                # an identity operator
-            if not (0 in op_dict.keys()):
-                indices.append(0)
-                op_dict[0] = self._local_obs_dict["id"]
-
-                # and the last part with another identity
-                # operator
-            if not (self.size - 1 in op_dict.keys()):
-                indices.append(self.size - 1)
-                op_dict[self.size - 1] = self._local_obs_dict["id"]
-
-            # order the indices
-            indices.sort()
-            # method for qutip.tensor optimization by Ewen Lawrence https://github.com/ewenlawrence
-            # dumb index
-            jdx: int = 0
-
-            for i, idx in enumerate(indices):
-                # if the sites are not nearest neighbours
-                # create a identity with dim 2**(i-j)
-
-                if idx - jdx > 1:
-                    identity = qutip.identity(2 ** (idx - jdx - 1))
-                    chain_oper = qutip.tensor(identity, op_dict[idx])
-                # otherwise define the operator
-                else:
-                    chain_oper = op_dict[idx]
-                # if k == 1:
-                #     print("partial chain oper=", chain_oper, k)
-
-                if i == 0:
-                    many_body_op = chain_oper
-                else:
-                    many_body_op = qutip.tensor(many_body_op, chain_oper)
-
-                jdx = idx
-
-            # reshape the dimension of the qutip
-            # object
-            many_body_op = qutip.Qobj(
-                many_body_op.data,
-                dims=[[2 for i in range(self.size)], [2 for i in range(self.size)]],
-            )
-
-            # sum each direction
-            if k == 0:
-                self.qutip_op = many_body_op * coupling
-            else:
-                self.qutip_op = self.qutip_op + many_body_op * coupling
+        # the Pauli strings are built directly in CSR format from the bit arithmetic
+        # of the basis states and cached by (index, size), so a new set of couplings
+        # only rescales the stored terms
+        many_body_op = pauli_sum_csr(
+            index=self.index, coupling=self.coupling, size=self.size
+        )
+        self.qutip_op = qutip.Qobj(
+            many_body_op,
+            dims=[[2 for i in range(self.size)], [2 for i in range(self.size)]],
+        )
 
 
 class FockOperator(ManyBodyQutipOperator):
@@ -503,9 +454,24 @@ class Hamiltonian(ManyBodyQutipOperator):
                 else:
                     raise ValueError("Non Hermitian Hamiltonian \n")
 
+    def ground_state(
+        self, solver: Optional[GroundStateSolver] = None
+    ) -> Tuple[np.ndarray, qutip.Qobj]:
+        """Lowest energies and ground state of the Hamiltonian (see GroundStateSolver).
+        Pass the same solver across a dataset to warm start from the previous ground state."""
+        if solver is None:
+            solver = GroundStateSolver()
+        return solver.ground_state(self.qutip_op)
+
+    def symmetries(self) -> List[str]:
+        """The symmetries of the chain (translation, reflection, spin_flip, z_parity) that commute with the Hamiltonian"""
+        return commuting_symmetries([self.qutip_op], self.size)
+
+    def block(self, sector: SymmetrySector) -> sparse.csr_matrix:
+        """The block of the Hamiltonian in a symmetry sector"""
+        return sector.project_operator(self.qutip_op)
+
 
-# we still can implement new attributes
-# such as eigsh and gs_state
 class SpinHamiltonian(Hamiltonian):
     def __init__(
         self,
@@ -604,6 +570,111 @@ class SpinHamiltonian(Hamiltonian):
                 self.j_ao.append(j)
 
 
+class GroundStateSolver:
+    def __init__(
+        self,
+        k: int = 4,
+        degeneracy_tol: float = 1e-8,
+        warm_start: bool = True,
+        tol: float = 0.0,
+        dense_dimension: int = 256,
+    ) -> None:
+        """Sparse Lanczos (eigsh) solver for the ground state of a sequence of Hamiltonians.
+
+        Only the k lowest eigenpairs are computed. With warm_start the previous ground state is the starting
+        vector of the Lanczos iteration, which converges in a few steps when the fields vary smoothly
+        across the samples of a dataset. The ground state is degenerate if more than one of the k energies
+        is within degeneracy_tol (relative) of the lowest one: in this case the returned state is the projection
+        of the previous ground state on the degenerate subspace (or the normalized sum of the degenerate
+        eigenvectors for the first Hamiltonian, as in counting_multiplicity), so the choice is continuous
+        along the dataset. Without warm_start (or after reset) the outcome only depends on the Hamiltonian.
+
+        Args:
+            k (int): number of computed eigenpairs. Defaults to 4.
+            degeneracy_tol (float): relative energy tolerance of the degenerate subspace. Defaults to 1e-8.
+            warm_start (bool): start from the previous ground state. Defaults to True.
+            tol (float): tolerance of eigsh (0 is machine precision). Defaults to 0.0.
+            dense_dimension (int): below this dimension the full spectrum is computed with eigh. Defaults to 256.
+        """
+        self.k = k
+        self.degeneracy_tol = degeneracy_tol
+        self.warm_start = warm_start
+        self.tol = tol
+        self.dense_dimension = dense_dimension
+
+        # attributes
+        self.psi: np.ndarray = None
+        self.energies: np.ndarray = None
+        self.multiplicity: int = None
+
+    def reset(self):
+        """Forget the previous ground state (the next one is computed from scratch)"""
+        self.psi = None
+        self.energies = None
+        self.multiplicity = None
+
+    def __eigenpairs(self, matrix: sparse.csr_matrix, k: int):
+        n = matrix.shape[0]
+        if n <= self.dense_dimension or k >= n - 1:
+            energies, vectors = np.linalg.eigh(matrix.toarray())
+            return energies[:k], vectors[:, :k]
+        # a fixed starting vector without a warm start (the default one of eigsh depends on the previous calls)
+        v0 = np.random.default_rng(0).standard_normal(n)
+        if self.warm_start and self.psi is not None and self.psi.shape[0] == n:
+            v0 = self.psi
+        energies, vectors = eigsh(matrix, k=k, which="SA", v0=v0, tol=self.tol)
+        order = np.argsort(energies)
+        return energies[order], vectors[:, order]
+
+    def ground_state(
+        self, hamiltonian: Union[qutip.Qobj, ManyBodyQutipOperator, sparse.spmatrix]
+    ) -> Tuple[np.ndarray, qutip.Qobj]:
+        """Compute the ground state
+
+        Args:
+            hamiltonian (Union[qutip.Qobj, ManyBodyQutipOperator, sparse.spmatrix]): the Hamiltonian
+
+        Returns:
+            energies (np.ndarray): the k lowest energies
+            psi0 (qutip.Qobj): the ground state (a qubit ket)
+        """
+        matrix = to_csr(hamiltonian)
+        n = matrix.shape[0]
+
+        # if all the computed states are degenerate the subspace may be larger
+        k = min(self.k, n)
+        while True:
+            energies, vectors = self.__eigenpairs(matrix, k)
+            scale = max(1.0, np.abs(energies[0]))
+            multiplicity = int(
+                np.sum(np.abs(energies - energies[0]) <= self.degeneracy_tol * scale)
+            )
+            if multiplicity < k or k == n:
+                break
+            k = min(2 * k, n)
+
+        ground = vectors[:, :multiplicity]
+        psi = None
+        if self.warm_start and self.psi is not None and self.psi.shape[0] == n:
+            # continuity with the previous ground state (projection and phase)
+            psi = ground @ (ground.conj().T @ self.psi)
+            if np.linalg.norm(psi) < 1e-8:
+                psi = None
+        if psi is None:
+            psi = np.sum(ground, axis=-1)
+        psi = psi / np.linalg.norm(psi)
+
+        self.psi = psi
+        self.energies = energies
+        self.multiplicity = multiplicity
+
+        size = int(np.round(np.log2(n)))
+        psi0 = qutip.Qobj(
+            psi.reshape(-1, 1), dims=[[2 for i in range(size)], [1 for i in range(size)]]
+        )
+        return energies, psi0
+
+
 class SteadyStateSolver:
     def __init__(
         self,
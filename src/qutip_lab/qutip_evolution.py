@@ -0,0 +1,220 @@
+import numpy as np
+import qutip
+from scipy import sparse
+from scipy.sparse.linalg import expm_multiply
+from typing import Dict, List, Optional, Tuple
+from tqdm import trange
+from src.qutip_lab.utils import to_csr
+from src.qutip_lab.bitmask_observables import BitmaskObservables, is_pauli_operator
+from src.qutip_lab.symmetries import SymmetrySector, commuting_symmetries
+
+
+def data_positions(pattern: sparse.csr_matrix, matrix: sparse.csr_matrix) -> np.ndarray:
+    """Positions of the non zero elements of matrix in the data array of pattern (the sparsity pattern of matrix must be contained in the one of pattern)"""
+    n = pattern.shape[1]
+    pattern_rows = np.repeat(np.arange(pattern.shape[0]), np.diff(pattern.indptr))
+    matrix_rows = np.repeat(np.arange(matrix.shape[0]), np.diff(matrix.indptr))
+    # with sorted indices the keys of the csr format are sorted
+    pattern_keys = pattern_rows.astype(np.int64) * n + pattern.indices
+    matrix_keys = matrix_rows.astype(np.int64) * n + matrix.indices
+    return np.searchsorted(pattern_keys, matrix_keys)
+
+
+class ExactPropagator:
+    def __init__(
+        self,
+        hamiltonian_0,
+        drivings: List,
+        e_ops: Optional[List] = None,
+        symmetries: bool = True,
+    ) -> None:
+        """Exact propagator of H(t) = H_0 + sum_i h_i(t) D_i for fields that are piecewise constant on the time grid.
+
+        The drivings D_i (e.g. the on site sigma_z) and H_0 are merged in a single sparsity pattern, so the Hamiltonian
+        of a time step is a matrix vector product (pattern entries x drivings) @ h(t) on the data array, and the state
+        is advanced with the Krylov action of the exponential (expm_multiply) without any Python callback. The observables
+        given as SpinOperator of Pauli strings are computed with the bitmask engine (BitmaskObservables), the other diagonal
+        ones are stacked in a single matrix and contracted with |psi|^2, the rest are kept in CSR format.
+
+        If the fields are uniform (the same on every driving) the evolution is restricted to the symmetry sector of the
+        initial state (momentum, reflection and Z2 parities that commute with H_0 and sum_i D_i, see SymmetrySector),
+        e.g. the zero momentum, fixed parity sector of the uniform quenches.
+
+        Args:
+            hamiltonian_0 (qutip.Qobj, ManyBodyQutipOperator or sparse matrix): the time independent part
+            drivings (List): the operators D_i coupled to the fields
+            e_ops (Optional[List]): the observables (SpinOperator, qutip.Qobj or sparse matrices). Defaults to None.
+            symmetries (bool): detect the symmetries and use the reduced sectors for uniform fields. Defaults to True.
+        """
+        h0 = to_csr(hamiltonian_0)
+        drivings = [to_csr(d) for d in drivings]
+        for matrix in [h0] + drivings:
+            matrix.eliminate_zeros()
+            matrix.sort_indices()
+        self.dimension = h0.shape[0]
+        self.size = int(np.round(np.log2(self.dimension)))
+        self.n_drivings = len(drivings)
+
+        # symmetries of H_0 + h(t) sum_i D_i
+        self.h0 = h0
+        self.driving_sum = sparse.csr_matrix(h0.shape, dtype=np.complex128)
+        for d in drivings:
+            self.driving_sum = self.driving_sum + d
+        self.symmetries: List[str] = []
+        if symmetries and 2**self.size == self.dimension:
+            self.symmetries = commuting_symmetries([h0, self.driving_sum], self.size)
+        self.sectors: Dict[Tuple, Tuple[SymmetrySector, "ExactPropagator"]] = {}
+
+        # common sparsity pattern
+        pattern = abs(h0)
+        for d in drivings:
+            pattern = pattern + abs(d)
+        pattern = sparse.csr_matrix(pattern)
+        pattern.sum_duplicates()
+        pattern.sort_indices()
+        self.indices = pattern.indices
+        self.indptr = pattern.indptr
+
+        self.data_0 = np.zeros(pattern.nnz, dtype=np.complex128)
+        self.data_0[data_positions(pattern, h0)] = h0.data
+
+        # (pattern entries x drivings) map from the fields to the data array
+        positions, columns, values = [], [], []
+        for i, d in enumerate(drivings):
+            positions.append(data_positions(pattern, d))
+            columns.append(np.full(d.nnz, i))
+            values.append(d.data)
+        self.driving_map = sparse.csr_matrix(
+            (
+                np.concatenate(values) if len(values) > 0 else np.zeros(0),
+                (
+                    np.concatenate(positions) if len(values) > 0 else np.zeros(0),
+                    np.concatenate(columns) if len(values) > 0 else np.zeros(0),
+                ),
+            ),
+            shape=(pattern.nnz, self.n_drivings),
+            dtype=np.complex128,
+        )
+
+        self.e_ops = e_ops
+        self.diagonal_index: List[int] = []
+        self.diagonal_ops: np.ndarray = None
+        self.sparse_index: List[int] = []
+        self.sparse_ops: List[sparse.csr_matrix] = []
+        self.bitmask_index: List[int] = []
+        self.bitmask: BitmaskObservables = None
+        if e_ops is not None:
+            diagonals = []
+            pauli_ops = []
+            for k, op in enumerate(e_ops):
+                if is_pauli_operator(op):
+                    self.bitmask_index.append(k)
+                    pauli_ops.append(op)
+                    continue
+                op = to_csr(op)
+                if (op - sparse.diags(op.diagonal())).count_nonzero() == 0:
+                    self.diagonal_index.append(k)
+                    diagonals.append(np.real(op.diagonal()))
+                else:
+                    self.sparse_index.append(k)
+                    self.sparse_ops.append(op)
+            if len(diagonals) > 0:
+                self.diagonal_ops = np.stack(diagonals, axis=0)
+            if len(pauli_ops) > 0:
+                self.bitmask = BitmaskObservables(pauli_ops, self.size)
+
+    def hamiltonian(self, field: np.ndarray) -> sparse.csr_matrix:
+        """The Hamiltonian for a given value of the fields (n_drivings)"""
+        data = self.data_0 + self.driving_map @ np.asarray(field, dtype=np.complex128)
+        return sparse.csr_matrix(
+            (data, self.indices, self.indptr), shape=(self.dimension, self.dimension)
+        )
+
+    def expect(self, psi: np.ndarray) -> np.ndarray:
+        """Expectation values of the observables on the state psi"""
+        values = np.zeros(len(self.e_ops))
+        if self.bitmask is not None:
+            values[self.bitmask_index] = self.bitmask.expect(psi)
+        if self.diagonal_ops is not None:
+            values[self.diagonal_index] = self.diagonal_ops @ np.abs(psi) ** 2
+        for k, op in zip(self.sparse_index, self.sparse_ops):
+            values[k] = np.real(np.vdot(psi, op @ psi))
+        return values
+
+    def evolve(
+        self,
+        psi0,
+        time: np.ndarray,
+        fields: np.ndarray,
+        midpoint: bool = False,
+        store_states: bool = False,
+        verbose: bool = False,
+    ) -> Tuple[np.ndarray, Optional[np.ndarray]]:
+        """Evolve the initial state on the time grid.
+
+        Args:
+            psi0 (qutip.Qobj or np.ndarray): the initial state
+            time (np.ndarray): the time grid (time)
+            fields (np.ndarray): the fields on the grid (time x n_drivings). In the step [t_n, t_n+1] the field is fields[n]
+            (as the qutip callbacks self.h[int(t / self.dt), i]), or (fields[n] + fields[n+1]) / 2 with midpoint.
+            midpoint (bool): use the midpoint value of the field in each step. Defaults to False.
+            store_states (bool): return the states at each time. Defaults to False.
+            verbose (bool): progress bar. Defaults to False.
+
+        Returns:
+            expect (np.ndarray): the expectation values of e_ops (n_ops x time), as the expect of a qutip.Result
+            states (Optional[np.ndarray]): the states (time x dimension) if store_states
+        """
+        psi = np.asarray(psi0.full() if isinstance(psi0, qutip.Qobj) else psi0)
+        psi = psi.reshape(-1).astype(np.complex128)
+
+        n_ops = 0 if self.e_ops is None else len(self.e_ops)
+        expect = np.zeros((n_ops, time.shape[0]))
+        states = (
+            np.zeros((time.shape[0], self.dimension), dtype=np.complex128)
+            if store_states
+            else None
+        )
+
+        if n_ops > 0:
+            expect[:, 0] = self.expect(psi)
+        if store_states:
+            states[0] = psi
+
+        # restriction to the symmetry sector of the initial state
+        hamiltonian = self.hamiltonian
+        sector = None
+        if len(self.symmetries) > 0 and np.allclose(fields, fields[:, :1]):
+            sector = SymmetrySector.from_state(psi, self.size, self.symmetries)
+            if sector is not None and sector.dimension < self.dimension:
+                hamiltonian = self.sector_propagator(sector).hamiltonian
+                psi = sector.project_state(psi)
+                fields = fields[:, : min(self.n_drivings, 1)]
+            else:
+                sector = None
+
+        steps = trange(time.shape[0] - 1) if verbose else range(time.shape[0] - 1)
+        for n in steps:
+            dt = time[n + 1] - time[n]
+            field = fields[n] if not (midpoint) else 0.5 * (fields[n] + fields[n + 1])
+            psi = expm_multiply(-1j * dt * hamiltonian(field), psi)
+
+            psi_full = psi if sector is None else sector.embed_state(psi)
+            if n_ops > 0:
+                expect[:, n + 1] = self.expect(psi_full)
+            if store_states:
+                states[n + 1] = psi_full
+
+        return expect, states
+
+    def sector_propagator(self, sector: SymmetrySector) -> "ExactPropagator":
+        """The propagator of H_0 + h(t) sum_i D_i in a symmetry sector (cached)"""
+        if sector.key not in self.sectors:
+            drivings = []
+            if self.n_drivings > 0:
+                drivings = [sector.project_operator(self.driving_sum)]
+            propagator = ExactPropagator(
+                sector.project_operator(self.h0), drivings=drivings, symmetries=False
+            )
+            self.sectors[sector.key] = (sector, propagator)
+        return self.sectors[sector.key][1]
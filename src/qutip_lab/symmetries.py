@@ -0,0 +1,229 @@
+import numpy as np
+from scipy import sparse
+from typing import Dict, List, Optional, Tuple
+from src.qutip_lab.utils import to_csr
+
+# symmetries of a spin chain with periodic boundary conditions:
+# translation (i -> i+1), reflection (i -> L-1-i), spin flip (prod_i x_i) and z parity (prod_i z_i)
+SYMMETRIES = ["translation", "reflection", "spin_flip", "z_parity"]
+
+
+def site_permutation(sites: np.ndarray, size: int) -> np.ndarray:
+    """Permutation of the basis states induced by the permutation of the sites (site i -> sites[i]),
+    site 0 is the most significant bit"""
+    basis = np.arange(2**size, dtype=np.int64)
+    permuted = np.zeros_like(basis)
+    for i in range(size):
+        bit = (basis >> (size - 1 - i)) & 1
+        permuted |= bit << (size - 1 - sites[i])
+    return permuted
+
+
+def symmetry_action(name: str, size: int) -> Tuple[np.ndarray, np.ndarray]:
+    """Action g|b> = sign[b] |perm[b]> of a symmetry generator on the computational basis"""
+    basis = np.arange(2**size, dtype=np.int64)
+    sign = np.ones(2**size)
+    if name == "translation":
+        perm = site_permutation((np.arange(size) + 1) % size, size)
+    elif name == "reflection":
+        perm = site_permutation(size - 1 - np.arange(size), size)
+    elif name == "spin_flip":
+        perm = basis ^ (2**size - 1)
+    elif name == "z_parity":
+        perm = basis
+        count = np.zeros_like(basis)
+        for i in range(size):
+            count += (basis >> i) & 1
+        sign = 1.0 - 2.0 * (count % 2)
+    else:
+        raise ValueError(f"symmetry {name} not defined, choose one of {SYMMETRIES}")
+    return perm, sign
+
+
+def symmetry_matrix(perm: np.ndarray, sign: np.ndarray) -> sparse.csr_matrix:
+    n = perm.shape[0]
+    return sparse.csr_matrix((sign, (perm, np.arange(n))), shape=(n, n))
+
+
+def _max_abs(matrix: sparse.spmatrix) -> float:
+    matrix = sparse.csr_matrix(matrix)
+    return float(np.max(np.abs(matrix.data))) if matrix.nnz > 0 else 0.0
+
+
+def commuting_symmetries(
+    operators: List, size: int, tolerance: float = 1e-10
+) -> List[str]:
+    """The symmetries (see SYMMETRIES) that commute with all the operators (qutip.Qobj, SpinOperator or sparse)"""
+    matrices = [to_csr(op) for op in operators]
+    symmetries = []
+    for name in SYMMETRIES:
+        if name in ["translation", "reflection"] and size < 3:
+            continue
+        g = symmetry_matrix(*symmetry_action(name, size))
+        if all(_max_abs(g @ m - m @ g) < tolerance for m in matrices):
+            symmetries.append(name)
+    # the spin flip and the z parity anticommute for an odd number of sites
+    if "spin_flip" in symmetries and "z_parity" in symmetries and size % 2 == 1:
+        symmetries.remove("z_parity")
+    return symmetries
+
+
+class SymmetrySector:
+    def __init__(
+        self,
+        size: int,
+        momentum: Optional[int] = None,
+        reflection: Optional[int] = None,
+        spin_flip: Optional[int] = None,
+        z_parity: Optional[int] = None,
+    ) -> None:
+        """Symmetry adapted basis of a sector of a spin chain (with periodic boundary conditions).
+
+        The sector is fixed by the eigenvalues of the symmetries: T|psi> = exp(2 pi i momentum / size)|psi>
+        for the translation and +-1 for the reflection and the two Z2 parities (None if the symmetry is not used).
+        The basis states are the projections P|r> = 1/|G| sum_g conj(chi(g)) g|r> of the orbit representatives r,
+        normalized, and they are the columns of the (2**size x dimension) isometry basis.
+
+        Args:
+            size (int): number of sites
+            momentum (Optional[int]): momentum index k in [0, size). Defaults to None.
+            reflection (Optional[int]): reflection parity, only for momentum 0 or size/2. Defaults to None.
+            spin_flip (Optional[int]): eigenvalue of prod_i x_i. Defaults to None.
+            z_parity (Optional[int]): eigenvalue of prod_i z_i. Defaults to None.
+        """
+        self.size = size
+        self.momentum = momentum
+        self.reflection = reflection
+        self.spin_flip = spin_flip
+        self.z_parity = z_parity
+
+        if reflection is not None and momentum is not None:
+            if not (momentum % size == 0 or 2 * (momentum % size) == size):
+                raise ValueError(
+                    "the reflection parity is defined only for momentum 0 or size/2"
+                )
+        if spin_flip is not None and z_parity is not None and size % 2 == 1:
+            raise ValueError(
+                "spin flip and z parity anticommute for an odd number of sites"
+            )
+
+        self.basis = self.__get_the_basis()
+        self.dimension = self.basis.shape[1]
+
+    @property
+    def key(self) -> Tuple:
+        return (self.size, self.momentum, self.reflection, self.spin_flip, self.z_parity)
+
+    def __group(self) -> List[Tuple[np.ndarray, np.ndarray, complex]]:
+        """All the elements T^a R^b X^c Z^d of the group as (perm, sign, character)"""
+        n = 2**self.size
+        identity = (np.arange(n, dtype=np.int64), np.ones(n), 1.0 + 0.0j)
+        elements = [identity]
+
+        def compose(second, first):
+            # second * first acting on |b>
+            perm_1, sign_1, chi_1 = first
+            perm_2, sign_2, chi_2 = second
+            return perm_2[perm_1], sign_1 * sign_2[perm_1], chi_1 * chi_2
+
+        for name, value in [
+            ("z_parity", self.z_parity),
+            ("spin_flip", self.spin_flip),
+            ("reflection", self.reflection),
+        ]:
+            if value is not None:
+                perm, sign = symmetry_action(name, self.size)
+                generator = (perm, sign, complex(value))
+                elements = elements + [compose(generator, g) for g in elements]
+
+        if self.momentum is not None:
+            perm, sign = symmetry_action("translation", self.size)
+            generator = (
+                perm,
+                sign,
+                np.exp(2j * np.pi * self.momentum / self.size),
+            )
+            power = identity
+            translated = []
+            for a in range(self.size):
+                translated = translated + [compose(power, g) for g in elements]
+                power = compose(generator, power)
+            elements = translated
+        return elements
+
+    def __get_the_basis(self) -> sparse.csr_matrix:
+        group = self.__group()
+        n = 2**self.size
+
+        # representative of each orbit: the smallest state
+        representative = np.arange(n, dtype=np.int64)
+        for perm, _, _ in group:
+            representative = np.minimum(representative, perm)
+        representatives = np.unique(representative)
+        columns = np.arange(representatives.shape[0])
+
+        rows, cols, values = [], [], []
+        for perm, sign, chi in group:
+            rows.append(perm[representatives])
+            cols.append(columns)
+            values.append(np.conj(chi) * sign[representatives] / len(group))
+        projection = sparse.csc_matrix(
+            (np.concatenate(values), (np.concatenate(rows), np.concatenate(cols))),
+            shape=(n, representatives.shape[0]),
+            dtype=np.complex128,
+        )
+        projection.sum_duplicates()
+
+        # representatives that are annihilated by the projector are not in the sector
+        norms = np.sqrt(
+            np.asarray(abs(projection.multiply(projection.conj())).sum(axis=0))
+        ).reshape(-1)
+        keep = norms > 1e-10
+        projection = projection[:, keep] @ sparse.diags(1 / norms[keep])
+        projection.eliminate_zeros()
+        return sparse.csr_matrix(projection)
+
+    def project_operator(self, operator) -> sparse.csr_matrix:
+        """The block of an operator (that commutes with the symmetries) in the sector"""
+        matrix = to_csr(operator)
+        return sparse.csr_matrix(self.basis.conj().T @ matrix @ self.basis)
+
+    def project_state(self, psi: np.ndarray) -> np.ndarray:
+        """The components of a state (or a batch of states, batch x 2**size) in the sector basis"""
+        return (self.basis.conj().T @ np.asarray(psi).T).T
+
+    def embed_state(self, psi: np.ndarray) -> np.ndarray:
+        """The state (or batch of states) of the sector in the full Hilbert space"""
+        return (self.basis @ np.asarray(psi).T).T
+
+    @classmethod
+    def from_state(
+        cls,
+        psi: np.ndarray,
+        size: int,
+        symmetries: List[str],
+        tolerance: float = 1e-8,
+    ):
+        """The smallest sector that contains psi, among the given symmetries (None if psi is not an eigenstate of any)"""
+        psi = np.asarray(psi).reshape(-1)
+        psi = psi / np.linalg.norm(psi)
+        eigenvalues: Dict[str, Optional[int]] = {}
+        for name in symmetries:
+            perm, sign = symmetry_action(name, size)
+            g_psi = symmetry_matrix(perm, sign) @ psi
+            chi = np.vdot(psi, g_psi)
+            if np.linalg.norm(g_psi - chi * psi) > tolerance:
+                continue
+            if name == "translation":
+                momentum = int(np.round(np.angle(chi) * size / (2 * np.pi))) % size
+                eigenvalues["momentum"] = momentum
+            else:
+                eigenvalues[name] = int(np.round(np.real(chi)))
+
+        if "reflection" in eigenvalues and "momentum" in eigenvalues:
+            momentum = eigenvalues["momentum"]
+            if not (momentum == 0 or 2 * momentum == size):
+                eigenvalues.pop("reflection")
+        if len(eigenvalues) == 0:
+            return None
+        return cls(size=size, **eigenvalues)
@@ -1,4 +1,5 @@
 import numpy as np
+from scipy import sparse
 
 
 def counting_multiplicity(psi: np.ndarray, eng: np.ndarray):
@@ -8,3 +9,15 @@ def counting_multiplicity(psi: np.ndarray, eng: np.ndarray):
         if e == eng0:
             psi0 = psi0 + psi[:, i + 1]
     return psi0 / (np.linalg.norm(psi0))
+
+
+def to_csr(operator) -> sparse.csr_matrix:
+    """CSR matrix of a qutip.Qobj, a ManyBodyQutipOperator (through its qutip_op), a scipy sparse matrix or an array"""
+    if hasattr(operator, "qutip_op"):
+        operator = operator.qutip_op
+    if hasattr(operator, "dims") and hasattr(operator, "data"):
+        # qutip >= 5 wraps the scipy matrix
+        if hasattr(operator, "to"):
+            return sparse.csr_matrix(operator.to("csr").data.as_scipy())
+        return sparse.csr_matrix(operator.data)
+    return sparse.csr_matrix(operator)
@@ -0,0 +1,366 @@
+import torch
+import torch.nn as nn
+import numpy as np
+from typing import Tuple, Dict
+from tqdm import trange
+from src.tddft_methods.kohm_sham_utils import (
+    compute_the_effective_fields,
+    parallelized_build_hamiltonian,
+    parallelized_compute_the_magnetization,
+    su2_exponentiation_algorithm,
+    parallelized_crank_nicolson_algorithm,
+    self_consistent_fields,
+    ZX_COMPONENTS,
+)
+
+
+def interpolate_field(h: torch.Tensor, time: torch.Tensor, t: float) -> torch.Tensor:
+    """Linear interpolation of the external fields h (R x time x channels x size) at time t"""
+    idx = int(torch.searchsorted(time, torch.tensor(t, dtype=time.dtype)))
+    idx = min(max(idx, 1), time.shape[0] - 1)
+    weight = (t - time[idx - 1]) / (time[idx] - time[idx - 1])
+    return (1 - weight) * h[:, idx - 1] + weight * h[:, idx]
+
+
+class KohmShamPropagator:
+    def __init__(
+        self,
+        energy: nn.Module,
+        dt: float,
+        self_consistent_step: int,
+        exponent_algorithm: bool = True,
+        components: Dict = ZX_COMPONENTS,
+        tolerance: float = None,
+        mixing_history: int = 4,
+        compiled: bool = False,
+    ) -> None:
+        """Batched version of nonlinear_schrodinger_step. It evolves R independent trajectories (different drivings, rates or initial states)
+        stacked in a psi of shape R x 2 x size, with a single call of the energy functional per predictor/corrector stage for the whole batch.
+
+        Each trajectory follows nonlinear_schrodinger_step (pure Kohm-Sham states with their own effective fields).
+        The ensamble (ensamble_tddft_run.py), Heisenberg (heisemberg_tddft.py) and master equation (master_equation_tddft.py)
+        drivers evolve different equations and still loop over the rates with their own steps. With adaptive = True the
+        ensamble driver evolves its trajectories with run_adaptive, since its two states start equal and stay so.
+
+        Args:
+            energy (nn.Module): the energy functional E[m,h] in eval mode
+            dt (float): the time step
+            self_consistent_step (int): (maximum) number of corrector iterations
+            exponent_algorithm (bool): if True the exact SU(2) exponentiation, Crank-Nicolson otherwise. Defaults to True.
+            components (Dict): the channel of each magnetization component in the input of the functional. Defaults to ZX_COMPONENTS.
+            tolerance (float): convergence threshold of the effective fields in the corrector, None for a fixed number of iterations. Defaults to None.
+            mixing_history (int): number of iterates of the Anderson mixing of the corrector. Defaults to 4.
+            compiled (bool): if True the effective fields are computed by the compiled EnergyGradient of the functional. Defaults to False.
+        """
+        self.energy = energy
+        self.dt = dt
+        self.self_consistent_step = self_consistent_step
+        self.exponent_algorithm = exponent_algorithm
+        self.components = components
+        self.tolerance = tolerance
+        self.mixing_history = mixing_history
+        self.compiled = compiled
+
+        # number of calls of the energy functional
+        self.n_functional_calls = 0
+
+    def get_the_magnetization(self, psi: torch.Tensor) -> torch.DoubleTensor:
+        """Magnetization in the input format of the functional (R x channels x size)"""
+        x, y, z = parallelized_compute_the_magnetization(psi=psi)
+        values = {"x": x, "y": y, "z": z}
+        m = torch.zeros(
+            (psi.shape[0], len(self.components), psi.shape[-1]), dtype=torch.double
+        )
+        for c, channel in self.components.items():
+            m[:, channel] = values[c]
+        return m
+
+    def get_the_hamiltonian(
+        self, psi: torch.Tensor, h: torch.Tensor
+    ) -> Tuple[torch.Tensor]:
+        m = self.get_the_magnetization(psi=psi)
+        self.n_functional_calls += 1
+        (omega_eff, h_eff), eng = compute_the_effective_fields(
+            m=m,
+            h=h,
+            energy=self.energy,
+            respect_to=("x", "z"),
+            components=self.components,
+            compiled=self.compiled,
+        )
+        hamiltonian = parallelized_build_hamiltonian(
+            field_x=-1 * omega_eff, field_z=-1 * h_eff
+        )
+        return hamiltonian, omega_eff, h_eff, eng
+
+    def unitary_step(
+        self, hamiltonian: torch.Tensor, psi: torch.Tensor, dt: float = None
+    ):
+        if dt is None:
+            dt = self.dt
+        if self.exponent_algorithm:
+            return su2_exponentiation_algorithm(hamiltonian=hamiltonian, psi=psi, dt=dt)
+        else:
+            return parallelized_crank_nicolson_algorithm(
+                hamiltonian=hamiltonian, psi=psi, dt=dt
+            )
+
+    def self_consistent_loop(
+        self,
+        psi: torch.Tensor,
+        hamiltonian_minus: torch.Tensor,
+        fields: torch.Tensor,
+        h_plus: torch.Tensor,
+        dt: float,
+        max_iterations: int,
+        tolerance: float,
+    ) -> Tuple:
+        """Corrector loop for the effective fields (R x 2 x size, omega and h) at t+dt.
+
+        Returns:
+            hamiltonian_plus (torch.Tensor): the hamiltonian of the converged fields
+            fields (torch.Tensor): the converged effective fields
+            eng (torch.Tensor): the energies of the last functional call (None if max_iterations=0)
+            info (Dict): number of iterations and residuals (see self_consistent_fields)
+        """
+
+        def fixed_point_map(fields: torch.Tensor):
+            hamiltonian_plus = parallelized_build_hamiltonian(
+                field_x=-1 * fields[:, 0], field_z=-1 * fields[:, 1]
+            )
+            psi_plus = self.unitary_step(
+                hamiltonian=0.5 * (hamiltonian_minus + hamiltonian_plus),
+                psi=psi,
+                dt=dt,
+            )
+            _, omega_eff, h_eff, eng = self.get_the_hamiltonian(psi=psi_plus, h=h_plus)
+            return torch.stack((omega_eff, h_eff), dim=1), eng
+
+        fields, eng, info = self_consistent_fields(
+            fixed_point_map=fixed_point_map,
+            fields=fields,
+            max_iterations=max_iterations,
+            tolerance=tolerance,
+            history=self.mixing_history,
+        )
+        hamiltonian_plus = parallelized_build_hamiltonian(
+            field_x=-1 * fields[:, 0], field_z=-1 * fields[:, 1]
+        )
+        return hamiltonian_plus, fields, eng, info
+
+    def step(
+        self, psi: torch.Tensor, h_minus: torch.Tensor, h_plus: torch.Tensor
+    ) -> Tuple[torch.Tensor]:
+        """Single predictor-corrector step from t to t+dt for the whole batch.
+
+        Args:
+            psi (torch.Tensor): the Kohm-Sham states (R x 2 x size)
+            h_minus (torch.Tensor): the external fields at time t (R x channels x size)
+            h_plus (torch.Tensor): the external fields at time t+dt (R x channels x size)
+
+        Returns:
+            psi (torch.Tensor): the states at time t+dt
+            omega_eff, h_eff (torch.Tensor): the last effective fields (R x size)
+            eng (torch.Tensor): the energies of the last functional call (R)
+            info (Dict): iterations and residuals of the self consistent loop
+        """
+        hamiltonian_minus, omega_eff, h_eff, eng = self.get_the_hamiltonian(
+            psi=psi, h=h_minus
+        )
+
+        hamiltonian_plus, fields, eng_plus, info = self.self_consistent_loop(
+            psi=psi,
+            hamiltonian_minus=hamiltonian_minus,
+            fields=torch.stack((omega_eff, h_eff), dim=1),
+            h_plus=h_plus,
+            dt=self.dt,
+            max_iterations=self.self_consistent_step,
+            tolerance=self.tolerance,
+        )
+        if eng_plus is not None:
+            eng = eng_plus
+
+        psi = self.unitary_step(
+            hamiltonian=0.5 * (hamiltonian_minus + hamiltonian_plus), psi=psi
+        )
+        return psi, fields[:, 0], fields[:, 1], eng, info
+
+    def run(self, psi: torch.Tensor, h: torch.Tensor) -> Dict:
+        """Evolve the batch over the time grid of h.
+
+        Args:
+            psi (torch.Tensor): the initial Kohm-Sham states (R x 2 x size)
+            h (torch.Tensor): the external fields (R x time x channels x size)
+
+        Returns:
+            Dict: x, y, z, omega_eff, h_eff (R x time x size), energy (R x time),
+            the number of corrector iterations and the last field residual of each step (time)
+        """
+        r, steps, l = psi.shape[0], h.shape[1], psi.shape[-1]
+        results = {
+            key: torch.zeros((r, steps, l), dtype=torch.double)
+            for key in ["x", "y", "z", "omega_eff", "h_eff"]
+        }
+        results["energy"] = torch.zeros((r, steps), dtype=torch.double)
+        results["sc_iterations"] = torch.zeros(steps, dtype=torch.long)
+        results["sc_residual"] = torch.zeros(steps, dtype=torch.double)
+
+        for i in trange(steps - 1):
+            x, y, z = parallelized_compute_the_magnetization(psi=psi)
+            results["x"][:, i], results["y"][:, i], results["z"][:, i] = x, y, z
+
+            psi, omega_eff, h_eff, eng, info = self.step(
+                psi=psi, h_minus=h[:, i], h_plus=h[:, i + 1]
+            )
+            results["sc_iterations"][i] = info["iterations"]
+            if len(info["residuals"]) > 0:
+                results["sc_residual"][i] = info["residuals"][-1]
+            results["omega_eff"][:, i] = omega_eff
+            results["h_eff"][:, i] = h_eff
+            results["energy"][:, i] = eng
+
+        x, y, z = parallelized_compute_the_magnetization(psi=psi)
+        results["x"][:, -1], results["y"][:, -1], results["z"][:, -1] = x, y, z
+        self.psi = psi
+        return results
+
+    def run_adaptive(
+        self,
+        psi: torch.Tensor,
+        h: torch.Tensor,
+        time: torch.Tensor,
+        tolerance: float,
+        field_tolerance: float,
+        max_self_consistent_step: int = 10,
+        dt_min: float = 10**-5,
+        dt_max: float = 1.0,
+        safety: float = 0.9,
+    ) -> Dict:
+        """Evolve the batch with an adaptive time step and report the results on the time grid of h.
+
+        The local error is estimated from the discrepancy between the magnetizations of the predictor
+        (exponential Euler with the fields at t, error O(dt^2)) and of the corrector. The step is rejected
+        and shrunk if the error is larger than tolerance, otherwise it is accepted and dt is grown. The steps
+        never jump over an output time, so the results are exact on the output grid (no interpolation of psi).
+        The corrector iterations (self_consistent_loop) stop as soon as the effective fields change less than field_tolerance.
+        The batch shares the same dt (the error is the maximum over the batch).
+
+        Each accepted step costs a predictor call plus the corrector iterations, so the adaptive run pays off only
+        for loose tolerances. In test_adaptive_propagator.py (l=8 quench to tf=4) it needs 779 and 1693 functional
+        calls at tolerance 1e-3 and 1e-4 against 4684 for a fixed step reference of comparable accuracy, but 5092 at
+        1e-5: use it for tolerance >= 1e-4 and the fixed step (run) below.
+
+        Args:
+            psi (torch.Tensor): the initial Kohm-Sham states (R x 2 x size)
+            h (torch.Tensor): the external fields on the output grid (R x time x channels x size), linearly interpolated in between
+            time (torch.Tensor): the output time grid
+            tolerance (float): the maximum local error on the magnetization
+            field_tolerance (float): the convergence threshold of the self consistent effective fields
+            max_self_consistent_step (int): maximum number of corrector iterations. Defaults to 10.
+            dt_min (float): minimum time step (always accepted). Defaults to 10**-5.
+            dt_max (float): maximum time step. Defaults to 1.0.
+            safety (float): safety factor of the step size controller. Defaults to 0.9.
+
+        Returns:
+            Dict: x, y, z, omega_eff, h_eff (R x time x size) and energy (R x time) on the output grid.
+            The statistics of the run (accepted/rejected steps and functional calls) are stored in self.stats
+        """
+        time = torch.as_tensor(time, dtype=torch.double)
+        r, steps, l = psi.shape[0], time.shape[0], psi.shape[-1]
+        results = {
+            key: torch.zeros((r, steps, l), dtype=torch.double)
+            for key in ["x", "y", "z", "omega_eff", "h_eff"]
+        }
+        results["energy"] = torch.zeros((r, steps), dtype=torch.double)
+
+        def record(k: int, psi, omega_eff, h_eff, eng):
+            x, y, z = parallelized_compute_the_magnetization(psi=psi)
+            results["x"][:, k], results["y"][:, k], results["z"][:, k] = x, y, z
+            results["omega_eff"][:, k] = omega_eff
+            results["h_eff"][:, k] = h_eff
+            results["energy"][:, k] = eng
+
+        self.n_functional_calls = 0
+        n_accepted = 0
+        n_rejected = 0
+        n_iterations = 0
+
+        t = time[0].item()
+        dt = min(self.dt, dt_max)
+        hamiltonian_minus, omega_eff, h_eff, eng = self.get_the_hamiltonian(
+            psi=psi, h=h[:, 0]
+        )
+        record(0, psi, omega_eff, h_eff, eng)
+
+        k = 1
+        while k < steps:
+            # never step over the next output time
+            dt_step = min(dt, time[k].item() - t)
+            h_plus = interpolate_field(h=h, time=time, t=t + dt_step)
+
+            # predictor
+            psi_predictor = self.unitary_step(
+                hamiltonian=hamiltonian_minus, psi=psi, dt=dt_step
+            )
+            _, omega_plus, h_plus_eff, eng_plus = self.get_the_hamiltonian(
+                psi=psi_predictor, h=h_plus
+            )
+
+            # corrector
+            hamiltonian_plus, fields, eng_corrector, info = self.self_consistent_loop(
+                psi=psi,
+                hamiltonian_minus=hamiltonian_minus,
+                fields=torch.stack((omega_plus, h_plus_eff), dim=1),
+                h_plus=h_plus,
+                dt=dt_step,
+                max_iterations=max_self_consistent_step,
+                tolerance=field_tolerance,
+            )
+            n_iterations += info["iterations"]
+            if eng_corrector is not None:
+                eng_plus = eng_corrector
+            omega_plus, h_plus_eff = fields[:, 0], fields[:, 1]
+            psi_corrector = self.unitary_step(
+                hamiltonian=0.5 * (hamiltonian_minus + hamiltonian_plus),
+                psi=psi,
+                dt=dt_step,
+            )
+
+            error = torch.max(
+                torch.abs(
+                    self.get_the_magnetization(psi_corrector)
+                    - self.get_the_magnetization(psi_predictor)
+                )
+            ).item()
+            factor = safety * np.sqrt(tolerance / max(error, 10**-14))
+
+            if error <= tolerance or dt_step <= dt_min:
+                n_accepted += 1
+                psi = psi_corrector
+                t = t + dt_step
+                # the converged fields at t+dt are the starting point of the next step
+                hamiltonian_minus, omega_eff, h_eff, eng = (
+                    hamiltonian_plus,
+                    omega_plus,
+                    h_plus_eff,
+                    eng_plus,
+                )
+                if np.isclose(t, time[k].item(), rtol=0, atol=10**-12):
+                    t = time[k].item()
+                    record(k, psi, omega_eff, h_eff, eng)
+                    k += 1
+                dt_new = min(max(dt_step * min(factor, 5.0), dt_min), dt_max)
+                # a step truncated to hit the output grid does not limit the next one
+                dt = max(dt, dt_new) if dt_step < dt else dt_new
+            else:
+                n_rejected += 1
+                dt = max(dt_step * max(factor, 0.2), dt_min)
+
+        self.stats = {
+            "accepted_steps": n_accepted,
+            "rejected_steps": n_rejected,
+            "functional_calls": self.n_functional_calls,
+            "self_consistent_iterations": n_iterations,
+        }
+        self.psi = psi
+        return results
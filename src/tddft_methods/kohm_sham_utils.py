@@ -1,9 +1,13 @@
+import copy
+import time
+import weakref
 import torch
 import numpy as np
 import matplotlib.pyplot as plt
 import torch.nn as nn
-from typing import Tuple, List
+from typing import Tuple, List, Dict, Callable
 from tqdm import trange
+from src.training.dtype_policy import DTypePolicy
 
 
 def quench_field(
@@ -17,9 +21,17 @@ def quench_field(
 
 
 def compute_the_gradient(
-    m: torch.DoubleTensor, h: torch.DoubleTensor, energy: nn.Module, respect_to: str
+    m: torch.DoubleTensor,
+    h: torch.DoubleTensor,
+    energy: nn.Module,
+    respect_to: str,
+    compiled: bool = False,
 ) -> torch.DoubleTensor:
     m = m.detach().double()
+    if compiled:
+        # energy and gradient of the first sample from the EnergyGradient of the functional
+        grad, eng = get_energy_gradient(energy)(m=m[:1], h=h)
+        return grad[:, XYZ_COMPONENTS[respect_to]], eng[0].item()
     if respect_to == "z":
         z = m[:, 2, :]
         z.requires_grad_(True)
@@ -53,6 +65,251 @@ def compute_the_gradient(
     return grad.detach(), eng.squeeze().item()
 
 
+# channel of each magnetization component in the input of the energy functional
+# (same convention of compute_the_gradient)
+XYZ_COMPONENTS = {"x": 0, "y": 1, "z": 2}
+# channels of the 2 input channel (z,x) energy functionals
+ZX_COMPONENTS = {"z": 0, "x": 1}
+
+
+def compute_the_effective_fields(
+    m: torch.DoubleTensor,
+    h: torch.DoubleTensor,
+    energy: nn.Module,
+    respect_to: Tuple[str] = ("x", "z"),
+    components: dict = XYZ_COMPONENTS,
+    compiled: bool = False,
+) -> Tuple[Tuple[torch.DoubleTensor], torch.DoubleTensor]:
+    """Compute the effective fields dE/dm of the energy functional for all the requested components
+    with a single forward and a single backward pass.
+
+    The energies of the batch are summed before the backward, so the gradient of each sample only depends
+    on its own energy as long as the functional does not mix the batch (energy.eval() mode).
+
+    Args:
+        m (torch.DoubleTensor): the magnetization in batch x channels x size
+        h (torch.DoubleTensor): the external field (in the format of the energy functional)
+        energy (nn.Module): the energy functional E[m,h]
+        respect_to (Tuple[str]): the components of the gradient, e.g. ("x","z"). Defaults to ("x","z").
+        components (dict): the channel of each component in m. Defaults to XYZ_COMPONENTS.
+        compiled (bool): if True the energy and the gradient are computed by the EnergyGradient of the functional
+        (compiled once per input shape). Defaults to False.
+
+    Returns:
+        fields (Tuple[torch.DoubleTensor]): the gradient (batch x size) for each component in respect_to
+        eng (torch.DoubleTensor): the energy of each sample of the batch
+    """
+    if compiled:
+        grad, eng = get_energy_gradient(energy)(m=m.detach().double(), h=h)
+        fields = tuple(grad[:, components[c]] for c in respect_to)
+        return fields, eng.reshape(m.shape[0])
+
+    m = m.detach().double().clone()
+    m.requires_grad_(True)
+    eng = energy(z=m, h=h)
+    (grad,) = torch.autograd.grad(eng.sum(), m)
+    fields = tuple(grad[:, components[c]].detach() for c in respect_to)
+    return fields, eng.detach().reshape(m.shape[0])
+
+
+class EnergyGradient:
+    def __init__(self, energy: nn.Module, backend: str = "compile") -> None:
+        """Energy and gradient dE/dm of an energy functional for the inference in the time loops.
+
+        The gradient is a functional transform (torch.func.grad_and_value) of the energy instead of
+        requires_grad_/backward/grad.zero_, so no autograd graph is kept between the calls. With the "compile"
+        backend the transform is compiled (torch.compile) once for each shape, dtype and device of the inputs:
+        the small inputs of the time loop (e.g. 1 x 2 x 8) are dominated by the python dispatch of the
+        modules and of the autograd, which the compiled graph removes. The parameters are inputs of the
+        compiled graph, hence a change of the weights does not need a recompilation.
+
+        Args:
+            energy (nn.Module): the energy functional E[m,h] in eval mode (called as energy(z=m, h=h))
+            backend (str): "compile" (torch.compile of the functional gradient), "func" (functional gradient only)
+            or "autograd" (the backward of compute_the_effective_fields). Defaults to "compile".
+        """
+        if backend not in ("compile", "func", "autograd"):
+            raise ValueError(
+                f"backend {backend} not defined, choose one of compile, func, autograd"
+            )
+        self.energy = energy
+        self.backend = backend
+        # (shapes, dtypes, device) of the inputs -> energy and gradient function
+        self.functions: Dict[Tuple, Callable] = {}
+
+    def key(self, m: torch.Tensor, h: torch.Tensor) -> Tuple:
+        return (tuple(m.shape), tuple(h.shape), m.dtype, h.dtype, m.device)
+
+    def energy_and_gradient(
+        self, m: torch.Tensor, h: torch.Tensor
+    ) -> Tuple[torch.Tensor, torch.Tensor]:
+        def energy_sum(m: torch.Tensor, h: torch.Tensor):
+            eng = self.energy(z=m, h=h)
+            return eng.sum(), eng
+
+        grad, (_, eng) = torch.func.grad_and_value(energy_sum, has_aux=True)(m, h)
+        return grad, eng
+
+    def autograd_energy_and_gradient(
+        self, m: torch.Tensor, h: torch.Tensor
+    ) -> Tuple[torch.Tensor, torch.Tensor]:
+        m = m.clone()
+        m.requires_grad_(True)
+        with torch.enable_grad():
+            eng = self.energy(z=m, h=h)
+            (grad,) = torch.autograd.grad(eng.sum(), m)
+        return grad, eng
+
+    def get_function(self, m: torch.Tensor, h: torch.Tensor) -> Callable:
+        key = self.key(m, h)
+        if key not in self.functions:
+            if self.backend == "compile":
+                # a new compiled function for each shape (no recompilations of a shared one)
+                self.functions[key] = torch.compile(
+                    lambda m, h: self.energy_and_gradient(m, h), dynamic=False
+                )
+            elif self.backend == "func":
+                self.functions[key] = self.energy_and_gradient
+            else:
+                self.functions[key] = self.autograd_energy_and_gradient
+        return self.functions[key]
+
+    def clear(self):
+        self.functions = {}
+
+    def __call__(
+        self, m: torch.Tensor, h: torch.Tensor
+    ) -> Tuple[torch.Tensor, torch.Tensor]:
+        """The gradient (same shape of m) and the energies (batch) of the magnetization m in the field h"""
+        m = m.detach()
+        with torch.no_grad():
+            grad, eng = self.get_function(m, h)(m, h)
+        return grad.detach(), eng.detach().reshape(m.shape[0])
+
+
+# energy and gradient functions of the functionals used with compiled=True
+_ENERGY_GRADIENTS: "weakref.WeakKeyDictionary[nn.Module, EnergyGradient]" = (
+    weakref.WeakKeyDictionary()
+)
+
+
+def get_energy_gradient(energy: nn.Module, backend: str = "compile") -> EnergyGradient:
+    """The (cached) EnergyGradient of the energy functional"""
+    if energy not in _ENERGY_GRADIENTS or _ENERGY_GRADIENTS[energy].backend != backend:
+        _ENERGY_GRADIENTS[energy] = EnergyGradient(energy=energy, backend=backend)
+    return _ENERGY_GRADIENTS[energy]
+
+
+def benchmark_effective_fields(
+    m: torch.DoubleTensor,
+    h: torch.DoubleTensor,
+    energy: nn.Module,
+    n_steps: int = 1000,
+    backends: Tuple[str] = ("func", "compile"),
+) -> Dict[str, Dict[str, float]]:
+    """Latency of one evaluation of the effective fields (a step of the time loop) for each backend of
+    EnergyGradient against compute_the_effective_fields, on the inputs m and h.
+
+    Args:
+        m (torch.DoubleTensor): the magnetization in batch x channels x size
+        h (torch.DoubleTensor): the external field (in the format of the energy functional)
+        energy (nn.Module): the energy functional E[m,h]
+        n_steps (int): number of timed evaluations. Defaults to 1000.
+        backends (Tuple[str]): the backends of EnergyGradient. Defaults to ("func", "compile").
+
+    Returns:
+        Dict[str, Dict[str, float]]: for the current path and for each backend, the time of the first call
+        (compilation included) in s, the mean and the median time of a call in us and the maximum absolute
+        difference of the gradient from the current path
+    """
+    m = m.detach().double()
+    # all the channels of m, the gradient of the current path is stacked back in batch x channels x size
+    components = {c: i for i, c in enumerate(tuple(XYZ_COMPONENTS)[: m.shape[1]])}
+
+    def current(m: torch.Tensor, h: torch.Tensor):
+        fields, eng = compute_the_effective_fields(
+            m, h, energy, respect_to=tuple(components), components=components
+        )
+        return torch.stack(fields, dim=1), eng
+
+    functions = {"current": current}
+    for backend in backends:
+        functions[backend] = EnergyGradient(energy=energy, backend=backend)
+    grad_reference, _ = current(m, h)
+
+    results = {}
+    for name, function in functions.items():
+        start = time.perf_counter()
+        grad, _ = function(m, h)
+        first_call = time.perf_counter() - start
+
+        times = np.zeros(n_steps)
+        for k in range(n_steps):
+            start = time.perf_counter()
+            function(m, h)
+            times[k] = time.perf_counter() - start
+        results[name] = {
+            "first_call_s": first_call,
+            "mean_us": 1e6 * float(times.mean()),
+            "median_us": 1e6 * float(np.median(times)),
+            "max_grad_error": (grad - grad_reference).abs().max().item(),
+        }
+    return results
+
+
+def effective_fields_precision_error(
+    m: torch.DoubleTensor,
+    h: torch.DoubleTensor,
+    energy: nn.Module,
+    policy: str = "float32",
+    respect_to: Tuple[str] = ("x", "z"),
+    components: dict = None,
+    device: str = "cpu",
+) -> Dict[str, float]:
+    """Accuracy of the effective fields of an energy functional evaluated as in a dtype policy (see DTypePolicy:
+    parameters in param_dtype and forward under the autocast of the policy) against the float64 ones of
+    compute_the_effective_fields.
+
+    Args:
+        m (torch.DoubleTensor): the magnetization in batch x channels x size
+        h (torch.DoubleTensor): the external field (in the format of the energy functional)
+        energy (nn.Module): the energy functional E[m,h]
+        policy (str): the dtype policy, e.g. "float32" or "bfloat16". Defaults to "float32".
+        respect_to (Tuple[str]): the components of the gradient. Defaults to ("x","z").
+        components (dict): the channel of each component in m. Defaults to ZX_COMPONENTS for the (z,x)
+        functionals of the time loop (2 channels) and to XYZ_COMPONENTS otherwise.
+        device (str): the device of the autocast. Defaults to "cpu".
+
+    Returns:
+        Dict[str, float]: the maximum absolute and relative error of each field and of the energy
+    """
+    if components is None:
+        components = ZX_COMPONENTS if m.shape[1] == 2 else XYZ_COMPONENTS
+    policy = DTypePolicy(policy)
+
+    energy_64 = copy.deepcopy(energy).to(dtype=torch.double)
+    fields_64, eng_64 = compute_the_effective_fields(
+        m, h, energy_64, respect_to=respect_to, components=components
+    )
+
+    energy_low = copy.deepcopy(energy).to(dtype=policy.param_dtype)
+    m_low = m.detach().to(dtype=policy.param_dtype).clone()
+    m_low.requires_grad_(True)
+    with policy.autocast(device):
+        eng_low = energy_low(z=m_low, h=h.to(dtype=policy.param_dtype))
+    (grad,) = torch.autograd.grad(eng_low.sum(), m_low)
+
+    errors = {}
+    for c, field_64 in zip(respect_to, fields_64):
+        delta = (grad[:, components[c]].double() - field_64).abs().max().item()
+        errors[f"field_{c}_abs"] = delta
+        errors[f"field_{c}_rel"] = delta / max(field_64.abs().max().item(), 1e-30)
+    delta = (eng_low.detach().double().reshape(-1) - eng_64).abs().max().item()
+    errors["energy_abs"] = delta
+    errors["energy_rel"] = delta / max(eng_64.abs().max().item(), 1e-30)
+    return errors
+
+
 def compute_the_gradient_of_the_functional_ux_model(
     z: torch.DoubleTensor, model: nn.Module
 ) -> torch.DoubleTensor:
@@ -185,7 +442,20 @@ def parallelized_exponentiation_algorithm(
     )  # torch.matrix_exp(-1j * dt * hamiltonian)
 
     psi = torch.einsum("rlab,rbl->ral", unitary, psi)
-    psi = psi / torch.linalg.norm(psi, dim=0)[None, :]
+    psi = psi / torch.linalg.norm(psi, dim=1)[:, None, :]
+    return psi
+
+
+def parallelized_crank_nicolson_algorithm(
+    hamiltonian: torch.ComplexType, psi: torch.ComplexType, dt: float
+):
+    identity = torch.eye(psi.shape[1], dtype=torch.complex128)
+    unitary_op = identity[None, None, :, :] + 0.5j * dt * hamiltonian
+    unitary_op_star = identity[None, None, :, :] - 0.5j * dt * hamiltonian
+    unitary = torch.einsum(
+        "rlab,rlbc->rlac", torch.linalg.inv(unitary_op), unitary_op_star
+    )
+    psi = torch.einsum("rlab,rbl->ral", unitary, psi)
     return psi
 
 
@@ -210,6 +480,87 @@ def me_exponentiation_algorithm(
     return psi
 
 
+def su2_rotation(
+    field_x: torch.DoubleTensor,
+    field_y: torch.DoubleTensor,
+    field_z: torch.DoubleTensor,
+    psi: torch.ComplexType,
+    dt: float,
+):
+    """Exact exp(-i dt (h_x sx + h_y sy + h_z sz)) psi without building any matrix,
+    using exp(-i dt H) = cos(|h|dt) I - i sin(|h|dt)/|h| H.
+
+    Args:
+        field_x, field_y, field_z (torch.DoubleTensor): the fields (size or batch x size)
+        psi (torch.ComplexType): the single site states (2 x size or batch x 2 x size)
+        dt (float): the time step
+    """
+    norm = torch.sqrt(field_x**2 + field_y**2 + field_z**2)
+    cos = torch.cos(norm * dt)
+    # sin(|h|dt)/|h| stable for |h|->0
+    sin = dt * torch.sinc(norm * dt / np.pi)
+
+    a = psi[..., 0, :]
+    b = psi[..., 1, :]
+    h_a = field_z * a + (field_x - 1j * field_y) * b
+    h_b = (field_x + 1j * field_y) * a - field_z * b
+
+    return torch.stack((cos * a - 1j * sin * h_a, cos * b - 1j * sin * h_b), dim=-2)
+
+
+def su2_exponentiation_algorithm(
+    hamiltonian: torch.ComplexType, psi: torch.ComplexType, dt: float
+):
+    """Exact replacement of exponentiation_algorithm (size x 2 x 2 hamiltonian, 2 x size psi)
+    and parallelized_exponentiation_algorithm (batch x size x 2 x 2, batch x 2 x size)"""
+    field_x = torch.real(hamiltonian[..., 0, 1])
+    field_y = -1 * torch.imag(hamiltonian[..., 0, 1])
+    field_z = 0.5 * torch.real(hamiltonian[..., 0, 0] - hamiltonian[..., 1, 1])
+    # the identity part is just a phase
+    phase = torch.exp(
+        -0.5j * dt * torch.real(hamiltonian[..., 0, 0] + hamiltonian[..., 1, 1])
+    )
+    psi = su2_rotation(
+        field_x=field_x, field_y=field_y, field_z=field_z, psi=psi, dt=dt
+    )
+    return phase.unsqueeze(-2) * psi
+
+
+def so3_rotation(w: torch.DoubleTensor, m: torch.DoubleTensor, dt: float):
+    """Exact exp(-dt W) m for the rotation generator W m = w x m (Rodrigues formula).
+
+    Args:
+        w (torch.DoubleTensor): the rotation vector (3 x size or batch x 3 x size)
+        m (torch.DoubleTensor): the magnetization (3 x size or batch x 3 x size)
+        dt (float): the time step
+    """
+    norm = torch.linalg.norm(w, dim=-2, keepdim=True)
+    theta = norm * dt
+    # sin(theta)/|w| and (1-cos(theta))/|w|^2 stable for |w|->0
+    sin = dt * torch.sinc(theta / np.pi)
+    one_minus_cos = 0.5 * dt**2 * torch.sinc(theta / (2 * np.pi)) ** 2
+
+    w_cross_m = torch.cross(w, m, dim=-2)
+    w_dot_m = torch.sum(w * m, dim=-2, keepdim=True)
+    return torch.cos(theta) * m - sin * w_cross_m + one_minus_cos * w_dot_m * w
+
+
+def so3_exponentiation_algorithm(
+    hamiltonian: torch.Tensor, psi: torch.Tensor, dt: float
+):
+    """Exact replacement of me_exponentiation_algorithm for the antisymmetric size x 3 x 3
+    generators of heisemberg_matrix and nonlinear_master_equation_step"""
+    w = torch.stack(
+        (
+            -1 * hamiltonian[..., 1, 2],
+            hamiltonian[..., 0, 2],
+            -1 * hamiltonian[..., 0, 1],
+        ),
+        dim=-2,
+    )
+    return so3_rotation(w=w.to(dtype=psi.dtype), m=psi, dt=dt)
+
+
 # def time_step_backward_algorithm(
 #     psi: torch.ComplexType,
 #     h: torch.Tensor,
@@ -236,8 +587,10 @@ def get_the_hamiltonian(psi: torch.ComplexType, h: torch.Tensor, energy: nn.Modu
     x, z = compute_the_magnetization(psi=psi.clone())
     z = torch.cat((z.view(1, -1), x.view(1, -1)), dim=0)
     z = z.unsqueeze(0)  # the batch dimension
-    h_eff, eng0 = compute_the_gradient(m=z, h=h, energy=energy, respect_to="z")
-    omega_eff, _ = compute_the_gradient(m=z, h=h, energy=energy, respect_to="x")
+    (omega_eff, h_eff), eng = compute_the_effective_fields(
+        m=z, h=h, energy=energy, respect_to=("x", "z")
+    )
+    eng0 = eng[0].item()
     hamiltonian = build_hamiltonian(field_x=omega_eff[0], field_z=h_eff[0])
     return hamiltonian, eng0
 
@@ -265,6 +618,76 @@ def time_step_crank_nicolson_algorithm(
     return psi, eng
 
 
+def self_consistent_fields(
+    fixed_point_map: Callable,
+    fields: torch.DoubleTensor,
+    max_iterations: int,
+    tolerance: float = None,
+    history: int = 4,
+    mixing: float = 1.0,
+    stall_ratio: float = 0.5,
+) -> Tuple:
+    """Self consistent loop of the corrector for the effective fields at t+dt, solving fields = g(fields).
+
+    It starts as the plain iteration of the predictor-corrector (fields <- g(fields)) and switches to
+    Anderson (DIIS) mixing on the last history iterates as soon as the residual decreases by less than
+    stall_ratio in one iteration. The mixing coefficients are computed for each trajectory of the batch.
+    Without a tolerance it reduces to the fixed number of plain iterations of the original corrector.
+
+    Args:
+        fixed_point_map (Callable): fields (R x ...) -> (g(fields), aux), aux being any output of the last functional call
+        fields (torch.DoubleTensor): the initial guess of the fields (R x ...)
+        max_iterations (int): maximum number of calls of the fixed point map
+        tolerance (float): the loop stops when max|g(fields)-fields| < tolerance. If None, it runs max_iterations. Defaults to None.
+        history (int): number of previous iterates in the Anderson mixing, 0 for plain iteration. Defaults to 4.
+        mixing (float): the linear mixing parameter. Defaults to 1.0.
+        stall_ratio (float): the convergence rate below which the iteration is considered stalled. Defaults to 0.5.
+
+    Returns:
+        fields (torch.DoubleTensor): the last output of the fixed point map (it is equal to the input of the map if max_iterations=0)
+        aux: the aux output of the last call of the map (None if max_iterations=0)
+        info (Dict): number of iterations, residual at each iteration and whether the Anderson mixing was used
+    """
+    r = fields.shape[0]
+    g, aux = fields, None
+    xs, gs = [], []
+    residuals = []
+    anderson = False
+    iteration = 0
+    for iteration in range(1, max_iterations + 1):
+        g, aux = fixed_point_map(fields)
+        residual = g - fields
+        residuals.append(torch.max(torch.abs(residual)).item())
+        if tolerance is not None and residuals[-1] < tolerance:
+            break
+        if (
+            tolerance is not None
+            and history > 0
+            and len(residuals) > 1
+            and residuals[-1] > stall_ratio * residuals[-2]
+        ):
+            anderson = True
+
+        xs = (xs + [fields.reshape(r, -1)])[-(history + 1) :]
+        gs = (gs + [g.reshape(r, -1)])[-(history + 1) :]
+        if anderson and len(xs) > 1:
+            x_history = torch.stack(xs, dim=-1)
+            f_history = torch.stack(gs, dim=-1) - x_history
+            delta_x = x_history[..., 1:] - x_history[..., :-1]
+            delta_f = f_history[..., 1:] - f_history[..., :-1]
+            gamma = torch.linalg.lstsq(
+                delta_f, residual.reshape(r, -1, 1)
+            ).solution
+            fields = fields + mixing * residual - torch.bmm(
+                delta_x + mixing * delta_f, gamma
+            ).reshape(fields.shape)
+        else:
+            fields = fields + mixing * residual
+
+    info = {"iterations": iteration, "residuals": residuals, "anderson": anderson}
+    return g, aux, info
+
+
 def heisemberg_matrix(omega_eff: torch.Tensor, h_eff: torch.Tensor):
     hm = torch.zeros(omega_eff.shape[-1], 3, 3, dtype=torch.double)
     hm[:, 0, 1] = h_eff
@@ -286,15 +709,13 @@ def nonlinear_master_equation_step(
 ):
     # m0 = torch.from_numpy(m_qutip_tot[q, i]).unsqueeze(0)
 
-    omega_eff, engx = compute_the_gradient(
-        m=psi.unsqueeze(0), h=h[i].unsqueeze(0), energy=energy, respect_to="x"
-    )
-    delta_eff, engy = compute_the_gradient(
-        m=psi.unsqueeze(0), h=h[i].unsqueeze(0), energy=energy, respect_to="y"
-    )
-    h_eff, engz = compute_the_gradient(
-        m=psi.unsqueeze(0), h=h[i].unsqueeze(0), energy=energy, respect_to="z"
+    (omega_eff, delta_eff, h_eff), eng = compute_the_effective_fields(
+        m=psi.unsqueeze(0),
+        h=h[i].unsqueeze(0),
+        energy=energy,
+        respect_to=("x", "y", "z"),
     )
+    engx = engz = eng[0].item()
 
     hamiltonian0 = torch.zeros((psi.shape[-1], 3, 3))
     hamiltonian0[:, 0, 1] = 1 * h_eff[0]
@@ -307,7 +728,7 @@ def nonlinear_master_equation_step(
     # hamiltonian0 = build_hamiltonian(
     #     field_x=-1 * omega_eff[0], field_z=-1 * h_eff[0]
     # )
-    psi1 = me_exponentiation_algorithm(
+    psi1 = so3_exponentiation_algorithm(
         hamiltonian=hamiltonian0,
         psi=psi,
         dt=dt,
@@ -318,14 +739,11 @@ def nonlinear_master_equation_step(
 
         # get the magnetization
 
-        omega_eff1, eng = compute_the_gradient(
-            m=psi1.unsqueeze(0), h=h[i + 1], energy=energy, respect_to="x"
-        )
-        h_eff1, _ = compute_the_gradient(
-            m=psi1.unsqueeze(0), h=h[i + 1], energy=energy, respect_to="z"
-        )
-        delta_eff1, _ = compute_the_gradient(
-            m=psi1.unsqueeze(0), h=h[i + 1], energy=energy, respect_to="y"
+        (omega_eff1, delta_eff1, h_eff1), _ = compute_the_effective_fields(
+            m=psi1.unsqueeze(0),
+            h=h[i + 1],
+            energy=energy,
+            respect_to=("x", "y", "z"),
         )
 
         hamiltonian1 = torch.zeros((psi.shape[-1], 3, 3))
@@ -337,13 +755,13 @@ def nonlinear_master_equation_step(
         hamiltonian1[:, 2, 1] = -1 * omega_eff1[0]
         hamiltonian1 = 2 * hamiltonian1
 
-        psi1 = me_exponentiation_algorithm(
+        psi1 = so3_exponentiation_algorithm(
             hamiltonian=0.5 * (hamiltonian0 + hamiltonian1),
             psi=psi,
             dt=dt,
         )
 
-    psi = me_exponentiation_algorithm(
+    psi = so3_exponentiation_algorithm(
         hamiltonian=0.5 * (hamiltonian0 + hamiltonian1),
         psi=psi,
         dt=dt,
@@ -368,31 +786,34 @@ def nonlinear_schrodinger_step(
     dt: float,
     eta: float,
     exponent_algorithm: bool,
+    tolerance: float = None,
+    report: List = None,
 ):
-    z, x, y = compute_the_magnetization(psi=psi)
+    x, y, z = compute_the_magnetization(psi=psi)
     m = torch.cat((z.view(1, -1), x.view(1, -1)), dim=0)
     m = m.unsqueeze(0)  # the batch dimension
 
     eng = energy(m, h[i].unsqueeze(0))[0].item()
 
-    z_minus, x_minus, _ = compute_the_magnetization(psi=psi)
+    x_minus, _, z_minus = compute_the_magnetization(psi=psi)
     m_minus = torch.cat((z_minus.view(1, -1), x_minus.view(1, -1)), dim=0)
     m_minus = m_minus.unsqueeze(0)  # the batch dimension
 
     # m0 = torch.from_numpy(m_qutip_tot[q, i]).unsqueeze(0)
 
-    omega_eff, engx = compute_the_gradient(
-        m=m_minus, h=h[i].unsqueeze(0), energy=energy, respect_to="x"
-    )
-    h_eff, engz = compute_the_gradient(
-        m=m_minus, h=h[i].unsqueeze(0), energy=energy, respect_to="z"
+    (omega_eff, h_eff), _ = compute_the_effective_fields(
+        m=m_minus,
+        h=h[i].unsqueeze(0),
+        energy=energy,
+        respect_to=("x", "z"),
+        components=ZX_COMPONENTS,
     )
 
     hamiltonian_minus = build_hamiltonian(
         field_x=-1 * omega_eff[0], field_z=-1 * h_eff[0]
     )
     if exponent_algorithm:
-        psi_minus = exponentiation_algorithm(
+        psi_minus = su2_exponentiation_algorithm(
             hamiltonian=hamiltonian_minus, psi=psi, dt=dt
         )
     else:
@@ -400,11 +821,12 @@ def nonlinear_schrodinger_step(
             hamiltonian=hamiltonian_minus, psi=psi, dt=dt
         )
 
-    hamiltonian_plus = hamiltonian_minus.clone()
-
-    for step in range(self_consistent_step):
+    def fixed_point_map(fields: torch.DoubleTensor):
+        hamiltonian_plus = build_hamiltonian(
+            field_x=-1 * fields[0, 0], field_z=-1 * fields[0, 1]
+        )
         if exponent_algorithm:
-            psi_plus = exponentiation_algorithm(
+            psi_plus = su2_exponentiation_algorithm(
                 hamiltonian=0.5 * (hamiltonian_minus + hamiltonian_plus),
                 psi=psi,
                 dt=dt,
@@ -416,25 +838,39 @@ def nonlinear_schrodinger_step(
                 dt=dt,
             )
 
-        z_plus, x_plus, _ = compute_the_magnetization(psi=psi_plus)
+        x_plus, _, z_plus = compute_the_magnetization(psi=psi_plus)
         m_plus = torch.cat((z_plus.view(1, -1), x_plus.view(1, -1)), dim=0)
         m_plus = m_plus.unsqueeze(0)  # the batch dimension
 
         # m1 = torch.from_numpy(m_qutip_tot[q, i]).unsqueeze(0)
 
-        omega_eff, eng = compute_the_gradient(
-            m=m_plus, h=h[i + 1].unsqueeze(0), energy=energy, respect_to="x"
-        )
-        h_eff, _ = compute_the_gradient(
-            m=m_plus, h=h[i + 1].unsqueeze(0), energy=energy, respect_to="z"
+        (omega_eff, h_eff), eng = compute_the_effective_fields(
+            m=m_plus,
+            h=h[i + 1].unsqueeze(0),
+            energy=energy,
+            respect_to=("x", "z"),
+            components=ZX_COMPONENTS,
         )
+        return torch.stack((omega_eff, h_eff), dim=1), eng[0].item()
 
-        hamiltonian_plus = build_hamiltonian(
-            field_x=-1 * omega_eff[0], field_z=-1 * h_eff[0]
-        )
+    fields, eng_plus, info = self_consistent_fields(
+        fixed_point_map=fixed_point_map,
+        fields=torch.stack((omega_eff, h_eff), dim=1),
+        max_iterations=self_consistent_step,
+        tolerance=tolerance,
+    )
+    if report is not None:
+        report.append(info)
+    if eng_plus is not None:
+        eng = eng_plus
+    omega_eff, h_eff = fields[:, 0], fields[:, 1]
+
+    hamiltonian_plus = build_hamiltonian(
+        field_x=-1 * omega_eff[0], field_z=-1 * h_eff[0]
+    )
 
     if exponent_algorithm:
-        psi = exponentiation_algorithm(
+        psi = su2_exponentiation_algorithm(
             hamiltonian=0.5 * (hamiltonian_plus + hamiltonian_minus),
             psi=psi,
             dt=dt,
@@ -460,14 +896,15 @@ def nonlinear_ensamble_schrodinger_step(
     dt: float,
     eta: float,
     exponent_algorithm: bool,
+    compiled: bool = False,
 ):
-    ms_minus = torch.zeros((2, psis[0].shape[0]))
-    xs = torch.zeros(psis[0].shape[0])
-    ys = torch.zeros(psis[0].shape[0])
-    zs = torch.zeros(psis[0].shape[0])
+    ms_minus = torch.zeros((2, psis[0].shape[-1]))
+    xs = torch.zeros(psis[0].shape[-1])
+    ys = torch.zeros(psis[0].shape[-1])
+    zs = torch.zeros(psis[0].shape[-1])
 
     for psi in psis:
-        z, x, y = compute_the_magnetization(psi=psi)
+        x, y, z = compute_the_magnetization(psi=psi)
         xs = xs + x
         ys = ys + y
         zs = zs + z
@@ -476,7 +913,7 @@ def nonlinear_ensamble_schrodinger_step(
 
         eng = energy(m, h[i].unsqueeze(0))[0].item()
 
-        z_minus, x_minus, _ = compute_the_magnetization(psi=psi)
+        x_minus, _, z_minus = compute_the_magnetization(psi=psi)
         m_minus = torch.cat((z_minus.view(1, -1), x_minus.view(1, -1)), dim=0)
         m_minus = m_minus.unsqueeze(0)  # the batch dimension
 
@@ -486,11 +923,13 @@ def nonlinear_ensamble_schrodinger_step(
     xs = xs / len(psis)
     ys = ys / len(psis)
 
-    omega_eff, engx = compute_the_gradient(
-        m=ms_minus, h=h[i].unsqueeze(0), energy=energy, respect_to="x"
-    )
-    h_eff, engz = compute_the_gradient(
-        m=ms_minus, h=h[i].unsqueeze(0), energy=energy, respect_to="z"
+    (omega_eff, h_eff), _ = compute_the_effective_fields(
+        m=ms_minus,
+        h=h[i].unsqueeze(0),
+        energy=energy,
+        respect_to=("x", "z"),
+        components=ZX_COMPONENTS,
+        compiled=compiled,
     )
 
     hamiltonian_minus = build_hamiltonian(
@@ -500,10 +939,10 @@ def nonlinear_ensamble_schrodinger_step(
     hamiltonian_plus = hamiltonian_minus.clone()
 
     for step in range(self_consistent_step):
-        ms_plus = torch.zeros((2, psis[0].shape[0]))
+        ms_plus = torch.zeros((2, psis[0].shape[-1]))
         for psi in psis:
             if exponent_algorithm:
-                psi_plus = exponentiation_algorithm(
+                psi_plus = su2_exponentiation_algorithm(
                     hamiltonian=0.5 * (hamiltonian_minus + hamiltonian_plus),
                     psi=psi,
                     dt=dt,
@@ -515,7 +954,7 @@ def nonlinear_ensamble_schrodinger_step(
                     dt=dt,
                 )
 
-            z_plus, x_plus, _ = compute_the_magnetization(psi=psi_plus)
+            x_plus, _, z_plus = compute_the_magnetization(psi=psi_plus)
             m_plus = torch.cat((z_plus.view(1, -1), x_plus.view(1, -1)), dim=0)
             m_plus = m_plus.unsqueeze(0)  # the batch dimension
 
@@ -524,12 +963,15 @@ def nonlinear_ensamble_schrodinger_step(
         ms_plus = ms_plus / len(psis)
         # m1 = torch.from_numpy(m_qutip_tot[q, i]).unsqueeze(0)
 
-        omega_eff, eng = compute_the_gradient(
-            m=ms_plus, h=h[i + 1].unsqueeze(0), energy=energy, respect_to="x"
-        )
-        h_eff, _ = compute_the_gradient(
-            m=ms_plus, h=h[i + 1].unsqueeze(0), energy=energy, respect_to="z"
+        (omega_eff, h_eff), eng = compute_the_effective_fields(
+            m=ms_plus,
+            h=h[i + 1].unsqueeze(0),
+            energy=energy,
+            respect_to=("x", "z"),
+            components=ZX_COMPONENTS,
+            compiled=compiled,
         )
+        eng = eng[0].item()
 
         hamiltonian_plus = build_hamiltonian(
             field_x=-1 * omega_eff[0], field_z=-1 * h_eff[0]
@@ -537,7 +979,7 @@ def nonlinear_ensamble_schrodinger_step(
 
     for i, psi in enumerate(psis):
         if exponent_algorithm:
-            psis[i] = exponentiation_algorithm(
+            psis[i] = su2_exponentiation_algorithm(
                 hamiltonian=0.5 * (hamiltonian_plus + hamiltonian_minus),
                 psi=psi,
                 dt=dt,
@@ -549,7 +991,7 @@ def nonlinear_ensamble_schrodinger_step(
                 dt=dt,
             )
 
-    # z, x, y = compute_the_magnetization(psi=psi)
+    # x, y, z = compute_the_magnetization(psi=psi)
 
     return psis, omega_eff, h_eff, eng, xs, ys, zs
 
@@ -579,7 +1021,7 @@ def nonlinear_schrodinger_step_zzx_model(
 
     for step in range(self_consistent_step):
         if exponent_algorithm:
-            psi_plus = exponentiation_algorithm(
+            psi_plus = su2_exponentiation_algorithm(
                 hamiltonian=0.5 * (hamiltonian_minus + hamiltonian_plus),
                 psi=psi,
                 dt=dt,
@@ -603,7 +1045,7 @@ def nonlinear_schrodinger_step_zzx_model(
         hamiltonian_plus = build_hamiltonian(field_x=omega_eff, field_z=h_eff)
 
     if exponent_algorithm:
-        psi = exponentiation_algorithm(
+        psi = su2_exponentiation_algorithm(
             hamiltonian=0.5 * (hamiltonian_plus + hamiltonian_minus),
             psi=psi,
             dt=dt,
@@ -626,8 +1068,12 @@ def nonlinear_schrodinger_step_zzx_model_full_effective_field_parallel(
     self_consistent_step: int,
     dt: float,
     exponent_algorithm: bool,
+    streaming: bool = False,
     #    dataset_z: torch.Tensor,
 ):
+    """If streaming, full_z is a preallocated history (R x time x size) with the z at time i in full_z[:, i],
+    and the model is evaluated only on the newest time slice with the cached history (model.reset_stream()
+    at the beginning of the evolution). The new z is written in full_z[:, i + 1]."""
 
     # if i == 0:
     #     dataset = dataset_z[:, 0, :].unsqueeze(1)
@@ -636,7 +1082,10 @@ def nonlinear_schrodinger_step_zzx_model_full_effective_field_parallel(
 
     # full_z_proj = z_dataset_projection(z=full_z, dataset=dataset)
 
-    df_dz = get_effective_field_parallel(z=full_z, model=model, i=-1)
+    if streaming:
+        df_dz = get_effective_field_stream(z=full_z[:, i], model=model)
+    else:
+        df_dz = get_effective_field_parallel(z=full_z, model=model, i=-1)
     h_eff = h[:, i]  # + df_dz)
 
     omega_eff = torch.ones_like(h_eff)
@@ -644,13 +1093,11 @@ def nonlinear_schrodinger_step_zzx_model_full_effective_field_parallel(
 
     psi_old = psi.clone()
 
-    exp_hamiltonian = torch.matrix_exp(-1j * dt * hamiltonian)
-    # psi = parallelized_exponentiation_algorithm(
-    #     hamiltonian=hamiltonian,
-    #     psi=psi,
-    #     dt=dt,
-    # )
-    psi = torch.einsum("rlab,rbl->ral", exp_hamiltonian, psi)
+    psi = su2_exponentiation_algorithm(
+        hamiltonian=hamiltonian,
+        psi=psi,
+        dt=dt,
+    )
     # print("TEST PSI=", psi - psi_old)
 
     hamiltonian_minus = hamiltonian.clone()
@@ -659,22 +1106,20 @@ def nonlinear_schrodinger_step_zzx_model_full_effective_field_parallel(
 
     for step in range(self_consistent_step):
 
-        psi_plus = parallelized_exponentiation_algorithm(
+        psi_plus = su2_exponentiation_algorithm(
             hamiltonian=0.5 * (hamiltonian_minus + hamiltonian_plus),
             psi=psi,
             dt=dt,
         )
 
-        exp_hamiltonian_plus = torch.matrix_exp(
-            -1j * dt * 0.5 * (hamiltonian_minus + hamiltonian_plus)
-        )
-        psi_plus = torch.einsum("lab,bl->al", exp_hamiltonian_plus, psi)
-
         _, _, z_plus = parallelized_compute_the_magnetization(psi=psi_plus)
-        full_z_plus = torch.cat((full_z, z_plus.unsqueeze(1)), dim=0)
-        # full_z_plus_proj = z_dataset_projection(z=full_z_plus, dataset=dataset)
+        if streaming:
+            df_dz = get_effective_field_stream(z=z_plus, model=model, commit=False)
+        else:
+            full_z_plus = torch.cat((full_z, z_plus.unsqueeze(1)), dim=1)
+            # full_z_plus_proj = z_dataset_projection(z=full_z_plus, dataset=dataset)
 
-        df_dz = get_effective_field_parallel(z=full_z_plus, model=model, i=-1)
+            df_dz = get_effective_field_parallel(z=full_z_plus, model=model, i=-1)
         h_eff = 0.5 * (h[:, i + 1])  # + df_dz)
 
         hamiltonian_plus = parallelized_build_hamiltonian(
@@ -687,7 +1132,10 @@ def nonlinear_schrodinger_step_zzx_model_full_effective_field_parallel(
     #     dt=dt,
     # )
     # print("FULL Z SHAPE=", full_z.shape, z.shape)
-    full_z = torch.cat((full_z, z.unsqueeze(1)), dim=1)
+    if streaming:
+        full_z[:, i + 1] = z
+    else:
+        full_z = torch.cat((full_z, z.unsqueeze(1)), dim=1)
     return psi, df_dz, full_z
 
 
@@ -700,8 +1148,12 @@ def nonlinear_schrodinger_step_zzx_model_full_effective_field(
     self_consistent_step: int,
     dt: float,
     exponent_algorithm: bool,
+    streaming: bool = False,
     #    dataset_z: torch.Tensor,
 ):
+    """If streaming, full_z is a preallocated history (time x size) with the z at time i in full_z[i],
+    and the model is evaluated only on the newest time slice with the cached history (model.reset_stream()
+    at the beginning of the evolution). The new z is written in full_z[i + 1]."""
 
     # if i == 0:
     #     dataset = dataset_z[:, 0, :].unsqueeze(1)
@@ -710,7 +1162,10 @@ def nonlinear_schrodinger_step_zzx_model_full_effective_field(
 
     # full_z_proj = z_dataset_projection(z=full_z, dataset=dataset)
 
-    df_dz = get_effective_field(z=full_z, model=model, i=-1)
+    if streaming:
+        df_dz = get_effective_field_stream(z=full_z[i].unsqueeze(0), model=model)[0]
+    else:
+        df_dz = get_effective_field(z=full_z, model=model, i=-1)
 
     h_eff = h[i]   + df_dz
 
@@ -718,7 +1173,7 @@ def nonlinear_schrodinger_step_zzx_model_full_effective_field(
     hamiltonian = build_hamiltonian(field_x=omega_eff, field_z=h_eff)
 
     # exp_hamiltonian = torch.matrix_exp(-1j * dt * hamiltonian)
-    psi = exponentiation_algorithm(
+    psi = su2_exponentiation_algorithm(
         hamiltonian=hamiltonian,
         psi=psi,
         dt=dt,
@@ -731,7 +1186,7 @@ def nonlinear_schrodinger_step_zzx_model_full_effective_field(
 
     for step in range(self_consistent_step):
 
-        psi_plus = exponentiation_algorithm(
+        psi_plus = su2_exponentiation_algorithm(
             hamiltonian=0.5 * (hamiltonian_minus + hamiltonian_plus),
             psi=psi,
             dt=dt,
@@ -743,10 +1198,15 @@ def nonlinear_schrodinger_step_zzx_model_full_effective_field(
         # psi_plus = torch.einsum("lab,bl->al", exp_hamiltonian_plus, psi)
 
         _, _, z_plus = compute_the_magnetization(psi=psi_plus)
-        full_z_plus = torch.cat((full_z, z_plus.unsqueeze(0)), dim=0)
-        # full_z_plus_proj = z_dataset_projection(z=full_z_plus, dataset=dataset)
+        if streaming:
+            df_dz = get_effective_field_stream(
+                z=z_plus.unsqueeze(0), model=model, commit=False
+            )[0]
+        else:
+            full_z_plus = torch.cat((full_z, z_plus.unsqueeze(0)), dim=0)
+            # full_z_plus_proj = z_dataset_projection(z=full_z_plus, dataset=dataset)
 
-        df_dz = get_effective_field(z=full_z_plus, model=model, i=-1)
+            df_dz = get_effective_field(z=full_z_plus, model=model, i=-1)
         h_eff = 0.5 * (h[i + 1] + df_dz)
 
         hamiltonian_plus = build_hamiltonian(field_x=omega_eff, field_z=h_eff)
@@ -757,7 +1217,10 @@ def nonlinear_schrodinger_step_zzx_model_full_effective_field(
     #     dt=dt,
     # )
 
-    full_z = torch.cat((full_z, z.unsqueeze(0)), dim=0)
+    if streaming:
+        full_z[i + 1] = z
+    else:
+        full_z = torch.cat((full_z, z.unsqueeze(0)), dim=0)
     return psi, df_dz, full_z
 
 
@@ -787,7 +1250,7 @@ def nonlinear_schrodinger_step_zzxz_model(
 
     for step in range(self_consistent_step):
         if exponent_algorithm:
-            psi_plus = exponentiation_algorithm(
+            psi_plus = su2_exponentiation_algorithm(
                 hamiltonian=0.5 * (hamiltonian_minus + hamiltonian_plus),
                 psi=psi,
                 dt=dt,
@@ -815,7 +1278,7 @@ def nonlinear_schrodinger_step_zzxz_model(
         hamiltonian_plus = build_hamiltonian(field_x=omega_eff, field_z=h_eff)
 
     if exponent_algorithm:
-        psi = exponentiation_algorithm(
+        psi = su2_exponentiation_algorithm(
             hamiltonian=0.5 * (hamiltonian_plus + hamiltonian_minus),
             psi=psi,
             dt=dt,
@@ -845,6 +1308,15 @@ def get_effective_field(z: torch.tensor, model: nn.Module, i: int):
     return effective_field
 
 
+def get_effective_field_stream(z: torch.tensor, model: nn.Module, commit: bool = True):
+    """Effective field at the newest time slice z (R x size) with the streaming evaluation of a causal model.
+    If commit is False z is a trial value that does not enter the history of the model."""
+    with torch.no_grad():
+        # the stream of every causal model returns R x size
+        effective_field = model.stream(z.double(), commit=commit)
+    return effective_field
+
+
 def z_pca(z: torch.Tensor, dataset: torch.Tensor):
 
     mu = dataset.mean(0)
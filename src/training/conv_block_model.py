@@ -1,7 +1,12 @@
 import torch
 import torch.nn as nn
 from torch.nn import functional as F
-from src.training.model_utils.cnn_causal_blocks import CausalConv2d, MaskedTimeConv2d
+from src.training.model_utils.cnn_causal_blocks import (
+    CausalConv2d,
+    MaskedTimeConv2d,
+    reset_stream_sequential,
+    stream_sequential,
+)
 from typing import List
 
 
@@ -93,6 +98,13 @@ class ConvBlock(nn.Module):
     def forward(self, x: torch.Tensor):
         return self.block(x)
 
+    def reset_stream(self):
+        reset_stream_sequential(self.block)
+
+    def stream(self, x: torch.Tensor, commit: bool = True):
+        """Output at the newest time slice x (batch x channels x size x 1)"""
+        return stream_sequential(self.block, x, commit=commit)
+
 
 class PixelConv(nn.Module):
     def __init__(
@@ -191,6 +203,13 @@ class PixelConv(nn.Module):
     def forward(self, x: torch.Tensor):
         return self.block(x)
 
+    def reset_stream(self):
+        reset_stream_sequential(self.block)
+
+    def stream(self, x: torch.Tensor, commit: bool = True):
+        """Output at the newest time slice x (batch x channels x size x 1)"""
+        return stream_sequential(self.block, x, commit=commit)
+
 
 class ConvBlock1D(nn.Module):
     def __init__(
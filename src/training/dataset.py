@@ -1,4 +1,8 @@
+import os
+import zipfile
 from typing import List, Dict, Tuple
+import numpy as np
+import torch as pt
 from torch.utils.data import Dataset
 
 
@@ -15,3 +19,114 @@ class ScalableCorrelationDataset(Dataset):
 
     def __getitem__(self, idx):
         return [(self.ns[i][idx], self.corrs[i][idx]) for i in range(len(self.ns))]
+
+
+def npz_to_npy(file_name: str, keys: List[str], path: str = None) -> List[str]:
+    """Extract the arrays of a .npz file (compressed or not) as uncompressed .npy files that can be memory mapped.
+    The members are streamed to disk in chunks, so the arrays are never loaded in memory. The extraction is done
+    once: the .npy files newer than the .npz file are reused.
+
+    Args:
+        file_name (str): name of the .npz file or of a directory with the <key>.npy files
+        keys (List[str]): the arrays to extract
+        path (str, optional): directory of the .npy files. Defaults to file_name without the extension + "_npy".
+
+    Returns:
+        List[str]: the .npy files (one for each key)
+    """
+    if os.path.isdir(file_name):
+        return [os.path.join(file_name, key + ".npy") for key in keys]
+    if path is None:
+        path = os.path.splitext(file_name)[0] + "_npy"
+    os.makedirs(path, exist_ok=True)
+
+    npy_files = []
+    with zipfile.ZipFile(file_name) as archive:
+        for key in keys:
+            npy_file = os.path.join(path, key + ".npy")
+            npy_files.append(npy_file)
+            if os.path.exists(npy_file) and os.path.getmtime(
+                npy_file
+            ) >= os.path.getmtime(file_name):
+                continue
+            with archive.open(key + ".npy") as member:
+                version = np.lib.format.read_magic(member)
+                if version == (1, 0):
+                    header = np.lib.format.read_array_header_1_0(member)
+                else:
+                    header = np.lib.format.read_array_header_2_0(member)
+                shape, fortran_order, dtype = header
+                # write the header of the .npy file, then copy the raw data
+                array = np.lib.format.open_memmap(
+                    npy_file + ".tmp",
+                    mode="w+",
+                    dtype=dtype,
+                    shape=shape,
+                    fortran_order=fortran_order,
+                )
+                offset, n_bytes = array.offset, array.nbytes
+                del array
+                with open(npy_file + ".tmp", "r+b") as f:
+                    f.seek(offset)
+                    chunk = 64 * 2**20
+                    for start in range(0, n_bytes, chunk):
+                        f.write(member.read(min(chunk, n_bytes - start)))
+            os.replace(npy_file + ".tmp", npy_file)
+    return npy_files
+
+
+class MemmapDataset(Dataset):
+    def __init__(
+        self,
+        npy_files: List[str],
+        indices: np.ndarray,
+        time_interval: int,
+        preprocessing: bool,
+        dtype: np.dtype = None,
+    ):
+        """Dataset of memory mapped .npy arrays (sample,time,...) restricted to a subset of the samples.
+
+        The items are batches: __getitem__ takes a list of positions (from a BatchSampler) and reads the
+        rows of the batch with a single (sorted) fancy index of the memory maps. The time window and the
+        preprocessing (the (time,l) -> (l,time) view of the samples, as in make_data_loader_unet) are applied
+        to the batch, so the dataset is never loaded in memory and the train/valid splits are only index arrays.
+
+        Args:
+            npy_files (List[str]): the .npy files of the input and the target (see npz_to_npy)
+            indices (np.ndarray): the samples of the dataset
+            time_interval (int): number of time steps of each sample
+            preprocessing (bool): if True the samples are viewed as (l,time)
+            dtype (np.dtype, optional): dtype of the batches (the model dtype), converted in the workers. Defaults to None.
+        """
+        super().__init__()
+        self.npy_files = npy_files
+        self.indices = np.asarray(indices)
+        self.time_interval = time_interval
+        self.preprocessing = preprocessing
+        self.dtype = dtype
+        # opened in each worker of the DataLoader
+        self.arrays = None
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        state["arrays"] = None
+        return state
+
+    def __len__(self):
+        return self.indices.shape[0]
+
+    def __getitem__(self, idx):
+        if self.arrays is None:
+            self.arrays = [np.load(f, mmap_mode="r") for f in self.npy_files]
+        idx = np.sort(self.indices[np.atleast_1d(idx)])
+
+        batch = []
+        for array in self.arrays:
+            if self.preprocessing:
+                x = np.asarray(array[idx])
+                x = x.reshape(x.shape[0], x.shape[-1], x.shape[1])
+                x = x[:, :, : self.time_interval]
+            else:
+                x = np.asarray(array[idx, : self.time_interval])
+            batch.append(pt.from_numpy(np.ascontiguousarray(x, dtype=self.dtype)))
+        return tuple(batch)
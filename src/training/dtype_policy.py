@@ -0,0 +1,93 @@
+import contextlib
+from typing import Dict, List, Optional
+import torch
+import torch.nn as nn
+
+# name: (dtype of the parameters, autocast dtype, float64 master weights)
+DTYPE_POLICIES: Dict[str, tuple] = {
+    "float64": (torch.float64, None, False),
+    "float32": (torch.float32, None, False),
+    "float32_master64": (torch.float32, None, True),
+    "bfloat16": (torch.float32, torch.bfloat16, False),
+}
+
+
+def model_dtype(model: nn.Module) -> torch.dtype:
+    """The dtype of the (floating point) parameters of the model, used to cast the batches in the train steps"""
+    for p in model.parameters():
+        if p.is_floating_point():
+            return p.dtype
+    return torch.get_default_dtype()
+
+
+class DTypePolicy:
+    def __init__(self, name: str = "float64") -> None:
+        """Precision of the training of a model.
+
+        float64 is the historical behaviour of the training. float32 halves the memory and the cost of the
+        convolutions, float32_master64 computes in float32 and keeps a float64 copy of the parameters
+        for the optimizer updates (the small updates of long trainings are not lost in the rounding),
+        bfloat16 keeps float32 parameters and runs the forward in bfloat16 autocast (CPU or cuda).
+
+        The policy only affects the training: the drivers of the Kohn Sham evolution cast the functionals
+        back to float64 (model.to(dtype=torch.double)) since the effective fields are gradients of the energy
+        (see effective_fields_precision_error for the accuracy of a reduced precision functional).
+
+        Args:
+            name (str): one of DTYPE_POLICIES. Defaults to "float64".
+        """
+        if name not in DTYPE_POLICIES:
+            raise ValueError(
+                f"dtype policy {name} not defined, choose one of {list(DTYPE_POLICIES)}"
+            )
+        self.name = name
+        self.param_dtype, self.autocast_dtype, self.master_weights = DTYPE_POLICIES[
+            name
+        ]
+        self.master: Optional[List[torch.Tensor]] = None
+
+    @classmethod
+    def from_model(cls, model: nn.Module):
+        """The policy of a checkpoint (or the plain one of the dtype of the model parameters)"""
+        name = getattr(model, "dtype_policy", None)
+        if name is None:
+            name = "float32" if model_dtype(model) == torch.float32 else "float64"
+        return cls(name)
+
+    def cast_model(self, model: nn.Module) -> nn.Module:
+        """Cast the model to the dtype of the policy and record the policy in the model (saved in the checkpoints)"""
+        model = model.to(dtype=self.param_dtype)
+        model.dtype_policy = self.name
+        return model
+
+    def parameters(self, model: nn.Module) -> List[torch.Tensor]:
+        """The parameters updated by the optimizer: the float64 master copy or the ones of the model"""
+        if not (self.master_weights):
+            return list(model.parameters())
+        if self.master is None:
+            self.master = [
+                p.detach().clone().to(dtype=torch.float64).requires_grad_(True)
+                for p in model.parameters()
+            ]
+        return self.master
+
+    def autocast(self, device: str):
+        if self.autocast_dtype is None:
+            return contextlib.nullcontext()
+        return torch.autocast(
+            device_type=torch.device(device).type, dtype=self.autocast_dtype
+        )
+
+    def step(self, model: nn.Module, opt: torch.optim.Optimizer):
+        """Optimizer step (through the master copy if any) and zero grad"""
+        if self.master_weights:
+            for p, master in zip(model.parameters(), self.parameters(model)):
+                master.grad = None if p.grad is None else p.grad.to(torch.float64)
+            opt.step()
+            with torch.no_grad():
+                for p, master in zip(model.parameters(), self.master):
+                    p.copy_(master)
+            model.zero_grad()
+        else:
+            opt.step()
+        opt.zero_grad()
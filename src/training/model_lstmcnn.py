@@ -7,6 +7,7 @@ from typing import Tuple, List
 from src.training.model_utils.lstm_cnn import LSTMcell, Encoder1D, Decoder1D
 from tqdm import trange
 import matplotlib.pyplot as plt
+from src.training.dtype_policy import model_dtype
 
 
 class CNNLSTM(nn.Module):
@@ -85,8 +86,8 @@ class CNNLSTM(nn.Module):
 
     def train_step(self, batch: Tuple, device: str):
         x, y = batch
-        x = x.to(device=device, dtype=torch.double)
-        y = y.to(device=device, dtype=torch.double)
+        x = x.to(device=device, dtype=model_dtype(self))
+        y = y.to(device=device, dtype=model_dtype(self))
         x = self.forward(x).squeeze()
         loss = self.loss(x, y)
         return loss
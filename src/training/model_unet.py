@@ -4,6 +4,7 @@ import torch
 import torch.nn as nn
 import torch.nn.functional as F
 from typing import Tuple
+from src.training.dtype_policy import model_dtype
 
 
 class REDENTnopooling2D(nn.Module):
@@ -332,24 +333,24 @@ class REDENTnopooling2D(nn.Module):
 
     def train_step(self, batch: Tuple, device: str):
         x, y = batch
-        x = x.to(device=device, dtype=torch.double)
-        y = y.to(device=device, dtype=torch.double)
+        x = x.to(device=device, dtype=model_dtype(self))
+        y = y.to(device=device, dtype=model_dtype(self))
         x = self.forward(x)
         loss = self.loss(x, y)
         return loss
     
     def valid_step(self, batch: Tuple, device: str):
         x, y = batch
-        x = x.to(device=device, dtype=torch.double)
-        y = y.to(device=device, dtype=torch.double)
+        x = x.to(device=device, dtype=model_dtype(self))
+        y = y.to(device=device, dtype=model_dtype(self))
         x = self.forward(x)
         loss = self.loss(x, y)
         return loss
 
     def r2_computation(self, batch: Tuple, device: str, r2):
         x, y = batch
-        x = self.forward(x.to(dtype=torch.double, device=device))
-        y = y.double()
+        x = self.forward(x.to(dtype=model_dtype(self), device=device))
+        y = y.to(model_dtype(self))
         # print(y.shape,x.shape)
         r2.update(x.cpu().detach().view(-1), y.cpu().detach().view(-1))
         return r2
@@ -553,16 +554,16 @@ class DenseAutoEncoder(nn.Module):
     
     def train_step(self, batch: Tuple, device: str):
         x, y = batch
-        x = x.to(device=device, dtype=torch.double)
-        y = y.to(device=device, dtype=torch.double)
+        x = x.to(device=device, dtype=model_dtype(self))
+        y = y.to(device=device, dtype=model_dtype(self))
         x = self.forward(x)
         loss = self.loss(x, y)
         return loss
     
     def valid_step(self, batch: Tuple, device: str):
         x, y = batch
-        x = x.to(device=device, dtype=torch.double)
-        y = y.to(device=device, dtype=torch.double)
+        x = x.to(device=device, dtype=model_dtype(self))
+        y = y.to(device=device, dtype=model_dtype(self))
         x = self.forward(x)
         loss = self.loss(x, y)
         return loss
@@ -5,6 +5,56 @@ from torch.nn.modules.utils import _pair
 from typing import List
 
 
+class TimeRingBuffer:
+    def __init__(self, length: int, replicate: bool) -> None:
+        """Preallocated ring buffer with the last time slices (last dimension) of a streamed input
+
+        Args:
+            length (int): number of stored time slices
+            replicate (bool): if True the slices before the first one are replicas of the first one (as in CausalConv2d), zeros otherwise
+        """
+        self.length = length
+        self.replicate = replicate
+        self.buffer = None
+        self.position = 0
+
+    def window(self, x: torch.Tensor) -> torch.Tensor:
+        """The stored slices in chronological order (... x length), x (... x 1) being the next slice"""
+        if self.buffer is None:
+            shape = (*x.shape[:-1], self.length)
+            return x.expand(shape) if self.replicate else x.new_zeros(shape)
+        order = (
+            self.position + torch.arange(self.length, device=self.buffer.device)
+        ) % self.length
+        return self.buffer.index_select(-1, order)
+
+    def push(self, x: torch.Tensor):
+        if self.length == 0:
+            return
+        if self.buffer is None:
+            self.buffer = self.window(x).clone()
+            self.position = 0
+        self.buffer[..., self.position] = x[..., 0]
+        self.position = (self.position + 1) % self.length
+
+
+def reset_stream_sequential(block: nn.Sequential):
+    for module in block:
+        if hasattr(module, "reset_stream"):
+            module.reset_stream()
+
+
+def stream_sequential(block: nn.Sequential, x: torch.Tensor, commit: bool):
+    """Streaming evaluation of a sequence of time causal layers on a single time slice x (batch x channels x size x 1).
+    The layers without time memory (space convolutions, batchnorm in eval mode, activations) act on the slice directly"""
+    for module in block:
+        if hasattr(module, "stream"):
+            x = module.stream(x, commit=commit)
+        else:
+            x = module(x)
+    return x
+
+
 class MaskedConv2d(nn.Conv2d):
     def __init__(self, *args, **kwargs) -> None:
         # remove mask_type kwargs
@@ -82,6 +132,29 @@ class MaskedTimeConv2d(nn.Conv2d):
             dilation=self.dilation,
         )
 
+    def reset_stream(self):
+        """Reset the history of the streaming evaluation"""
+        _, _, _, kw = self.weight.shape
+        self.history = TimeRingBuffer(
+            length=(kw // 2) * _pair(self.dilation)[1], replicate=False
+        )
+
+    def stream(self, inputs: torch.Tensor, commit: bool = True) -> torch.Tensor:
+        """Output at the newest time slice (batch x channels x size x 1), equal to the last time slice of forward
+        over the whole history but with only the past taps of the kernel. If commit is False the slice is a trial
+        value that does not enter the history (e.g. in a self consistent loop)."""
+        _, _, _, kw = self.weight.shape
+        window = torch.cat((self.history.window(inputs), inputs), dim=-1)
+        if commit:
+            self.history.push(inputs)
+        return F.conv2d(
+            window,
+            weight=(self.mask * self.weight)[..., : kw // 2 + 1],
+            bias=self.bias,
+            padding=[self.padding[0], 0],
+            dilation=self.dilation,
+        )
+
     def extra_repr(self):
         return super(
             MaskedTimeConv2d, self
@@ -249,3 +322,20 @@ class CausalConv2d(nn.Conv2d):
         # print("NEW INPUTS=", new_inputs[0, 0])
         output = super().forward(new_inputs)
         return output
+
+    def reset_stream(self):
+        """Reset the history of the streaming evaluation"""
+        if self.up_padding != 0 or self.stride[1] != 1:
+            raise ValueError(
+                "streaming evaluation needs no padding in the first dimension and a unit time stride"
+            )
+        self.history = TimeRingBuffer(length=self.left_padding, replicate=True)
+
+    def stream(self, inputs: torch.Tensor, commit: bool = True) -> torch.Tensor:
+        """Output at the newest time slice (batch x channels x size x 1), equal to the last time slice of forward
+        over the whole history, with O(kernel_size) cost per slice. If commit is False the slice is a trial
+        value that does not enter the history (e.g. in a self consistent loop)."""
+        window = torch.cat((self.history.window(inputs), inputs), dim=-1)
+        if commit:
+            self.history.push(inputs)
+        return super().forward(window)
@@ -13,6 +13,7 @@ from src.training.model_utils.cnn_causal_blocks import (
 )
 from tqdm import trange
 import matplotlib.pyplot as plt
+from src.training.dtype_policy import model_dtype
 
 
 class TDDFTCNNNoMemory(nn.Module):
@@ -66,6 +67,24 @@ class TDDFTCNNNoMemory(nn.Module):
             x.squeeze(1)
         return x
 
+    def reset_stream(self):
+        """Reset the cached history of the streaming evaluation (call it at the beginning of each trajectory)"""
+        self.CNNBlock.reset_stream()
+
+    def stream(self, x: torch.tensor, commit: bool = True) -> torch.tensor:
+        """Streaming (causal) evaluation on the newest time slice x (batch x size, or batch x 2 x size).
+        The output is the effective field (the channel 0) at the last time slice of forward on the whole
+        history (batch x size), computed in O(1) time per slice, as the stream of the other causal models.
+
+        Args:
+            x (torch.tensor): the newest time slice
+            commit (bool): if False x is a trial value that does not enter the history. Defaults to True.
+        """
+        if x.shape[1] != 2:
+            x = x.unsqueeze(1)
+        x = self.CNNBlock.stream(x.unsqueeze(-1), commit=commit)
+        return x[:, 0, :, 0]
+
     def train_step(self, batch: Tuple, device: str):
         loss = 0
         x, y = batch
@@ -78,7 +97,7 @@ class TDDFTCNNNoMemory(nn.Module):
         x = x[:, :, : self.t_interval_range]  # + noise
         y = y.to(device=device)
         y = y[:, :, : self.t_interval_range]
-        y_hat = self.forward(x.double())
+        y_hat = self.forward(x.to(model_dtype(self)))
         y_hat = y_hat.squeeze()
         y = y.squeeze()
         loss = +self.loss(y_hat, y)
@@ -92,7 +111,7 @@ class TDDFTCNNNoMemory(nn.Module):
         x = x[:, :, : self.t_interval_range]
         y = y.to(device=device)
         y = y[:, :, : self.t_interval_range]
-        y_hat = self.forward(x.double())
+        y_hat = self.forward(x.to(model_dtype(self)))
         y_hat = y_hat.squeeze()
         y = y.squeeze()
         loss = +self.loss(y_hat, y)
@@ -486,24 +505,24 @@ class REDENT2D(nn.Module):
 
     def train_step(self, batch: Tuple, device: str):
         x, y = batch
-        x = x.to(device=device, dtype=torch.double)
-        y = y.to(device=device, dtype=torch.double)
+        x = x.to(device=device, dtype=model_dtype(self))
+        y = y.to(device=device, dtype=model_dtype(self))
         x = self.forward(x)  # .squeeze(1)
         loss = self.loss(x, y)
         return loss
 
     def predict_step(self, batch: Tuple, device: str):
         x, y = batch
-        x = x.to(device=device, dtype=torch.double)
-        y = y.to(device=device, dtype=torch.double)
+        x = x.to(device=device, dtype=model_dtype(self))
+        y = y.to(device=device, dtype=model_dtype(self))
         x = self.forward(x)  # .squeeze(1)
         loss = self.loss(x, y)
         return loss
 
     def valid_step(self, batch: Tuple, device: str):
         x, y = batch
-        x = x.to(device=device, dtype=torch.double)
-        y = y.to(device=device, dtype=torch.double)
+        x = x.to(device=device, dtype=model_dtype(self))
+        y = y.to(device=device, dtype=model_dtype(self))
         x = self.forward(x)  # .squeeze(1)
         loss = self.loss(x, y)
         return loss
@@ -896,24 +915,24 @@ class REDENT2DPCA(nn.Module):
 
     def train_step(self, batch: Tuple, device: str):
         x, y = batch
-        x = x.to(device=device, dtype=torch.double)
-        y = y.to(device=device, dtype=torch.double)
+        x = x.to(device=device, dtype=model_dtype(self))
+        y = y.to(device=device, dtype=model_dtype(self))
         x = self.forward(x)  # .squeeze(1)
         loss = self.loss(x, y)
         return loss
 
     def predict_step(self, batch: Tuple, device: str):
         x, y = batch
-        x = x.to(device=device, dtype=torch.double)
-        y = y.to(device=device, dtype=torch.double)
+        x = x.to(device=device, dtype=model_dtype(self))
+        y = y.to(device=device, dtype=model_dtype(self))
         x = self.forward(x)  # .squeeze(1)
         loss = self.loss(x, y)
         return loss
 
     def valid_step(self, batch: Tuple, device: str):
         x, y = batch
-        x = x.to(device=device, dtype=torch.double)
-        y = y.to(device=device, dtype=torch.double)
+        x = x.to(device=device, dtype=model_dtype(self))
+        y = y.to(device=device, dtype=model_dtype(self))
         x = self.forward(x)  # .squeeze(1)
         loss = self.loss(x, y)
         return loss
@@ -1310,24 +1329,24 @@ class REDENTnopooling(nn.Module):
 
     def train_step(self, batch: Tuple, device: str):
         x, y = batch
-        x = x.to(device=device, dtype=torch.double)
-        y = y.to(device=device, dtype=torch.double)
+        x = x.to(device=device, dtype=model_dtype(self))
+        y = y.to(device=device, dtype=model_dtype(self))
         x = self.forward(x).squeeze()
         loss = self.loss(x, y)
         return loss
 
     def valid_step(self, batch: Tuple, device: str):
         x, y = batch
-        x = x.to(device=device, dtype=torch.double)
-        y = y.to(device=device, dtype=torch.double)
+        x = x.to(device=device, dtype=model_dtype(self))
+        y = y.to(device=device, dtype=model_dtype(self))
         x = self.forward(x).squeeze()
         loss = self.loss(x, y)
         return loss
 
     def r2_computation(self, batch: Tuple, device: str, r2):
         x, y = batch
-        x = self.forward(x.to(dtype=torch.double, device=device))
-        y = y.double()
+        x = self.forward(x.to(dtype=model_dtype(self), device=device))
+        y = y.to(model_dtype(self))
         # print(y.shape,x.shape)
         r2.update(x.cpu().detach().view(-1), y.cpu().detach().view(-1))
         return r2
@@ -1411,18 +1430,30 @@ class LSTMTDDFT(nn.Module):
     def forward(self, x: torch.Tensor):
         return self.model(x)
 
+    def reset_stream(self):
+        """Reset the cached hidden state of the streaming evaluation"""
+        self.state = None
+
+    def stream(self, x: torch.Tensor, commit: bool = True) -> torch.Tensor:
+        """Output at the newest time slice x (batch x features) from the cached hidden state.
+        If commit is False the hidden state is not updated."""
+        output, state = self.model(x.unsqueeze(1), self.state)
+        if commit:
+            self.state = state
+        return output[:, 0]
+
     def train_step(self, batch: Tuple, device: str):
         x, y = batch
-        x = x.to(device=device, dtype=torch.double)
-        y = y.to(device=device, dtype=torch.double)
+        x = x.to(device=device, dtype=model_dtype(self))
+        y = y.to(device=device, dtype=model_dtype(self))
         x, _ = self.forward(x)
         loss = self.loss(x, y)
         return loss
 
     def valid_step(self, batch: Tuple, device: str):
         x, y = batch
-        x = x.to(device=device, dtype=torch.double)
-        y = y.to(device=device, dtype=torch.double)
+        x = x.to(device=device, dtype=model_dtype(self))
+        y = y.to(device=device, dtype=model_dtype(self))
         x, _ = self.forward(x)
         loss = self.loss(x, y)
         return loss
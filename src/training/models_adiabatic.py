@@ -2,6 +2,7 @@ import torch
 import torch.nn as nn
 from typing import Tuple, Optional
 from torch.nn.functional import sigmoid
+from src.training.dtype_policy import model_dtype
 
 
 class TDDFTadiabaticModel(nn.Module):
@@ -344,16 +345,16 @@ class TDDFTadiabaticModel(nn.Module):
 
     def train_step(self, batch: Tuple, device: str):
         x, y = batch
-        x = x.to(device=device, dtype=torch.double)
-        y = y.to(device=device, dtype=torch.double)
+        x = x.to(device=device, dtype=model_dtype(self))
+        y = y.to(device=device, dtype=model_dtype(self))
         x = self.forward(x).squeeze()
         loss = self.loss(x, y)
         return loss
 
     def r2_computation(self, batch: Tuple, device: str, r2):
         x, y = batch
-        x = self.forward(x.to(dtype=torch.double, device=device))
-        y = y.double()
+        x = self.forward(x.to(dtype=model_dtype(self), device=device))
+        y = y.to(model_dtype(self))
         # print(y.shape,x.shape)
         r2.update(x.cpu().detach().view(-1), y.cpu().detach().view(-1))
         return r2
@@ -911,8 +912,8 @@ class TDDFTadiabaticModel_xxzzxz(nn.Module):
 
     def train_step(self, batch: Tuple, device: str):
         x, y = batch
-        x = x.to(device=device, dtype=torch.double)
-        y = y.to(device=device, dtype=torch.double)
+        x = x.to(device=device, dtype=model_dtype(self))
+        y = y.to(device=device, dtype=model_dtype(self))
         x = self.forward(x).squeeze()
 
         loss = self.loss(x, y)
@@ -920,8 +921,8 @@ class TDDFTadiabaticModel_xxzzxz(nn.Module):
 
     def r2_computation(self, batch: Tuple, device: str, r2):
         x, y = batch
-        x = self.forward(x.to(dtype=torch.double, device=device))
-        y = y.double()
+        x = self.forward(x.to(dtype=model_dtype(self), device=device))
+        y = y.to(model_dtype(self))
         # print(y.shape,x.shape)
         r2.update(x.cpu().detach().view(-1), y.cpu().detach().view(-1))
         return r2
@@ -1314,16 +1315,16 @@ class REDENTnopooling(nn.Module):
 
     def train_step(self, batch: Tuple, device: str):
         x, y = batch
-        x = x.to(device=device, dtype=torch.double)
-        y = y.to(device=device, dtype=torch.double)
+        x = x.to(device=device, dtype=model_dtype(self))
+        y = y.to(device=device, dtype=model_dtype(self))
         x = self.forward(x).squeeze()
         loss = self.loss(x, y)
         return loss
 
     def r2_computation(self, batch: Tuple, device: str, r2):
         x, y = batch
-        x = self.forward(x.to(dtype=torch.double, device=device))
-        y = y.double()
+        x = self.forward(x.to(dtype=model_dtype(self), device=device))
+        y = y.to(model_dtype(self))
         # print(y.shape,x.shape)
         r2.update(x.cpu().detach().view(-1), y.cpu().detach().view(-1))
         return r2
@@ -1722,8 +1723,8 @@ class TDDFTadiabaticModelNoNorm(nn.Module):
 
     def train_step(self, batch: Tuple, device: str):
         x, y = batch
-        x = x.to(device=device, dtype=torch.double)
-        y = y.to(device=device, dtype=torch.double)
+        x = x.to(device=device, dtype=model_dtype(self))
+        y = y.to(device=device, dtype=model_dtype(self))
         x = self.forward(x).squeeze()
 
         loss = self.loss(x, y)
@@ -1731,8 +1732,8 @@ class TDDFTadiabaticModelNoNorm(nn.Module):
 
     def r2_computation(self, batch: Tuple, device: str, r2):
         x, y = batch
-        x = self.forward(x.to(dtype=torch.double, device=device))
-        y = y.double()
+        x = self.forward(x.to(dtype=model_dtype(self), device=device))
+        y = y.to(model_dtype(self))
         # print(y.shape,x.shape)
         r2.update(x.cpu().detach().view(-1), y.cpu().detach().view(-1))
         return r2
@@ -13,6 +13,7 @@ from src.training.model_utils.cnn_causal_blocks import (
 )
 from tqdm import trange
 import matplotlib.pyplot as plt
+from src.training.dtype_policy import model_dtype
 
 
 class PixelCNN(nn.Module):
@@ -98,6 +99,32 @@ class PixelCNN(nn.Module):
         y = self.PixelCONV_final(y)
         return y.squeeze()
 
+    def reset_stream(self):
+        """Reset the cached history of the streaming evaluation (call it at the beginning of each trajectory)"""
+        self.CNNBlock.reset_stream()
+        self.PixelCONV_initial.reset_stream()
+        self.PixelCONV_final.reset_stream()
+
+    def stream(self, x: torch.tensor, commit: bool = True) -> torch.tensor:
+        """Streaming (causal) evaluation on the newest time slice x (batch x 2 x size).
+        The output is the channel 0 of the last time slice of forward on the whole history (batch x size).
+
+        Args:
+            x (torch.tensor): the newest time slice
+            commit (bool): if False x is a trial value that does not enter the history. Defaults to True.
+        """
+        h_eff = x[:, 0, None, :, None]
+        h = x[:, 1, None, :, None]
+
+        h = self.CNNBlock.stream(h, commit=commit)
+        h_eff = self.PixelCONV_initial.stream(h_eff, commit=commit)
+
+        # the gate of forward acts on the concatenation of the time axes, slice by slice
+        y = self.Gated(torch.cat((h_eff, h), axis=-1))
+
+        y = self.PixelCONV_final.stream(y, commit=commit)
+        return y[:, 0, :, 0]
+
     def train_step(self, batch: Tuple, device: str):
         loss = 0
         x, y = batch
@@ -106,7 +133,7 @@ class PixelCNN(nn.Module):
         y = y.to(device=device)
         y = y[:, :, : self.t_interval_range]
 
-        y_hat = self.forward(x.double())
+        y_hat = self.forward(x.to(model_dtype(self)))
         y_hat = y_hat.squeeze()
         y = y.squeeze()
         loss = +self.loss(y_hat, y)
@@ -120,7 +147,7 @@ class PixelCNN(nn.Module):
         x = x[:, :, :, : self.t_interval_range]
         y = y.to(device=device)
         y = y[:, :, : self.t_interval_range]
-        y_hat = self.forward(x.double())
+        y_hat = self.forward(x.to(model_dtype(self)))
         y_hat = y_hat.squeeze()
         y = y.squeeze()
         loss = +self.loss(y_hat, y)
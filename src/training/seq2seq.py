@@ -6,6 +6,7 @@ from src.training.model_utils.utils_seq2seq import (
     ProbabilityHead,
 )
 from typing import Tuple
+from src.training.dtype_policy import model_dtype
 
 
 class Seq2Seq(nn.Module):
@@ -58,12 +59,12 @@ class Seq2Seq(nn.Module):
 
     def train_step(self, batch: Tuple, device: str):
         x, y = batch
-        x = x.to(device=device, dtype=torch.double)
+        x = x.to(device=device, dtype=model_dtype(self))
         # create some noise to improve the universality
         noise_mu = torch.zeros_like(x)
         noise_sigma = self.regularization * torch.ones_like(x)
         noise = torch.normal(noise_mu, noise_sigma)
-        y = y.to(device=device, dtype=torch.double)
+        y = y.to(device=device, dtype=model_dtype(self))
         y_input = y + noise
         x = x.unsqueeze(1)
         y = y.unsqueeze(1)
@@ -75,12 +76,12 @@ class Seq2Seq(nn.Module):
 
     def valid_step(self, batch: Tuple, device: str):
         x, y = batch
-        x = x.to(device=device, dtype=torch.double)
+        x = x.to(device=device, dtype=model_dtype(self))
         # create some noise to improve the universality
         noise_mu = torch.zeros_like(x)
         noise_sigma = self.regularization * torch.ones_like(x)
         noise = torch.normal(noise_mu, noise_sigma)
-        y = y.to(device=device, dtype=torch.double)
+        y = y.to(device=device, dtype=model_dtype(self))
         y_input = y + noise
         x = x.unsqueeze(1)
         y = y.unsqueeze(1)
@@ -1,7 +1,12 @@
+import queue
+import threading
+import time
 import torch
+import torch.distributed as dist
 import torch.nn as nn
-from typing import Tuple, List
+from typing import Optional, Tuple, List
 from tqdm import tqdm, trange
+from src.training.dtype_policy import DTypePolicy
 
 
 def decreasing(val_losses, best_loss, min_delta=0.001):
@@ -13,6 +18,138 @@ def decreasing(val_losses, best_loss, min_delta=0.001):
     return is_decreasing
 
 
+def to_device(batch, device: str, dtype: Optional[torch.dtype] = None):
+    """Move (nested lists/tuples of) tensors to device, casting the floating point ones to dtype"""
+    if isinstance(batch, (list, tuple)):
+        return type(batch)(to_device(b, device, dtype) for b in batch)
+    if not (isinstance(batch, torch.Tensor)):
+        return batch
+    if dtype is not None and batch.is_floating_point():
+        batch = batch.to(dtype=dtype)
+    if torch.device(device).type == "cuda":
+        return batch.pin_memory().to(device=device, non_blocking=True)
+    return batch.to(device=device)
+
+
+class PrefetchLoader:
+    def __init__(
+        self,
+        dl: torch.utils.data.DataLoader,
+        device: str,
+        dtype: Optional[torch.dtype] = None,
+        prefetch: int = 2,
+    ) -> None:
+        """Iterate a DataLoader with the batches already converted to the model dtype and moved to device.
+
+        A background thread reads and converts the next batches (up to prefetch of them) while the
+        current step computes, so the .to(device, dtype) of the train_step of the models is a no op.
+        The time spent waiting for the batches and the throughput of the last epoch are recorded.
+
+        Args:
+            dl (torch.utils.data.DataLoader): the data loader
+            device (str): the device of the model
+            dtype (Optional[torch.dtype]): the dtype of the model (None keeps the dtype of the data). Defaults to None.
+            prefetch (int): number of batches in the queue. Defaults to 2.
+        """
+        self.dl = dl
+        self.device = device
+        self.dtype = dtype
+        self.prefetch = prefetch
+
+        self.data_wait_time = 0.0
+        self.n_batches = 0
+        self.elapsed = 0.0
+
+    @property
+    def batches_per_second(self) -> float:
+        return self.n_batches / self.elapsed if self.elapsed > 0 else 0.0
+
+    def __len__(self):
+        return len(self.dl)
+
+    def _producer(self, batches: queue.Queue, stop: threading.Event):
+        def put(item) -> bool:
+            # False if the consumer stopped
+            while not (stop.is_set()):
+                try:
+                    batches.put(item, timeout=0.1)
+                    return True
+                except queue.Full:
+                    continue
+            return False
+
+        try:
+            for batch in self.dl:
+                if not (put(to_device(batch, self.device, self.dtype))):
+                    return
+        except Exception as e:
+            put(e)
+            return
+        put(StopIteration())
+
+    def __iter__(self):
+        batches = queue.Queue(maxsize=self.prefetch)
+        stop = threading.Event()
+        thread = threading.Thread(
+            target=self._producer, args=(batches, stop), daemon=True
+        )
+        thread.start()
+
+        self.data_wait_time = 0.0
+        self.n_batches = 0
+        start = time.perf_counter()
+        try:
+            while True:
+                wait = time.perf_counter()
+                batch = batches.get()
+                self.data_wait_time += time.perf_counter() - wait
+                if isinstance(batch, StopIteration):
+                    break
+                if isinstance(batch, Exception):
+                    raise batch
+                yield batch
+                self.n_batches += 1
+        finally:
+            stop.set()
+            thread.join()
+            self.elapsed = time.perf_counter() - start
+
+
+def is_distributed() -> bool:
+    return dist.is_available() and dist.is_initialized()
+
+
+def broadcast_parameters(model: nn.Module):
+    """Copy the parameters and the buffers of rank 0 to all the processes (before building the optimizer)"""
+    for tensor in list(model.parameters()) + list(model.buffers()):
+        dist.broadcast(tensor.data, src=0)
+
+
+def average_gradients(model: nn.Module):
+    """All reduce (in a single flat buffer) the average of the gradients over the processes, as DistributedDataParallel"""
+    grads = [p.grad for p in model.parameters() if p.grad is not None]
+    if len(grads) == 0:
+        return
+    flat = torch.cat([g.reshape(-1) for g in grads])
+    dist.all_reduce(flat, op=dist.ReduceOp.SUM)
+    flat /= dist.get_world_size()
+    start = 0
+    for g in grads:
+        g.copy_(flat[start : start + g.numel()].view_as(g))
+        start += g.numel()
+
+
+def average_buffers(model: nn.Module):
+    """All reduce the average of the floating point buffers (e.g. the running statistics of the BatchNorm layers)
+    and copy the other ones (e.g. num_batches_tracked) from rank 0, so all the processes validate and save the same model"""
+    for buffer in model.buffers():
+        if buffer.is_floating_point():
+            dist.all_reduce(buffer.data, op=dist.ReduceOp.SUM)
+            buffer.data /= dist.get_world_size()
+        else:
+            dist.broadcast(buffer.data, src=0)
+
+
 def fit(
     epochs: int,
     model: torch.nn.Module,
@@ -29,6 +166,11 @@ def fit(
     patiance: int,
     early_stopping: float,
     device: str,
+    prefetch: int = 2,
+    dtype: Optional[torch.dtype] = None,
+    eval_train_every: int = 0,
+    eval_train_batches: Optional[int] = None,
+    policy: Optional[DTypePolicy] = None,
 ) -> Tuple:
     """This function fits the model using the selected optimizer.
         It will return a list with the loss values and the accuracy as a tuple (loss,accuracy).
@@ -45,25 +187,61 @@ def fit(
     name_checkpoint: if checkpoint is true, the name of the checkpoint model
     history_train: the record of train losses over the past epochs
     history_valid: the record of valid losses over the past epochs
+    prefetch: number of batches converted and prefetched on a background thread (0 to disable)
+    dtype: the dtype of the batches (default the dtype of the model parameters)
+    eval_train_every: every how many epochs the train loss is recomputed exactly (without gradients)
+        with the model in eval mode (default=0, only the running loss of the optimization pass)
+    eval_train_batches: number of batches of each train set used for the exact train loss (default=None, all)
+    policy: the dtype policy of the training (default the plain policy of the model dtype), if it
+        uses the float64 master weights opt must be built on policy.parameters(model)
 
     return: the evolution of the train and valid losses
 
+    In a distributed run (torch.distributed initialized, one shard of the data for each process, with the same
+    number of batches) the gradients are averaged over the processes after each backward, the losses are averaged
+    over all the shards and only rank 0 saves the checkpoints and prints the losses.
+
     """
 
     loss_func = loss_func
 
+    distributed = is_distributed()
+    main_process = not (distributed) or dist.get_rank() == 0
+
+    if policy is None:
+        policy = DTypePolicy.from_model(model)
+    model.dtype_policy = policy.name
+
+    # the batches are converted to the model dtype and prefetched while the step computes
+    if dtype is None:
+        dtype = policy.param_dtype
+    if prefetch > 0:
+        train_dls = [PrefetchLoader(dl, device, dtype, prefetch) for dl in train_dls]
+        valid_dls = [PrefetchLoader(dl, device, dtype, prefetch) for dl in valid_dls]
+
     wait = 0
     if supervised:
         r_max = -100000
     best_loss = 10 ** 9
 
-    for epoch in trange(epochs, desc="train epoch"):
+    for epoch in trange(epochs, desc="train epoch", disable=not (main_process)):
 
-        model.train()
         loss_ave_train = 0
         loss_ave_valid = 0
         kldiv_train = 0
         kldiv_valid = 0
+        # input pipeline metrics of the optimization pass
+        data_wait_time = 0.0
+        n_batches = 0
+        elapsed = 0.0
+
+        n_train_batches = 0
+        n_valid_batches = 0
+        loss_eval_train = 0
+        n_eval_batches = 0
+        eval_train = (
+            supervised and eval_train_every > 0 and (epoch + 1) % eval_train_every == 0
+        )
 
         for i in range(len(train_dls)):
             train_dl = train_dls[i]
@@ -73,58 +251,116 @@ def fit(
                 total=len(train_dl),
                 desc=f"batch [loss_ave: None]",
                 leave=False,
+                disable=not (main_process),
             )
 
+            model.train()
             for batch in tqdm_iterator:
 
                 batch = batch
-                loss = model.train_step(batch, device)
+                with policy.autocast(device):
+                    loss = model.train_step(batch, device)
                 loss.backward()
+                if distributed:
+                    average_gradients(model)
+
+                policy.step(model, opt)
+                if distributed:
+                    average_buffers(model)
 
-                opt.step()
-                opt.zero_grad()
+                # running train loss (of the model during the optimization pass)
+                if supervised:
+                    loss_ave_train += loss.item()
+                    n_train_batches += 1
 
                 tqdm_iterator.set_description(
                     f"train batch subset-{i} [avg loss: {loss.item():.9f}]"
                 )
                 tqdm_iterator.refresh()
 
+            if prefetch > 0:
+                data_wait_time += train_dl.data_wait_time
+                n_batches += train_dl.n_batches
+                elapsed += train_dl.elapsed
+
             model.eval()
             # if supervised:
             #     r2 = R2Score()
 
-            for batch in valid_dl:
-                if supervised:
-                    loss = model.valid_step(batch, device)
-                    loss_ave_valid += loss.item()
-                else:
-                    loss, kldiv = model.train_generative_step(batch, device)
-                    loss_ave_valid += loss.item()
-                    kldiv_valid += kldiv
-
-            for batch in train_dl:
-                if supervised:
-                    loss = model.train_step(batch, device)
-                    loss_ave_train += loss.item()
-                else:
-                    loss, kldiv = model.train_generative_step(batch, device)
-                    loss_ave_train += loss.item()
-                    kldiv_train += kldiv
+            with torch.no_grad(), policy.autocast(device):
+                for batch in valid_dl:
+                    if supervised:
+                        loss = model.valid_step(batch, device)
+                        loss_ave_valid += loss.item()
+                    else:
+                        loss, kldiv = model.train_generative_step(batch, device)
+                        loss_ave_valid += loss.item()
+                        kldiv_valid += kldiv
+                    n_valid_batches += 1
+
+                if supervised and eval_train:
+                    for k, batch in enumerate(train_dl):
+                        if eval_train_batches is not None and k >= eval_train_batches:
+                            break
+                        loss = model.train_step(batch, device)
+                        loss_eval_train += loss.item()
+                        n_eval_batches += 1
+                elif not (supervised):
+                    # the kl divergence of the generative models is not in the optimization pass
+                    for batch in train_dl:
+                        loss, kldiv = model.train_generative_step(batch, device)
+                        loss_ave_train += loss.item()
+                        kldiv_train += kldiv
+
+        n_processes = 1
+        if distributed:
+            # sums over the shards of all the processes
+            n_processes = dist.get_world_size()
+            totals = torch.tensor(
+                [
+                    loss_ave_train,
+                    n_train_batches,
+                    loss_ave_valid,
+                    n_valid_batches,
+                    loss_eval_train,
+                    n_eval_batches,
+                    float(kldiv_train),
+                    float(kldiv_valid),
+                ],
+                dtype=torch.double,
+            )
+            dist.all_reduce(totals, op=dist.ReduceOp.SUM)
+            (
+                loss_ave_train,
+                n_train_batches,
+                loss_ave_valid,
+                n_valid_batches,
+                loss_eval_train,
+                n_eval_batches,
+                kldiv_train,
+                kldiv_valid,
+            ) = totals.tolist()
+
         if supervised:
 
-            loss_ave_train = loss_ave_train / (len(train_dl) * len(train_dls))
+            loss_ave_train = loss_ave_train / max(n_train_batches, 1)
             history_train.append(loss_ave_train)
-            loss_ave_valid = loss_ave_valid / (len(valid_dl) * len(train_dls))
+            loss_ave_valid = loss_ave_valid / max(n_valid_batches, 1)
             history_valid.append(loss_ave_valid)
-            print(loss_ave_valid)
+            if main_process:
+                print(loss_ave_valid)
+            if eval_train:
+                loss_eval_train = loss_eval_train / max(n_eval_batches, 1)
+                if main_process:
+                    print(f"loss_eval_train={loss_eval_train}")
 
         else:
-            kldiv_train = kldiv_train / len(train_dl)
-            kldiv_valid = kldiv_valid / len(valid_dl)
+            kldiv_train = kldiv_train / (len(train_dl) * n_processes)
+            kldiv_valid = kldiv_valid / (len(valid_dl) * n_processes)
 
-            loss_ave_train = loss_ave_train / len(train_dl)
+            loss_ave_train = loss_ave_train / (len(train_dl) * n_processes)
             history_train.append(loss_ave_train)
-            loss_ave_valid = loss_ave_valid / len(valid_dl)
+            loss_ave_valid = loss_ave_valid / (len(valid_dl) * n_processes)
             history_valid.append(loss_ave_valid)
 
         wait = wait + 1
@@ -134,16 +370,17 @@ def fit(
             metric = best_loss
         if decreasing(history_valid, metric, early_stopping):
             wait = 0
-        if wait >= patiance:
+        if wait >= patiance and main_process:
             print(f"EARLY STOPPING AT {early_stopping}")
 
         if checkpoint:
             if best_loss >= loss_ave_valid:
-                print("Decreasing!")
-                torch.save(
-                    model,
-                    f"model_rep/{name_checkpoint}",
-                )
+                if main_process:
+                    print("Decreasing!")
+                    torch.save(
+                        model,
+                        f"model_rep/{name_checkpoint}",
+                    )
                 best_loss = loss_ave_valid
 
             history_best.append(best_loss)
@@ -153,6 +390,11 @@ def fit(
             else:
                 text = "_generative"
 
+        # only rank 0 saves the histories and prints
+        if not (main_process):
+            continue
+
+        if checkpoint:
             torch.save(
                 history_train,
                 f"losses_dft_pytorch/{name_checkpoint}_loss_train" + text,
@@ -166,6 +408,11 @@ def fit(
                 f"losses_dft_pytorch/{name_checkpoint}_loss_best" + text,
             )
 
+        if prefetch > 0:
+            print(
+                f"batches/s={n_batches / elapsed if elapsed > 0 else 0.0:.2f} "
+                f"data wait time={data_wait_time:.3f}s"
+            )
         if supervised:
             print(
                 f"loss_ave_train={loss_ave_train} \n"
@@ -7,6 +7,7 @@ from src.training.model_utils.utils_seq2seq import (
 )
 from src.training.model_utils.lstm_cnn import Encoder1D, Decoder1D, Encoder2D, Decoder2D
 from typing import Tuple, List
+from src.training.dtype_policy import model_dtype
 
 
 class UnetLSTM(nn.Module):
@@ -84,11 +85,34 @@ class UnetLSTM(nn.Module):
         z = z.view(bs, t, -1)
         return z
 
+    def reset_stream(self, mean: float, std: float):
+        """Reset the cached hidden state of the streaming evaluation.
+        forward normalizes with the statistics of the whole input (not causal), so the streaming
+        evaluation uses a fixed normalization (e.g. the one of the training set).
+
+        Args:
+            mean (float): the normalization mean
+            std (float): the normalization standard deviation
+        """
+        self.state = None
+        self.mean = mean
+        self.std = std
+
+    def stream(self, b: torch.Tensor, commit: bool = True) -> torch.Tensor:
+        """Output at the newest time slice b (batch x size). If commit is False the hidden state is not updated."""
+        b = (b - self.mean) / self.std
+        lt, outputs = self.encoder(b.unsqueeze(1))
+        lt, state = self.lstm(lt.view(b.shape[0], 1, -1), self.state)
+        if commit:
+            self.state = state
+        z = self.decoder(lt.reshape(b.shape[0], -1), outputs)
+        return z.squeeze(1).view(b.shape[0], -1)
+
     def train_step(self, batch: Tuple, device: str):
         x, y = batch
-        x = x.to(device=device, dtype=torch.double)
+        x = x.to(device=device, dtype=model_dtype(self))
         # create some noise to improve the universality
-        y = y.to(device=device, dtype=torch.double)
+        y = y.to(device=device, dtype=model_dtype(self))
         y_tilde = self.forward(x)
         # y_tilde = self.probability_head.training_sample(mu, logsigma)
         loss = self.loss(y_tilde, y)
@@ -96,9 +120,9 @@ class UnetLSTM(nn.Module):
 
     def valid_step(self, batch: Tuple, device: str):
         x, y = batch
-        x = x.to(device=device, dtype=torch.double)
+        x = x.to(device=device, dtype=model_dtype(self))
         # create some noise to improve the universality
-        y = y.to(device=device, dtype=torch.double)
+        y = y.to(device=device, dtype=model_dtype(self))
         y_tilde = self.forward(x)
         # y_tilde = self.probability_head.training_sample(mu, logsigma)
         loss = self.loss(y_tilde, y)
@@ -183,9 +207,9 @@ class UnetLSTM_beta(nn.Module):
 
     def train_step(self, batch: Tuple, device: str):
         x, y = batch
-        x = x.to(device=device, dtype=torch.double)
+        x = x.to(device=device, dtype=model_dtype(self))
         # create some noise to improve the universality
-        y = y.to(device=device, dtype=torch.double)
+        y = y.to(device=device, dtype=model_dtype(self))
         y_tilde = self.forward(x)
         # y_tilde = self.probability_head.training_sample(mu, logsigma)
         loss = self.loss(y_tilde, y)
@@ -193,9 +217,9 @@ class UnetLSTM_beta(nn.Module):
 
     def valid_step(self, batch: Tuple, device: str):
         x, y = batch
-        x = x.to(device=device, dtype=torch.double)
+        x = x.to(device=device, dtype=model_dtype(self))
         # create some noise to improve the universality
-        y = y.to(device=device, dtype=torch.double)
+        y = y.to(device=device, dtype=model_dtype(self))
         y_tilde = self.forward(x)
         # y_tilde = self.probability_head.training_sample(mu, logsigma)
         loss = self.loss(y_tilde, y)
@@ -4,8 +4,13 @@ from typing import Dict, List, Tuple
 import numpy as np
 import torch as pt
 import torch.nn as nn
-from torch.utils.data import DataLoader, TensorDataset
-from src.training.dataset import ScalableCorrelationDataset
+from torch.utils.data import BatchSampler, DataLoader, RandomSampler, TensorDataset
+from src.training.dtype_policy import DTypePolicy
+from src.training.dataset import (
+    MemmapDataset,
+    ScalableCorrelationDataset,
+    npz_to_npy,
+)
 
 # %%
 
@@ -29,55 +34,64 @@ def make_data_loader_unet(
     keys: Tuple,
     time_interval: int,
     preprocessing: bool,
+    num_workers: int = 0,
+    prefetch_factor: int = 2,
+    dtype: np.dtype = None,
+    rank: int = 0,
+    world_size: int = 1,
 ) -> tuple:
     """
     This function create a data loader from a .npz file
 
     Arguments
 
-    file_name: name of the npz data_file (numpy format)
-    pbc: if True the input data is extended in a periodic fashion with 128 components both on the top and bottom (128+256+128)
-    split: the ratio valid_data/train_data
+    file_name: name of the npz data_file (numpy format) or of a directory with the <key>.npy files
+    split: the ratio train_data/data
     bs: batch size of the data loader
-    img: if True reshape the x data into a one dimensional image        (N_dataset,1,dimension)
+    keys: the input and the target arrays of the data file
+    time_interval: number of time steps of each sample
+    preprocessing: if True each sample (time,l) is viewed as (l,time)
+    num_workers: number of processes that read the batches (default=0, in the main process)
+    prefetch_factor: number of batches prefetched by each worker (default=2)
+    dtype: dtype of the batches, e.g. the one of the model (default=None, the dtype of the data)
+    rank: the process of a distributed training, that takes its shard of the train and valid sets (default=0)
+    world_size: the number of processes of a distributed training (default=1)
+
+    The arrays are extracted once as uncompressed .npy files and memory mapped, the train/valid
+    splits are random subsets of indices and the batches are read and sliced on the fly (see MemmapDataset)
     """
 
-    data = np.load(file_name)
-    # in this way we generalize this vector-vector function
-    k1 = pt.tensor(data[keys[0]])
-    k2 = pt.tensor(data[keys[1]])
-
-    p = np.random.permutation(np.arange(k1.shape[0]))
-    k1 = k1[p]
-    k2 = k2[p]
-    n_train = int(k1.shape[0] * split)
-    if preprocessing:
-        x = k1.view(k1.shape[0], k1.shape[-1], k1.shape[1])
-        y = k2.view(k2.shape[0], k2.shape[-1], k2.shape[1])
-
-        train_ds = TensorDataset(
-            x[0:n_train, :, :time_interval],
-            y[0:n_train, :, :time_interval],
-        )
-        train_dl = DataLoader(train_ds, bs, shuffle=True)
-        valid_ds = TensorDataset(
-            x[n_train:,:, :time_interval],
-            y[n_train:, :, :time_interval],
-        )
-        valid_dl = DataLoader(valid_ds,  bs, shuffle=True)
-    else:
-        x = k1
-        y = k2
-        train_ds = TensorDataset(
-            x[0:n_train, :time_interval],
-            y[0:n_train, :time_interval],
+    npy_files = npz_to_npy(file_name, keys=list(keys[:2]))
+    n_dataset = np.load(npy_files[0], mmap_mode="r").shape[0]
+
+    p = np.random.permutation(np.arange(n_dataset))
+    n_train = int(n_dataset * split)
+
+    dls = []
+    for indices in [p[0:n_train], p[n_train:]]:
+        # shards of the same size (the same number of batches in each process)
+        n_shard = indices.shape[0] // world_size
+        indices = indices[rank::world_size][:n_shard]
+        ds = MemmapDataset(
+            npy_files,
+            indices=indices,
+            time_interval=time_interval,
+            preprocessing=preprocessing,
+            dtype=dtype,
         )
-        train_dl = DataLoader(train_ds, bs, shuffle=True)
-        valid_ds = TensorDataset(
-            x[n_train:, :time_interval],
-            y[n_train:, :time_interval],
+        # each item of the dataset is a whole batch
+        sampler = BatchSampler(RandomSampler(ds), batch_size=bs, drop_last=False)
+        dls.append(
+            DataLoader(
+                ds,
+                sampler=sampler,
+                batch_size=None,
+                num_workers=num_workers,
+                prefetch_factor=prefetch_factor if num_workers > 0 else None,
+                persistent_workers=num_workers > 0,
+            )
         )
-        valid_dl = DataLoader(valid_ds,  bs, shuffle=True)
+    train_dl, valid_dl = dls
 
     return train_dl, valid_dl
 
@@ -197,16 +211,20 @@ def plotting_test(output_model: pt.tensor, target: pt.tensor):
     plt.show()
 
 
-def get_optimizer(model: pt.nn.Module, lr: int) -> pt.optim.Optimizer:
+def get_optimizer(
+    model: pt.nn.Module, lr: int, policy: DTypePolicy = None
+) -> pt.optim.Optimizer:
     """This function fixies the optimizer
 
     Argument:
 
     model: the model which should be trained, related to the Optimizer
     lr: learning rate of the optimization process
+    policy: the dtype policy of the training (the optimizer updates its float64 master weights if any)
     """
 
-    opt = pt.optim.Adam(model.parameters(), lr=lr)
+    parameters = model.parameters() if policy is None else policy.parameters(model)
+    opt = pt.optim.Adam(parameters, lr=lr)
 
     return opt
 
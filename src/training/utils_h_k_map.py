@@ -6,36 +6,27 @@ from torchmetrics import R2Score
 from tqdm import trange
 from torch.utils.data import TensorDataset, DataLoader
 import matplotlib.pyplot as plt
-from src.training.models import Energy_unet
 from src.training.utils import count_parameters
 
 # Methods from quantum_ising_simulation
 
 
-def parallel_nambu_diagonalization_ising_model(
-    nbatch, l: int, j_coupling: float, hs: np.array, device: str, pbc: bool
-):
-    """Compute the correlation <\sigma_x \sigma_x>(ij) of the transverse quantum ising model using the Nambu Mapping
+def nambu_ising_template(
+    l: int, j_coupling: float, device: str, pbc: bool
+) -> torch.Tensor:
+    """The field independent part of the Nambu matrix of the transverse quantum ising model
 
     Args:
         l (int): length of the chain
         j_coupling (float): coupling costant of the spin interaction
-        hs (np.array): realizations of the magnetic field [batch,l]
-        checkpoint (bool): if True, it creates a npz version of the dataset
-        train (bool): if True, it labels the file as train, valid otherwise
-        device(str): the device used for the computation. Can be either 'cuda' or 'cpu' (standard is 'cpu').
+        device (str): the device used for the computation. Can be either 'cuda' or 'cpu'.
+        pbc (bool): periodic boundary conditions
+
     Returns:
-        e,f,m_z (Tuple[np.array]): a triple of energies, H-K functional values and transverse magnetizations for each hs realizations
+        torch.Tensor: the [2l,2l] Nambu matrix at zero field (the field enters in the diagonal as +h, -h)
     """
-
-    n_dataset = hs.shape[0]
-
-    batch = int(n_dataset / nbatch)
-    # uniform means h_ave=0
-    hs = torch.tensor(hs, dtype=torch.double, device=device)
-
     # obc
-    j_vec = j_coupling * torch.ones(l, device=device)
+    j_vec = j_coupling * torch.ones(l, dtype=torch.double, device=device)
     # the 0-th component is null in OBC
     j_vec_l = j_vec.clone()
     if not (pbc):
@@ -50,12 +41,11 @@ def parallel_nambu_diagonalization_ising_model(
     if pbc:
         j_vec_r[-1] = -1 * j_vec_r[-1]
 
-    # create the nambu matrix
-
     # create the j matrix in the nearest neighbourhood case
-    j_l = torch.einsum("ij,j->ij", torch.eye(l, device=device), j_vec_l)
+    eye = torch.eye(l, dtype=torch.double, device=device)
+    j_l = torch.einsum("ij,j->ij", eye, j_vec_l)
     j_l = torch.roll(j_l, shifts=-1, dims=1)
-    j_r = torch.einsum("ij,j->ij", torch.eye(l, device=device), j_vec_r)
+    j_r = torch.einsum("ij,j->ij", eye, j_vec_r)
     j_r = torch.roll(j_r, shifts=1, dims=1)
     # the coupling part for a
     j = -0.5 * (j_r + j_l)
@@ -64,32 +54,78 @@ def parallel_nambu_diagonalization_ising_model(
     # the b matrix of the nambu matrix
     b = j_b
 
+    h_nambu = torch.zeros((2 * l, 2 * l), dtype=torch.double, device=device)
+    h_nambu[:l, :l] = j
+    h_nambu[:l, l:] = b
+    h_nambu[l:, :l] = -1 * torch.conj(b)
+    h_nambu[l:, l:] = -1 * torch.conj(j)
+    return h_nambu
+
+
+def nambu_ising_chunks(
+    nbatch: int, l: int, j_coupling: float, hs: np.array, device: str, pbc: bool
+):
+    """Diagonalize the Nambu matrices of the transverse quantum ising model in nbatch chunks of field realizations.
+    Only the diagonal (field) block of the template is updated for each chunk.
+
+    Args:
+        nbatch (int): number of chunks
+        l (int): length of the chain
+        j_coupling (float): coupling costant of the spin interaction
+        hs (np.array): realizations of the magnetic field [batch,l]
+        device (str): the device used for the computation. Can be either 'cuda' or 'cpu'.
+        pbc (bool): periodic boundary conditions
+
+    Yields:
+        start, stop (int): the realizations of the chunk
+        h (torch.Tensor): the fields of the chunk [chunk,l]
+        e, u, v (torch.Tensor): the energies [chunk,2l] and the u, v coefficients [chunk,l,l] of the Bogoliubov modes
+    """
+    hs = torch.as_tensor(hs, dtype=torch.double, device=device)
+    template = nambu_ising_template(l, j_coupling, device=device, pbc=pbc)
+    sites = torch.arange(l, device=device)
+
+    # the last chunk takes the remainder
+    bounds = np.linspace(0, hs.shape[0], nbatch + 1).astype(int)
     for i in trange(nbatch):
-        # the external field
-        h = hs[i * batch : (i + 1) * batch]
-        h_matrix = torch.einsum("ij,aj->aij", torch.eye(l, device=device), h)
-        # the a matrix of the nambu matrix
-        a = j + h_matrix
-
-        # create the nambu matrix
-        h_nambu = torch.zeros((batch, 2 * l, 2 * l), device=device)
-        h_nambu[:, :l, :l] = a
-        h_nambu[:, :l, l:] = b
-        h_nambu[:, l:, :l] = -1 * torch.conj(b)
-        h_nambu[:, l:, l:] = -1 * torch.conj(a)
+        start, stop = bounds[i], bounds[i + 1]
+        if stop == start:
+            continue
+        h = hs[start:stop]
+        h_nambu = template.expand(stop - start, 2 * l, 2 * l).clone()
+        h_nambu[:, sites, sites] += h
+        h_nambu[:, l + sites, l + sites] -= h
 
         e, w = torch.linalg.eigh(h_nambu)
+        # the u and v coefficients
+        u = w[:, :l, :l]
+        v = w[:, l:, :l]
+        yield start, stop, h, e, u, v
+
 
-        # the v coefficients
-        v = w.clone()[:, l:, :l]
+def nambu_ising_correlation(u: torch.Tensor, v: torch.Tensor) -> torch.Tensor:
+    """The correlation matrix of the Majorana operators that gives <\sigma_x \sigma_x>"""
+    c_vv = torch.einsum("anl,aml->anm", v, torch.conj(v))
+    c_uu = torch.einsum("anl,aml->anm", u, torch.conj(u))
+    c_vu = torch.einsum("anl,aml->anm", v, torch.conj(u))
+    c_uv = torch.einsum("anl,aml->anm", u, torch.conj(v))
+    return c_vv + c_vu - c_uu - c_uv
 
-        u = w.clone()[:, :l, :l]
-        # compute the correlation sigma_x sigma_x
-        c_vv = torch.einsum("anl,aml->anm", v, torch.conj(v))
-        c_uu = torch.einsum("anl,aml->anm", u, torch.conj(u))
-        c_vu = torch.einsum("anl,aml->anm", v, torch.conj(u))
-        c_uv = torch.einsum("anl,aml->anm", u, torch.conj(v))
-        c = c_vv + c_vu - c_uu - c_uv
+
+def nambu_diagonalization_ising_chunks(
+    nbatch: int, l: int, j_coupling: float, hs: np.array, device: str, pbc: bool
+):
+    """Generator version of parallel_nambu_diagonalization_ising_model, that yields the outcomes chunk by chunk
+    (e.g. to write them in a TrajectoryStore with extend, without keeping the whole dataset in memory).
+
+    Yields:
+        start, stop (int): the realizations of the chunk
+        s_z, s_z_different, f, density_f, e_0 (np.ndarray): the outcomes of the chunk (see parallel_nambu_diagonalization_ising_model)
+    """
+    for start, stop, h, e, u, v in nambu_ising_chunks(
+        nbatch, l, j_coupling, hs, device=device, pbc=pbc
+    ):
+        c = nambu_ising_correlation(u, v)
 
         s_z = 1 - 2 * torch.einsum("aik,aik->ai", v, torch.conj(v))
         s_z_different = torch.einsum("aik,aik->ai", u, torch.conj(u)) - torch.einsum(
@@ -102,19 +138,44 @@ def parallel_nambu_diagonalization_ising_model(
         e_0 = torch.sum(e[:, 0:l], dim=-1) / l
         f = e_0 - torch.mean(h * s_z, dim=-1)
 
-        if i == 0:
-            magn_z = s_z
-            magn_z_diff = s_z_different
-            e_tot = e_0
-            f_tot = f
-            tot_density_f = density_f
-        else:
-            magn_z = np.append(magn_z, s_z, axis=0)
-            magn_z_diff = np.append(magn_z_diff, s_z_different, axis=0)
-            e_tot = np.append(e_tot, e_0)
-            f_tot = np.append(f_tot, f)
-            tot_density_f = np.append(tot_density_f, density_f, axis=0)
+        yield start, stop, *(
+            x.detach().cpu().numpy() for x in (s_z, s_z_different, f, density_f, e_0)
+        )
+
 
+def parallel_nambu_diagonalization_ising_model(
+    nbatch, l: int, j_coupling: float, hs: np.array, device: str, pbc: bool
+):
+    """Compute the correlation <\sigma_x \sigma_x>(ij) of the transverse quantum ising model using the Nambu Mapping
+
+    Args:
+        l (int): length of the chain
+        j_coupling (float): coupling costant of the spin interaction
+        hs (np.array): realizations of the magnetic field [batch,l]
+        device(str): the device used for the computation. Can be either 'cuda' or 'cpu' (standard is 'cpu').
+    Returns:
+        e,f,m_z (Tuple[np.array]): a triple of energies, H-K functional values and transverse magnetizations for each hs realizations
+    """
+
+    n_dataset = hs.shape[0]
+    # the outcomes are preallocated and filled chunk by chunk
+    magn_z = np.zeros((n_dataset, l))
+    magn_z_diff = np.zeros((n_dataset, l))
+    f_tot = np.zeros(n_dataset)
+    tot_density_f = np.zeros((n_dataset, l))
+    e_tot = np.zeros(n_dataset)
+    for start, stop, s_z, s_z_different, f, density_f, e_0 in (
+        nambu_diagonalization_ising_chunks(
+            nbatch, l, j_coupling, hs, device=device, pbc=pbc
+        )
+    ):
+        magn_z[start:stop] = s_z
+        magn_z_diff[start:stop] = s_z_different
+        f_tot[start:stop] = f
+        tot_density_f[start:stop] = density_f
+        e_tot[start:stop] = e_0
+
+    hs = torch.tensor(hs, dtype=torch.double, device=device)
     return hs, magn_z, magn_z_diff, f_tot, tot_density_f, e_tot
 
 
@@ -133,104 +194,168 @@ def parallel_nambu_correlation_ising_model(
         l (int): length of the chain
         j_coupling (float): coupling costant of the spin interaction
         hs (np.array): realizations of the magnetic field [batch,l]
-        checkpoint (bool): if True, it creates a npz version of the dataset
-        train (bool): if True, it labels the file as train, valid otherwise
         device(str): the device used for the computation. Can be either 'cuda' or 'cpu' (standard is 'cpu').
     Returns:
         e,f,m_z (Tuple[np.array]): a triple of energies, H-K functional values and transverse magnetizations for each hs realizations
     """
 
     n_dataset = hs.shape[0]
+    corr_xx = np.zeros((n_dataset, l, l))
+    corr_zz = np.zeros((n_dataset, l, l))
+    magn_z = np.zeros((n_dataset, l))
+
+    sites = torch.arange(l, device=device)
+    for start, stop, h, e, u, v in nambu_ising_chunks(
+        nbatch, l, j_coupling, hs, device=device, pbc=pbc
+    ):
+        c = nambu_ising_correlation(u, v)
+        s_z = 1 - 2 * torch.einsum("aik,aik->ai", v, torch.conj(v))
 
-    batch = int(n_dataset / nbatch)
-    # uniform means h_ave=0
-    hs = torch.tensor(hs, dtype=torch.double, device=device)
+        # <z_k z_r> = c_kk c_rr - c_kr c_rk
+        c_diag = torch.diagonal(c, dim1=-2, dim2=-1)
+        ss_z = c_diag[:, :, None] * c_diag[:, None, :] - c * c.transpose(-1, -2)
+        ss_z[:, sites, sites] = 1.0
+
+        # <x_k x_r> = det c[k:r, k+1:r+1], all the pairs at the same distance at once
+        ss_x = torch.zeros_like(c)
+        ss_x[:, sites, sites] = 1.0
+        for d in range(1, l):
+            k = torch.arange(l - d, device=device)
+            rows = k[:, None] + torch.arange(d, device=device)[None, :]
+            minors = c[:, rows[:, :, None], rows[:, None, :] + 1]
+            det = torch.linalg.det(minors)
+            ss_x[:, k, k + d] = det
+            ss_x[:, k + d, k] = det
+
+        corr_xx[start:stop] = ss_x.detach().cpu().numpy()
+        corr_zz[start:stop] = ss_z.detach().cpu().numpy()
+        magn_z[start:stop] = s_z.detach().cpu().numpy()
 
-    # obc
-    j_vec = j_coupling * torch.ones(l, device=device)
-    # the 0-th component is null in OBC
-    j_vec_l = j_vec.clone()
-    if not (pbc):
-        j_vec_l[0] = 0
-    if pbc:
-        j_vec_l[0] = -1 * j_vec_l[0]
+    return corr_xx, corr_zz, magn_z
 
-    # the l-th component is null in OBC
-    j_vec_r = j_vec.clone()
-    if not (pbc):
-        j_vec_r[-1] = 0
+
+def majorana_ising_matrix(
+    j_coupling: float, h: torch.Tensor, pbc: bool, parity: int = 1
+) -> torch.Tensor:
+    """Majorana matrix A of H = sum_i j x_i x_{i+1} + sum_i h_i z_i, written as H = (i/4) sum_kl A_kl a_k a_l
+    with a_2i = (prod_{j<i} z_j) x_i and a_2i+1 = (prod_{j<i} z_j) y_i (Jordan-Wigner).
+
+    Args:
+        j_coupling (float): coupling of the x x interaction
+        h (torch.Tensor): the fields [batch,l]
+        pbc (bool): periodic boundary conditions
+        parity (int): eigenvalue of prod_i z_i that fixes the boundary term with pbc. Defaults to 1.
+
+    Returns:
+        torch.Tensor: the real antisymmetric matrix [batch,2l,2l]
+    """
+    batch, l = h.shape
+    sites = torch.arange(l, device=h.device)
+    a = torch.zeros((batch, 2 * l, 2 * l), dtype=h.dtype, device=h.device)
+    a[:, 2 * sites, 2 * sites + 1] = -2 * h
+    bonds = sites[:-1]
+    a[:, 2 * bonds + 1, 2 * bonds + 2] = -2 * j_coupling
     if pbc:
-        j_vec_r[-1] = -1 * j_vec_r[-1]
+        # x_{l-1} x_0 = -parity * (-i a_{2l-1} a_0)
+        a[:, 2 * l - 1, 0] = 2 * parity * j_coupling
+    return a - a.transpose(-1, -2)
 
-    # create the nambu matrix
 
-    # create the j matrix in the nearest neighbourhood case
-    j_l = torch.einsum("ij,j->ij", torch.eye(l, device=device), j_vec_l)
-    j_l = torch.roll(j_l, shifts=-1, dims=1)
-    j_r = torch.einsum("ij,j->ij", torch.eye(l, device=device), j_vec_r)
-    j_r = torch.roll(j_r, shifts=1, dims=1)
-    # the coupling part for a
-    j = -0.5 * (j_r + j_l)
-    # the coupling part for b
-    j_b = -0.5 * (j_r - j_l)
-    # the b matrix of the nambu matrix
-    b = j_b
+def majorana_ising_observables(
+    gamma: torch.Tensor, j_coupling: float, pbc: bool, parity: int = 1
+) -> Tuple[torch.Tensor]:
+    """Observables of a gaussian state from its Majorana correlation matrix Gamma_kl = (i/2) <[a_k, a_l]>
 
-    for i in trange(nbatch):
-        ss_x = torch.zeros((batch, l, l))
-        ss_z = torch.zeros((batch, l, l))
-        ss_s_s_z = torch.zeros((batch, l, l))
-        # the external field
-        h = hs[i * batch : (i + 1) * batch]
-        h_matrix = torch.einsum("ij,aj->aij", torch.eye(l, device=device), h)
-        # the a matrix of the nambu matrix
-        a = j + h_matrix
-
-        # create the nambu matrix
-        h_nambu = torch.zeros((batch, 2 * l, 2 * l), device=device)
-        h_nambu[:, :l, :l] = a
-        h_nambu[:, :l, l:] = b
-        h_nambu[:, l:, :l] = -1 * torch.conj(b)
-        h_nambu[:, l:, l:] = -1 * torch.conj(a)
+    Args:
+        gamma (torch.Tensor): correlation matrix [...,2l,2l]
+        j_coupling (float): coupling of the current operator 2j (x_{i-1} y_i + y_i x_{i+1})
+        pbc (bool): periodic boundary conditions
+        parity (int): eigenvalue of prod_i z_i. Defaults to 1.
 
-        e, w = torch.linalg.eigh(h_nambu)
+    Returns:
+        z, xx, zz, current (Tuple[torch.Tensor]): <z_i>, <x_i x_{i+1}>, <z_i z_{i+1}> and the bond current [...,l]
+        (the last bond is zero with obc). <x_i> is zero in the gaussian states of fixed parity.
+    """
+    l = gamma.shape[-1] // 2
+    sites = torch.arange(l, device=gamma.device)
+    even, odd = 2 * sites, 2 * sites + 1
+    even_next, odd_next = (2 * sites + 2) % (2 * l), (2 * sites + 3) % (2 * l)
+    odd_previous = (2 * sites - 1) % (2 * l)
+
+    # the bonds across the boundary have an extra -parity sign (and vanish with obc)
+    boundary = torch.ones(l, dtype=gamma.dtype, device=gamma.device)
+    boundary[-1] = -parity if pbc else 0.0
+    boundary_left = torch.roll(boundary, shifts=1)
+
+    z = -gamma[..., even, odd]
+    xx = -gamma[..., odd, even_next] * boundary
+    # Wick theorem for (-i a_2i a_2i+1)(-i a_2i+2 a_2i+3)
+    zz = (
+        gamma[..., even, odd] * gamma[..., even_next, odd_next]
+        - gamma[..., even, even_next] * gamma[..., odd, odd_next]
+        + gamma[..., even, odd_next] * gamma[..., odd, even_next]
+    )
+    if not (pbc):
+        zz[..., -1] = 0.0
+    y_x_next = gamma[..., even, even_next] * boundary
+    x_previous_y = -gamma[..., odd_previous, odd] * boundary_left
+    current = 2 * j_coupling * (x_previous_y + y_x_next)
+    return z, xx, zz, current
 
-        # the v coefficients
-        v = w.clone()[:, l:, :l]
 
-        u = w.clone()[:, :l, :l]
-        # compute the correlation sigma_x sigma_x
-        c_vv = torch.einsum("anl,aml->anm", v, torch.conj(v))
-        c_uu = torch.einsum("anl,aml->anm", u, torch.conj(u))
-        c_vu = torch.einsum("anl,aml->anm", v, torch.conj(u))
-        c_uv = torch.einsum("anl,aml->anm", u, torch.conj(v))
-        c = c_vv + c_vu - c_uu - c_uv
+def parallel_nambu_dynamics_ising_model(
+    l: int,
+    j_coupling: float,
+    hs: np.array,
+    time: np.array,
+    device: str,
+    pbc: bool,
+    midpoint: bool = False,
+) -> Tuple[torch.Tensor]:
+    """Time evolution of H(t) = sum_i j x_i x_{i+1} + sum_i h_i(t) z_i for a batch of driving fields, starting from the ground state
+    of H(0), with the Bogoliubov-de Gennes (Majorana) formalism. The 2l x 2l correlation matrix evolves as Gamma -> R Gamma R^T
+    with R = exp(A dt) for the field piecewise constant in each time step, so the cost is polynomial in l. With pbc the state is in
+    the even parity sector (antiperiodic fermions), as in parallel_nambu_diagonalization_ising_model.
 
-        s_z = 1 - 2 * torch.einsum("aik,aik->ai", v, torch.conj(v))
-        for k in range(l):
-            for r in range(k, l):
-                if r != k:
-                    ss_z[:, k, r] = ss_z[:, k, r] + (
-                        c[:, k, k] * c[:, r, r] - c[:, k, r] * c[:, r, k]
-                    )
-                    ss_z[:, r, k] = ss_z[:, r, k] + ss_z[:, k, r]
-                    # print(f'k={k},j={j}')
-                    ss_x[:, k, r] = ss_x[:, k, r] + torch.linalg.det(
-                        c[:, k:r, k + 1 : r + 1]
-                    )
-                    ss_x[:, r, k] = ss_x[:, r, k] + ss_x[:, k, r]
-                    # print(c[k:j,k+1:j+1])
-                    # print(c,k,j)
-                else:
-                    ss_x[:, k, r] = 1.0
-                    ss_z[:, k, r] = 1
-        if i == 0:
-            corr_zz = ss_z
-            magn_z = s_z
-            corr_xx = ss_x
-        else:
-            corr_zz = np.append(corr_zz, ss_z, axis=0)
-            corr_xx = np.append(corr_xx, ss_x, axis=0)
-            magn_z = np.append(magn_z, s_z, axis=0)
+    Args:
+        l (int): length of the chain
+        j_coupling (float): coupling costant of the spin interaction
+        hs (np.array): the driving fields [batch,time,l]
+        time (np.array): the time grid [time]
+        device (str): the device used for the computation. Can be either 'cuda' or 'cpu'.
+        pbc (bool): periodic boundary conditions
+        midpoint (bool): use the midpoint value of the field in each step (otherwise hs[:, n] in [t_n, t_n+1]). Defaults to False.
 
-    return corr_xx, corr_zz, magn_z
+    Returns:
+        z, xx, zz, current (Tuple[torch.Tensor]): <z_i>, <x_i x_{i+1}>, <z_i z_{i+1}> and the bond current 2j (x_{i-1} y_i + y_i x_{i+1})
+        [batch,time,l]
+    """
+    hs = torch.tensor(hs, dtype=torch.double, device=device)
+    time = torch.tensor(time, dtype=torch.double, device=device)
+    batch, steps, _ = hs.shape
+
+    # ground state of H(0): Gamma = i sign(i A)
+    a = majorana_ising_matrix(j_coupling, hs[:, 0], pbc=pbc)
+    e, w = torch.linalg.eigh(1j * a.to(torch.complex128))
+    gamma = torch.real(
+        1j * torch.einsum("akn,an,aln->akl", w, torch.sign(e).to(w.dtype), w.conj())
+    )
+
+    z = torch.zeros((batch, steps, l), dtype=torch.double, device=device)
+    xx = torch.zeros_like(z)
+    zz = torch.zeros_like(z)
+    current = torch.zeros_like(z)
+    z[:, 0], xx[:, 0], zz[:, 0], current[:, 0] = majorana_ising_observables(
+        gamma, j_coupling, pbc=pbc
+    )
+
+    for n in trange(steps - 1):
+        h = hs[:, n] if not (midpoint) else 0.5 * (hs[:, n] + hs[:, n + 1])
+        a = majorana_ising_matrix(j_coupling, h, pbc=pbc)
+        r = torch.linalg.matrix_exp(a * (time[n + 1] - time[n]))
+        gamma = r @ gamma @ r.transpose(-1, -2)
+        z[:, n + 1], xx[:, n + 1], zz[:, n + 1], current[:, n + 1] = (
+            majorana_ising_observables(gamma, j_coupling, pbc=pbc)
+        )
+
+    return z, xx, zz, current
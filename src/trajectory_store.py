@@ -0,0 +1,192 @@
+import os
+import re
+import numpy as np
+from typing import Dict, List
+
+
+class TrajectoryStore:
+    def __init__(self, path: str, flush_every: int = 100) -> None:
+        """Append-only on-disk store for the trajectories of a simulation.
+
+        Each trajectory is a sequence of records (e.g. the time slices of an evolution, or the samples of a dataset).
+        The records are buffered in memory and every flush_every records they are written as a new chunk
+        (a single .npz file with all the keys), so the I/O is linear in the number of records. A chunk is written
+        to a temporary file and renamed, thus an interrupted run leaves only complete chunks and it can be resumed
+        from the last one (see saved_length and state).
+
+        Args:
+            path (str): the directory of the store, it is created if it does not exist
+            flush_every (int): number of buffered records of a trajectory before writing a chunk. Defaults to 100.
+        """
+        self.path = path
+        self.flush_every = flush_every
+        os.makedirs(self.path, exist_ok=True)
+
+        # chunks on disk: trajectory -> list of (start, length, file name)
+        self.chunks: Dict[int, List] = {}
+        for file_name in os.listdir(self.path):
+            match = re.fullmatch(
+                r"trajectory_(\d+)_start_(\d+)_length_(\d+)\.npz", file_name
+            )
+            if match is not None:
+                trajectory, start, length = (int(g) for g in match.groups())
+                self.chunks.setdefault(trajectory, []).append(
+                    (start, length, file_name)
+                )
+        for trajectory in self.chunks:
+            self.chunks[trajectory].sort()
+
+        # in memory buffers: trajectory -> key -> list of records
+        self.buffers: Dict[int, Dict[str, List]] = {}
+        self.states: Dict[int, Dict[str, np.ndarray]] = {}
+
+    def _save(self, file_name: str, arrays: Dict[str, np.ndarray]):
+        tmp = os.path.join(self.path, file_name + ".tmp")
+        with open(tmp, "wb") as f:
+            np.savez(f, **arrays)
+        os.replace(tmp, os.path.join(self.path, file_name))
+
+    def clear(self):
+        """Remove the chunks and the static arrays on disk and the buffered records (e.g. to start a new run)"""
+        for chunks in self.chunks.values():
+            for _, _, file_name in chunks:
+                os.remove(os.path.join(self.path, file_name))
+        if os.path.exists(os.path.join(self.path, "static.npz")):
+            os.remove(os.path.join(self.path, "static.npz"))
+        self.chunks = {}
+        self.buffers = {}
+        self.states = {}
+
+    def write_static(self, **arrays):
+        """Save the arrays that do not grow with the records (e.g. time grid, rates)"""
+        self._save("static.npz", arrays)
+
+    def static(self) -> Dict[str, np.ndarray]:
+        file_name = os.path.join(self.path, "static.npz")
+        if not (os.path.exists(file_name)):
+            return {}
+        with np.load(file_name) as data:
+            return {key: data[key] for key in data.files}
+
+    def saved_length(self, trajectory: int = 0) -> int:
+        """Number of records of the trajectory on disk"""
+        if trajectory not in self.chunks or len(self.chunks[trajectory]) == 0:
+            return 0
+        start, length, _ = self.chunks[trajectory][-1]
+        return start + length
+
+    def length(self, trajectory: int = 0) -> int:
+        """Number of records of the trajectory (on disk and buffered)"""
+        buffer = self.buffers.get(trajectory, {})
+        n_buffer = len(next(iter(buffer.values()))) if len(buffer) > 0 else 0
+        return self.saved_length(trajectory) + n_buffer
+
+    def append(self, trajectory: int = 0, state: Dict = None, **records):
+        """Append a single record of the trajectory.
+
+        Args:
+            trajectory (int): the index of the trajectory. Defaults to 0.
+            state (Dict): arrays needed to resume the run after this record (e.g. the Kohm-Sham states), saved with the chunk. Defaults to None.
+            records: one array per key, with the shape of a single record
+        """
+        buffer = self.buffers.setdefault(trajectory, {})
+        for key, value in records.items():
+            buffer.setdefault(key, []).append(np.asarray(value))
+        if state is not None:
+            self.states[trajectory] = {
+                key: np.asarray(value) for key, value in state.items()
+            }
+        if self.length(trajectory) - self.saved_length(trajectory) >= self.flush_every:
+            self.flush(trajectory)
+
+    def flush(self, trajectory: int = None):
+        """Write the buffered records as new chunks (of a single trajectory or of all of them)"""
+        trajectories = list(self.buffers.keys()) if trajectory is None else [trajectory]
+        for q in trajectories:
+            buffer = self.buffers.get(q, {})
+            if len(buffer) == 0:
+                continue
+            arrays = {key: np.stack(values, axis=0) for key, values in buffer.items()}
+            self._write_chunk(q, arrays)
+            self.buffers[q] = {}
+
+    def _write_chunk(self, trajectory: int, arrays: Dict[str, np.ndarray]):
+        start = self.saved_length(trajectory)
+        length = len(next(iter(arrays.values())))
+        for key, value in self.states.get(trajectory, {}).items():
+            arrays["state_" + key] = value
+        file_name = (
+            f"trajectory_{trajectory:05d}_start_{start:08d}_length_{length:06d}.npz"
+        )
+        self._save(file_name, arrays)
+        self.chunks.setdefault(trajectory, []).append((start, length, file_name))
+
+    def extend(self, trajectory: int = 0, state: Dict = None, **records):
+        """Append a batch of records (stacked along the first axis) as a new chunk, e.g. a chunk of a dataset
+
+        Args:
+            trajectory (int): the index of the trajectory. Defaults to 0.
+            state (Dict): arrays needed to resume the run after these records. Defaults to None.
+            records: one array per key, with the records along the first axis
+        """
+        self.flush(trajectory)
+        if state is not None:
+            self.states[trajectory] = {
+                key: np.asarray(value) for key, value in state.items()
+            }
+        self._write_chunk(
+            trajectory, {key: np.asarray(value) for key, value in records.items()}
+        )
+
+    def state(self, trajectory: int = 0) -> Dict[str, np.ndarray]:
+        """The resume state saved with the last chunk of the trajectory (empty if there is none)"""
+        if self.saved_length(trajectory) == 0:
+            return {}
+        _, _, file_name = self.chunks[trajectory][-1]
+        with np.load(os.path.join(self.path, file_name)) as data:
+            return {
+                key[len("state_") :]: data[key]
+                for key in data.files
+                if key.startswith("state_")
+            }
+
+    def load_trajectory(self, trajectory: int = 0) -> Dict[str, np.ndarray]:
+        """All the saved records of a trajectory, concatenated along the first axis"""
+        values: Dict[str, List] = {}
+        for _, _, file_name in self.chunks.get(trajectory, []):
+            with np.load(os.path.join(self.path, file_name)) as data:
+                for key in data.files:
+                    if not (key.startswith("state_")):
+                        values.setdefault(key, []).append(data[key])
+        return {key: np.concatenate(value, axis=0) for key, value in values.items()}
+
+    def load(self, length: int = None) -> Dict[str, np.ndarray]:
+        """The saved trajectories stacked as (trajectories x length x ...), zero padded to the longest one
+        (or to length if given), as in a preallocated array filled up to the saved records."""
+        trajectories = {q: self.load_trajectory(q) for q in self.chunks.keys()}
+        trajectories = {q: t for q, t in trajectories.items() if len(t) > 0}
+        if len(trajectories) == 0:
+            return {}
+        if length is None:
+            length = max(len(next(iter(t.values()))) for t in trajectories.values())
+        results = {}
+        for key, value in next(iter(trajectories.values())).items():
+            results[key] = np.zeros(
+                (max(trajectories.keys()) + 1, length) + value.shape[1:],
+                dtype=value.dtype,
+            )
+        for q, trajectory in trajectories.items():
+            for key, value in trajectory.items():
+                results[key][q, : value.shape[0]] = value[:length]
+        return results
+
+    def export_npz(
+        self, file_name: str, trajectory: int = None, length: int = None, **extra
+    ):
+        """Export the store (or a single trajectory) and the static arrays in a single .npz file"""
+        self.flush()
+        if trajectory is None:
+            arrays = self.load(length=length)
+        else:
+            arrays = self.load_trajectory(trajectory)
+        np.savez(file_name, **self.static(), **arrays, **extra)
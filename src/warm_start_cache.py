@@ -0,0 +1,126 @@
+import hashlib
+import os
+from collections import OrderedDict
+from typing import Dict, Optional, Tuple
+import numpy as np
+import torch.nn as nn
+
+
+def model_fingerprint(model: nn.Module) -> str:
+    """Hash of the class, the names and the values of the parameters and buffers of a model"""
+    digest = hashlib.sha1(type(model).__name__.encode())
+    for name, tensor in model.state_dict().items():
+        value = tensor.detach().cpu().contiguous().numpy()
+        digest.update(name.encode())
+        digest.update(str(value.dtype).encode())
+        digest.update(str(value.shape).encode())
+        digest.update(value.tobytes())
+    return digest.hexdigest()
+
+
+class WarmStartCache:
+    def __init__(
+        self,
+        path: Optional[str] = None,
+        resolution: float = 1e-3,
+        max_entries: int = 10000,
+        max_distance: Optional[float] = None,
+    ) -> None:
+        """Cache of the converged magnetizations of the ground state minimizations, keyed by the model
+        fingerprint and by the external field quantized with the given resolution.
+
+        get returns the magnetization of the same (quantized) field or, if there is none, the one of the nearest
+        field (rms distance per component, up to max_distance) minimized with the same model. A far field can be
+        in another phase, so the nearest guess is used only close to a cached one. The least recently
+        used entries are evicted beyond max_entries. The cache is loaded from path (a .npz file) if it exists and
+        save writes it back.
+
+        Args:
+            path (Optional[str]): the .npz file of the cache. Defaults to None (only in memory).
+            resolution (float): quantization of the field in the keys. Defaults to 1e-3.
+            max_entries (int): maximum number of entries. Defaults to 10000.
+            max_distance (Optional[float]): maximum rms distance of the fields of a nearest neighbour guess.
+            Defaults to None (10 * resolution).
+        """
+        self.path = path
+        self.resolution = resolution
+        self.max_entries = max_entries
+        self.max_distance = 10 * resolution if max_distance is None else max_distance
+
+        # (fingerprint, shape, quantized field) -> (field, magnetization), in order of use
+        self.entries: "OrderedDict[Tuple, Tuple[np.ndarray, np.ndarray]]" = (
+            OrderedDict()
+        )
+        self.hits = 0
+        self.nearest_hits = 0
+        self.misses = 0
+
+        if path is not None and os.path.exists(path):
+            self.load()
+
+    def key(self, h: np.ndarray, fingerprint: str) -> Tuple:
+        h = np.asarray(h, dtype=np.float64)
+        quantized = np.round(h / self.resolution).astype(np.int64)
+        return (fingerprint, h.shape, quantized.tobytes())
+
+    def get(self, h: np.ndarray, fingerprint: str) -> Optional[np.ndarray]:
+        """The cached magnetization of the field h (or of the nearest field), None if there is none"""
+        h = np.asarray(h, dtype=np.float64)
+        key = self.key(h, fingerprint)
+        if key in self.entries:
+            self.entries.move_to_end(key)
+            self.hits += 1
+            return self.entries[key][1].copy()
+
+        candidates = [
+            k for k in self.entries if k[0] == fingerprint and k[1] == h.shape
+        ]
+        if len(candidates) > 0:
+            fields = np.stack([self.entries[k][0].reshape(-1) for k in candidates])
+            distance = np.sqrt(np.mean((fields - h.reshape(1, -1)) ** 2, axis=-1))
+            nearest = int(np.argmin(distance))
+            if distance[nearest] <= self.max_distance:
+                self.entries.move_to_end(candidates[nearest])
+                self.nearest_hits += 1
+                return self.entries[candidates[nearest]][1].copy()
+        self.misses += 1
+        return None
+
+    def put(self, h: np.ndarray, fingerprint: str, m: np.ndarray):
+        """Store the converged magnetization m of the field h"""
+        h = np.asarray(h, dtype=np.float64)
+        key = self.key(h, fingerprint)
+        self.entries[key] = (h.copy(), np.asarray(m, dtype=np.float64).copy())
+        self.entries.move_to_end(key)
+        while len(self.entries) > self.max_entries:
+            self.entries.popitem(last=False)
+
+    def save(self):
+        """Write the cache (from the least to the most recently used entry) in path"""
+        if self.path is None:
+            return
+        arrays: Dict[str, np.ndarray] = {}
+        fingerprints = []
+        for k, ((fingerprint, _, _), (h, m)) in enumerate(self.entries.items()):
+            fingerprints.append(fingerprint)
+            arrays[f"field_{k}"] = h
+            arrays[f"magnetization_{k}"] = m
+        directory = os.path.dirname(self.path)
+        if directory != "":
+            os.makedirs(directory, exist_ok=True)
+        tmp = self.path + ".tmp"
+        with open(tmp, "wb") as f:
+            np.savez(
+                f,
+                fingerprint=np.asarray(fingerprints, dtype=str),
+                resolution=self.resolution,
+                **arrays,
+            )
+        os.replace(tmp, self.path)
+
+    def load(self):
+        with np.load(self.path) as data:
+            for k, fingerprint in enumerate(data["fingerprint"]):
+                self.put(
+                    data[f"field_{k}"], str(fingerprint), data[f"magnetization_{k}"]
+                )
@@ -6,7 +6,12 @@ import numpy as np
 import matplotlib.pyplot as plt
 from tqdm import trange, tqdm
 from src.training.models_adiabatic import EnergyReductionXXZXRespect2X
-from src.qutip_lab.qutip_class import SpinOperator, SpinHamiltonian, SteadyStateSolver
+from src.qutip_lab.qutip_class import (
+    SpinOperator,
+    SpinHamiltonian,
+    SteadyStateSolver,
+    GroundStateSolver,
+)
 
 from src.tddft_methods.kohm_sham_utils import (
     initialize_psi_from_z,
@@ -14,6 +19,7 @@ from src.tddft_methods.kohm_sham_utils import (
     compute_the_gradient_of_the_functional_ux_model,
 )
 from src.gradient_descent import GradientDescentKohmSham
+from src.trajectory_store import TrajectoryStore
 import qutip
 from typing import List
 import os
@@ -126,6 +132,9 @@ m_qutip_tot = np.append(
 # is the driving periodic?
 periodic = False
 
+# number of time steps between two chunks of the trajectory store
+checkpoint_every = 100
+
 # define the initial external field
 # zz x quench style (?)
 hi = torch.ones((2, l))
@@ -161,7 +170,20 @@ gd = GradientDescentKohmSham(
 zi = gd.run()
 zi = torch.from_numpy(zi)[0]
 
+if periodic:
+    file_name = f"data/kohm_sham_approach/results/tddft_periodic_uniform_zzxxzx_model_h_0_5_omega_0_2_ti_0_tf_{tf:.0f}_hi_{hi[0,0,0].item():.4f}_delta_{delta[0,0].item():.4f}_omegai_{hi[1,0].item():.1f}_delta_{delta[1,0].item():.1f}_steps_{steps}_self_consistent_steps_{self_consistent_step}_ndata_{ndata}_exp_{exponent_algorithm}"
+else:
+    file_name = f"data/kohm_sham_approach/results/dl_functional/zzxz_model/tddft_quench_uniform_model_h_0_2_omega_0_2_ti_0_tf_{tf:.0f}_hi_{hi[0,0].item():.1f}_hf_{hf[0,0].item():.1f}_steps_{steps}_self_consistent_steps_{self_consistent_step}_ndata_{ndata}_exp_{exponent_algorithm}"
+
+# the trajectories are saved in chunks of time steps and a run can be resumed
+store = TrajectoryStore(path=file_name + "_store", flush_every=checkpoint_every)
+store.write_static(rates=rates, time=time.detach().numpy())
+
+# sparse Lanczos ground state, warm started from the previous sample
+gs_solver = GroundStateSolver()
 for q, rate in enumerate(rates):
+    if store.saved_length(q) == time.shape[0] - 1:
+        continue
     # Qutip Dynamics
     # Hamiltonian
     ham0 = SpinHamiltonian(
@@ -178,8 +200,9 @@ for q, rate in enumerate(rates):
         index=[("z", i) for i in range(l)], coupling=hi[0].detach().numpy(), size=l
     )
 
-    eng, psi0 = np.linalg.eigh(ham0.qutip_op + hamExtZ.qutip_op + hamExtX.qutip_op)
-    psi0 = qutip.Qobj(psi0[:, 0], shape=psi0.shape, dims=([[2 for i in range(l)], [1]]))
+    eng, psi0 = gs_solver.ground_state(
+        ham0.qutip_op + hamExtZ.qutip_op + hamExtX.qutip_op
+    )
 
     print("real ground state energy=", eng[0])
     # to check if we have the same outcome with the Crank-Nicholson algorithm
@@ -277,8 +300,13 @@ for q, rate in enumerate(rates):
     psi = initialize_psi_from_z(z=-1 * zi)
     # psi = initialize_psi_from_xyz(z=-1 * zi[0], x=zi[1], y=torch.zeros_like(zi[1]))
 
+    # resume from the last chunk
+    start = store.saved_length(q)
+    if start > 0:
+        psi = torch.from_numpy(store.state(q)["psi"])
+
     t_bar = tqdm(enumerate(time))
-    for i in trange(time.shape[0] - 1):
+    for i in trange(start, time.shape[0] - 1):
         t = time[i]
 
         psi, omega_eff, h_eff, z = nonlinear_schrodinger_step_zzxz_model(
@@ -295,32 +323,22 @@ for q, rate in enumerate(rates):
         gradients_tot[q, i, 1, :] = -1 * omega_eff[0].detach().numpy()
         gradients_tot[q, i, 0, :] = -1 * h_eff[0].detach().numpy()
 
-        if periodic:
-            np.savez(
-                f"data/kohm_sham_approach/results/tddft_periodic_uniform_zzxxzx_model_h_0_5_omega_0_2_ti_0_tf_{tf:.0f}_hi_{hi[0,0,0].item():.4f}_delta_{delta[0,0].item():.4f}_omegai_{hi[1,0].item():.1f}_delta_{delta[1,0].item():.1f}_steps_{steps}_self_consistent_steps_{self_consistent_step}_ndata_{ndata}_exp_{exponent_algorithm}",
-                x_qutip=x_qutip_tot[:, :i],
-                z_qutip=z_qutip_tot[:, :i],
-                z=z_tot[:, :i],
-                x=x_tot[:, :i],
-                y=y_tot[:, :i],
-                y_qutip=y_qutip_tot[:, :i],
-                potential=h_tot[:, :i],
-                energy_x=eng_tot_x[:, :i],
-                energy_z=eng_tot_z[:, :i],
-                energy=eng_tot[:, :i],
-                energy_qutip=eng_qutip_tot[:, :i],
-                gradient=gradients_tot[:, :i],
-                rates=rates,
-                time=time[:i],
-            )
+        store.append(
+            trajectory=q,
+            state={"psi": psi.detach().numpy()},
+            x_qutip=x_qutip_tot[q, i],
+            z_qutip=z_qutip_tot[q, i],
+            z=z_tot[q, i],
+            x=x_tot[q, i],
+            y=y_tot[q, i],
+            y_qutip=y_qutip_tot[q, i],
+            potential=h_tot[q, i],
+            energy_x=eng_tot_x[q, i],
+            energy_z=eng_tot_z[q, i],
+            energy=eng_tot[q, i],
+            energy_qutip=eng_qutip_tot[q, i],
+            gradient=gradients_tot[q, i],
+        )
+    store.flush(q)
 
-        else:
-            np.savez(
-                f"data/kohm_sham_approach/results/dl_functional/zzxz_model/tddft_quench_uniform_model_h_0_2_omega_0_2_ti_0_tf_{tf:.0f}_hi_{hi[0,0].item():.1f}_hf_{hf[0,0].item():.1f}_steps_{steps}_self_consistent_steps_{self_consistent_step}_ndata_{ndata}_exp_{exponent_algorithm}",
-                z_qutip=z_qutip_tot[:, :i],
-                z=z_tot[:, :i],
-                potential=h_tot[:, :i],
-                gradient=gradients_tot[:, :i],
-                rates=rates,
-                time=time[:i],
-            )
+store.export_npz(file_name, length=steps)
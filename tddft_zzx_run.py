@@ -6,12 +6,19 @@ import numpy as np
 import matplotlib.pyplot as plt
 from tqdm import trange, tqdm
 from src.training.models_adiabatic import EnergyReductionXXZ
-from src.qutip_lab.qutip_class import SpinOperator, SpinHamiltonian, SteadyStateSolver
+from src.qutip_lab.qutip_class import (
+    SpinOperator,
+    SpinHamiltonian,
+    SteadyStateSolver,
+    GroundStateSolver,
+)
+from src.qutip_lab.qutip_evolution import ExactPropagator
 
 from src.tddft_methods.kohm_sham_utils import (
     initialize_psi_from_z,
     nonlinear_schrodinger_step_zzx_model_full_effective_field,
     get_effective_field,
+    get_effective_field_stream,
 )
 from src.gradient_descent import GradientDescentKohmSham
 import qutip
@@ -140,6 +147,9 @@ ham0 = SpinHamiltonian(
 
 obs: List[qutip.Qobj] = []
 current_obs: List[qutip.Qobj] = []
+# the same observables as SpinOperator (for the bitmask expectation values)
+spin_obs: List[SpinOperator] = []
+spin_current_obs: List[SpinOperator] = []
 for i in range(l):
     z_op = SpinOperator(index=[("z", i)], coupling=[1.0], size=l, verbose=1)
     # print(f"x[{i}]=", x.qutip_op, "\n")
@@ -150,12 +160,20 @@ for i in range(l):
     )
     obs.append(z_op.qutip_op)
     current_obs.append(current.qutip_op)
+    spin_obs.append(z_op)
+    spin_current_obs.append(current)
 
 time_stop = 500
 
 # %% Compute the initial ground state configuration
 
 print('ITS OK!')
+# sparse Lanczos ground state, warm started from the previous sample
+gs_solver = GroundStateSolver()
+# Krylov propagator of H = ham0 + sum_i h_i(t) z_i
+exact_propagator = ExactPropagator(
+    ham0.qutip_op, drivings=obs, e_ops=spin_obs + spin_current_obs
+)
 for q in range(nbatch):
     # Qutip Dynamics
     # Hamiltonian
@@ -163,8 +181,7 @@ for q in range(nbatch):
 
     hamExtZ = SpinOperator(index=[("z", i) for i in range(l)], coupling=h[0], size=l)
 
-    eng, psi0 = np.linalg.eigh(ham0.qutip_op + hamExtZ.qutip_op)
-    psi0 = qutip.Qobj(psi0[:, 0], shape=psi0.shape, dims=([[2 for i in range(l)], [1]]))
+    eng, psi0 = gs_solver.ground_state(ham0.qutip_op + hamExtZ.qutip_op)
 
     print("real ground state energy=", eng[0])
     # to check if we have the same outcome with the Crank-Nicholson algorithm
@@ -178,48 +195,24 @@ for q in range(nbatch):
     #         psi0 = qutip.tensor(psi0, psi_l)
     # compute and check the magnetizations
 
-    # build up the time dependent object for the qutip evolution
-    hamiltonian = [ham0.qutip_op]
-
-    for i in range(l):
-        drive_z = Driving(
-            h=h,
-            dt=time[1] - time[0],
-            idx=i,
-        )
-
-        hamiltonian.append([obs[i], drive_z.field])
-
-    # evolution and
-
-    output = qutip.sesolve(hamiltonian, psi0, time, e_ops=obs + current_obs)
+    # exact evolution with the field piecewise constant on the time grid
+    expect, _ = exact_propagator.evolve(psi0, time, h)
 
     current_exp = np.zeros((steps, l))
     z_exp = np.zeros_like(current_exp)
     for r in range(l):
-        z_exp[:, r] = output.expect[r]
-        current_exp[:, r] = output.expect[l + r]
+        z_exp[:, r] = expect[r]
+        current_exp[:, r] = expect[l + r]
 
     # get the full field
     heff_1stversion = torch.zeros_like(torch.tensor(z_exp))
 
-    z_vector = torch.tensor(z_exp[0]).unsqueeze(0)
-    
+    # streaming evaluation of the causal model, one time slice at a time
+    model.reset_stream()
     for i in trange(time_stop):
-
-        if i == 0:
-
-            heff_1stversion[i] = get_effective_field(z=(z_vector), model=model, i=-1)
-            z_vector = torch.cat(
-                (z_vector, torch.tensor(z_exp[i + 1]).unsqueeze(0)), dim=0
-            )
-        if i != 0:
-            heff_1stversion[i] = get_effective_field(z=z_vector, model=model, i=-1)
-
-            if i != time_stop - 1:
-                z_vector = torch.cat(
-                    (z_vector, torch.tensor(z_exp[i + 1]).unsqueeze(0)), dim=0
-                )
+        heff_1stversion[i] = get_effective_field_stream(
+            z=torch.tensor(z_exp[i]).unsqueeze(0), model=model
+        )[0]
 
     input = torch.einsum("ti->it", torch.tensor(z_exp[:time_stop]))
     heff = model(input.unsqueeze(0)).detach().squeeze()
@@ -231,7 +224,10 @@ for q in range(nbatch):
     )
     h_eff_exact = (0.25 * current_derivative + z_exp) / (x_sp + 10**-4) - h
     zi = torch.tensor(z_exp[0, :])  # initial magnetization
-    z_evolution = zi.clone().unsqueeze(0)  # initialize the evolution
+    # preallocated evolution of z (time x size)
+    z_evolution = torch.zeros((time_stop, l), dtype=torch.double)
+    z_evolution[0] = zi
+    model.reset_stream()
     #  Kohm Sham step 1) Initialize the state from an initial magnetization
 
     # psi = initialize_psi_from_xyz(z=-1 * zi[0], x=zi[1], y=torch.zeros_like(zi[1]))
@@ -241,26 +237,28 @@ for q in range(nbatch):
 
     h_eff = torch.zeros((time_stop, l))
     t_bar = tqdm(enumerate(time))
+    print("H SHAPE=", h.shape)
+    h_time_stop = torch.tensor(h[:time_stop])
     for i in trange(time_stop - 1):
         t = time[i]
-        print("H SHAPE=", h.shape)
         psi, df, z_evolution = (
             nonlinear_schrodinger_step_zzx_model_full_effective_field(
                 psi=psi,
                 model=model,
                 i=i,
-                h=torch.tensor(h[:time_stop]) ,
-                full_z=z_evolution,  # full z in size x time
+                h=h_time_stop,
+                full_z=z_evolution,  # full z in time x size
                 self_consistent_step=self_consistent_step,
                 dt=dt,
                 exponent_algorithm=exponent_algorithm,
+                streaming=True,
                 #    dataset_z=torch.tensor(dataset_z),
             )
         )
         h_eff[i] = df
 
         z_qutip_tot[q, i, :] = z_exp[i]
-        z_tot[q, i, :] = z_evolution.detach().numpy()
+        z_tot[q, i, :] = z_evolution[i].detach().numpy()
         h_eff_tot[q, i, :] = h_eff
         h_tot[q, i, :] = h[i]
         h_eff_tot_exact[q, i, :] = h_eff_exact[i, :]
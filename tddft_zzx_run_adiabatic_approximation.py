@@ -6,7 +6,12 @@ import numpy as np
 import matplotlib.pyplot as plt
 from tqdm import trange, tqdm
 from src.training.models_adiabatic import EnergyReductionXXZ
-from src.qutip_lab.qutip_class import SpinOperator, SpinHamiltonian, SteadyStateSolver
+from src.qutip_lab.qutip_class import (
+    SpinOperator,
+    SpinHamiltonian,
+    SteadyStateSolver,
+    GroundStateSolver,
+)
 
 from src.tddft_methods.kohm_sham_utils import (
     initialize_psi_from_z,
@@ -129,6 +134,8 @@ gd = GradientDescentKohmSham(
 zi = gd.run()
 zi = torch.from_numpy(zi)[0]
 
+# sparse Lanczos ground state, warm started from the previous sample
+gs_solver = GroundStateSolver()
 for q, rate in enumerate(rates):
     # Qutip Dynamics
     # Hamiltonian
@@ -143,8 +150,7 @@ for q, rate in enumerate(rates):
         index=[("z", i) for i in range(l)], coupling=hi.detach().numpy(), size=l
     )
 
-    eng, psi0 = np.linalg.eigh(ham0.qutip_op + hamExtZ.qutip_op)
-    psi0 = qutip.Qobj(psi0[:, 0], shape=psi0.shape, dims=([[2 for i in range(l)], [1]]))
+    eng, psi0 = gs_solver.ground_state(ham0.qutip_op + hamExtZ.qutip_op)
 
     print("real ground state energy=", eng[0])
     # to check if we have the same outcome with the Crank-Nicholson algorithm
@@ -0,0 +1,80 @@
+# %% Check of KohmShamPropagator.run_adaptive against a fine fixed step reference
+# A quench with a random (z,x) functional, reported on a coarse output grid. The reference is run
+# with a fixed dt 40 times smaller than the output spacing and a converged corrector.
+import torch
+import torch.nn as nn
+from src.training.models_adiabatic import EnergyXXZX
+from src.tddft_methods.kohm_sham_utils import initialize_psi_from_z, quench_field
+from src.tddft_methods.kohm_sham_propagator import (
+    KohmShamPropagator,
+    interpolate_field,
+)
+
+
+class Functional(nn.Module):
+    def __init__(self) -> None:
+        super().__init__()
+        self.conv = nn.Sequential(
+            nn.Conv1d(2, 20, 3, padding=1, padding_mode="circular"),
+            nn.Tanh(),
+            nn.Conv1d(20, 1, 3, padding=1, padding_mode="circular"),
+        )
+
+    def forward(self, z: torch.Tensor):
+        return 3 * self.conv(z)[:, 0].squeeze(0)
+
+
+torch.manual_seed(0)
+l = 8
+rates = [0.5, 4.0]
+energy = EnergyXXZX(model=Functional().double())
+energy.eval()
+
+h_i = 0.5 + 0.1 * torch.rand((2, l), dtype=torch.double)
+h_f = 1.5 + 0.1 * torch.rand((2, l), dtype=torch.double)
+psi0 = initialize_psi_from_z(z=0.8 * torch.rand(l, dtype=torch.double) - 0.4)
+psi = psi0.unsqueeze(0).repeat(len(rates), 1, 1)
+
+# output grid and fine reference grid
+tf = 4.0
+time = torch.linspace(0, tf, 21, dtype=torch.double)
+refinement = 40
+time_fine = torch.linspace(
+    0, tf, (time.shape[0] - 1) * refinement + 1, dtype=torch.double
+)
+h = torch.stack([quench_field(h_i, h_f, rate, time) for rate in rates])
+# the adaptive run interpolates h linearly between the output times, and so does the reference
+h_fine = torch.stack([interpolate_field(h, time, t.item()) for t in time_fine], dim=1)
+
+reference = KohmShamPropagator(
+    energy=energy,
+    dt=(time_fine[1] - time_fine[0]).item(),
+    self_consistent_step=20,
+    tolerance=1e-12,
+).run(psi=psi.clone(), h=h_fine)
+z_reference = reference["z"][:, ::refinement]
+x_reference = reference["x"][:, ::refinement]
+
+for tolerance in [1e-3, 1e-4, 1e-5]:
+    propagator = KohmShamPropagator(energy=energy, dt=0.1, self_consistent_step=10)
+    results = propagator.run_adaptive(
+        psi=psi.clone(),
+        h=h,
+        time=time,
+        tolerance=tolerance,
+        field_tolerance=1e-10,
+    )
+    error = max(
+        (results["z"] - z_reference).abs().max().item(),
+        (results["x"] - x_reference).abs().max().item(),
+    )
+    print(
+        f"tolerance={tolerance:.0e}: max error={error:.2e}, "
+        f"accepted={propagator.stats['accepted_steps']}, "
+        f"rejected={propagator.stats['rejected_steps']}, "
+        f"functional calls={propagator.stats['functional_calls']} "
+        f"(reference {reference['sc_iterations'].sum().item() + time_fine.shape[0] - 1})"
+    )
+    assert error < 10 * tolerance
+
+# %%
@@ -0,0 +1,105 @@
+# %% Check of the batched mode of GradientDescent (_batched_gradient_descent) against the per instance loop
+# The instances (x ensambles) of a batch are minimized in a single batch of the energy functional: the
+# minimum energies, magnetizations, gradients and histories must be the ones of the loop over the instances,
+# with a batch that does not divide the number of instances
+import contextlib
+import io
+import os
+import tempfile
+import time
+import numpy as np
+import torch
+import torch.nn as nn
+from src.gradient_descent import GradientDescent
+from src.training.models_adiabatic import EnergyXXZX
+
+
+class Functional(nn.Module):
+    def __init__(self) -> None:
+        super().__init__()
+        self.conv = nn.Sequential(
+            nn.Conv1d(3, 8, 3, padding=1, padding_mode="circular"),
+            nn.Tanh(),
+            nn.Conv1d(8, 1, 3, padding=1, padding_mode="circular"),
+        )
+
+    def forward(self, z: torch.Tensor):
+        return self.conv(z)[:, 0].squeeze(0)
+
+
+torch.manual_seed(0)
+np.random.seed(0)
+l, n_instances, epochs = 8, 5, 300
+energy = EnergyXXZX(model=Functional().double())
+n_init = np.random.uniform(-0.9, 0.9, (10000, 3, l))
+
+with tempfile.TemporaryDirectory() as tmp:
+    target_path = os.path.join(tmp, "target.npz")
+    np.savez(
+        target_path,
+        density=np.random.uniform(-1, 1, (n_instances, 3, l)),
+        potential=np.random.uniform(0, 1, (n_instances, 3, l)),
+        energy=np.random.rand(n_instances),
+    )
+
+    # (n_ensambles, early_stopping, logdiffsoglia, optimizer)
+    for n_ensambles, early_stopping, logdiffsoglia, optimizer in [
+        (1, False, -2, "gd"),
+        (1, True, -2, "gd"),
+        (3, False, -10, "gd"),
+        (3, True, -10, "gd"),
+        (3, False, -10, "lbfgs"),
+    ]:
+        results = {}
+        for batched in [False, True]:
+            gd = GradientDescent(
+                n_instances=n_instances,
+                loglr=-2,
+                cut=2,
+                logdiffsoglia=logdiffsoglia,
+                n_ensambles=n_ensambles,
+                target_path=target_path,
+                energy=energy,
+                run_name="check",
+                epochs=epochs,
+                variable_lr=True,
+                final_lr=1e-3,
+                early_stopping=early_stopping,
+                L=l,
+                resolution=1,
+                seed=3,
+                num_threads=1,
+                device="cpu",
+                n_init=n_init,
+                save=False,
+                batched=batched,
+                instances_per_batch=2,
+                optimizer=optimizer,
+            )
+            start = time.perf_counter()
+            with contextlib.redirect_stdout(io.StringIO()):
+                with contextlib.redirect_stderr(io.StringIO()):
+                    gd.run()
+            elapsed = time.perf_counter() - start
+            epoch = epochs - 1
+            results[batched] = (
+                [
+                    gd.min_engs[epoch],
+                    gd.min_ns[epoch],
+                    gd.grads[epoch],
+                    gd.min_hist[epoch],
+                ],
+                elapsed,
+            )
+        error = max(
+            np.abs(single - batch).max()
+            for single, batch in zip(results[False][0], results[True][0])
+        )
+        print(
+            f"{n_ensambles} ensambles, early stopping={early_stopping}, {optimizer}: "
+            f"batched vs per instance max error={error:.1e} "
+            f"({results[False][1]:.2f} s vs {results[True][1]:.2f} s)"
+        )
+        assert error < 1e-10
+
+# %%
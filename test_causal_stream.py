@@ -0,0 +1,106 @@
+# %% Check of the streaming evaluation (reset_stream/stream) of the causal effective field models
+# stream over the T slices of a history must give, at each time t, the effective field (batch x size) of the
+# last time index of forward on the history up to t. Trial slices (commit=False) must not enter the history.
+# UnetLSTM normalizes with the statistics of the whole input in forward, so it is compared with forward on the
+# whole history, streamed with the same normalization constants.
+import torch
+import torch.nn as nn
+from src.training.models import TDDFTCNNNoMemory, LSTMTDDFT
+from src.training.pixel_model import PixelCNN
+from src.training.unet_recurrent import UnetLSTM
+
+
+def cnn_forward(model, history):
+    # history (batch x T x size) -> effective field at the last time (batch x size)
+    return model(torch.einsum("bti->bit", history))[:, 0, :, -1]
+
+
+def pixel_forward(model, history):
+    # history (batch x T x 2 x size)
+    y = model(torch.einsum("btci->bcit", history))
+    return y.reshape(history.shape[0], history.shape[-1], -1)[..., -1]
+
+
+def lstm_forward(model, history):
+    return model(history)[0][:, -1]
+
+
+torch.manual_seed(0)
+batch, steps, l = 3, 12, 8
+z = torch.rand((batch, steps, l), dtype=torch.double)
+zh = torch.rand((batch, steps, 2, l), dtype=torch.double)
+
+models = {
+    "TDDFTCNNNoMemory": (
+        TDDFTCNNNoMemory(
+            in_channels=1,
+            hidden_channels=[5, 5, 5],
+            out_channels=1,
+            ks=[3, 3],
+            padding_mode="circular",
+            Activation=nn.GELU(),
+        ),
+        z,
+        cnn_forward,
+    ),
+    "PixelCNN": (
+        PixelCNN(
+            in_channels=1,
+            hidden_channels=[5, 5, 5],
+            out_channels=1,
+            ks=[3, 3],
+            padding_mode="circular",
+            Activation=nn.GELU(),
+        ),
+        zh,
+        pixel_forward,
+    ),
+    "LSTMTDDFT": (
+        LSTMTDDFT(input_size=[l], hidden_size=10, num_layers=2, dropout=0.0, loss=None),
+        z,
+        lstm_forward,
+    ),
+    "UnetLSTM": (
+        UnetLSTM(
+            activation=nn.GELU(),
+            hc=[4, 4],
+            in_channels=1,
+            out_channels=1,
+            kernel_size=3,
+            latent_dimension=6,
+            n_layers=1,
+            hidden_neurons=10,
+            input_size=l,
+            Loss=None,
+            lstm_layers=1,
+        ),
+        z,
+        None,
+    ),
+}
+
+for name, (model, history, forward) in models.items():
+    model = model.double().eval()
+    if name == "UnetLSTM":
+        model.reset_stream(mean=history.mean().item(), std=history.std().item())
+        with torch.no_grad():
+            reference = model(history)
+    else:
+        model.reset_stream()
+
+    error = 0.0
+    for t in range(steps):
+        with torch.no_grad():
+            # a trial slice, as in the corrector loop, then the committed one
+            model.stream(torch.rand_like(history[:, t]), commit=False)
+            field = model.stream(history[:, t])
+            if name == "UnetLSTM":
+                expected = reference[:, t]
+            else:
+                expected = forward(model, history[:, : t + 1])
+        assert field.shape == (batch, l), (name, field.shape)
+        error = max(error, (field - expected).abs().max().item())
+    print(f"{name}: stream vs forward over {steps} slices, max error={error:.2e}")
+    assert error < 1e-12
+
+# %%
@@ -0,0 +1,89 @@
+# %% Check of the compiled energy and gradient path (EnergyGradient) of the Kohm-Sham steps
+# A small random (z,x) functional replaces the trained one: nonlinear_ensamble_schrodinger_step
+# (the step of ensamble_tddft_run.py) must give the same evolution with compiled=True and False,
+# and the latency of a single evaluation of the effective fields is compared with the current path.
+import torch
+import torch.nn as nn
+from src.training.models_adiabatic import EnergyXXZX
+from src.tddft_methods.kohm_sham_utils import (
+    initialize_psi_from_z,
+    compute_the_magnetization,
+    nonlinear_ensamble_schrodinger_step,
+    benchmark_effective_fields,
+)
+
+
+class ConvFunctional(nn.Module):
+    def __init__(self, hidden_channels: int = 40, n_layers: int = 4) -> None:
+        super().__init__()
+        layers = []
+        for k in range(n_layers):
+            layers.append(
+                nn.Conv1d(
+                    2 if k == 0 else hidden_channels,
+                    hidden_channels,
+                    3,
+                    padding=1,
+                    padding_mode="circular",
+                )
+            )
+            layers.append(nn.GELU())
+        layers.append(
+            nn.Conv1d(hidden_channels, 1, 3, padding=1, padding_mode="circular")
+        )
+        self.conv = nn.Sequential(*layers)
+
+    def forward(self, z: torch.Tensor):
+        return self.conv(z)[:, 0].squeeze(0)
+
+
+torch.manual_seed(0)
+l = 8
+energy = EnergyXXZX(model=ConvFunctional().double())
+energy.eval()
+
+steps = 20
+dt = 0.05
+h = 0.5 + 0.1 * torch.rand((steps, 2, l), dtype=torch.double)
+psi = initialize_psi_from_z(z=0.8 * torch.rand(l, dtype=torch.double) - 0.4)
+
+results = {}
+for compiled in [False, True]:
+    psis = [psi.clone(), torch.conj(psi)]
+    magnetizations = []
+    for i in range(steps - 1):
+        psis, omega_eff, h_eff, eng, x, y, z = nonlinear_ensamble_schrodinger_step(
+            psis=psis,
+            energy=energy,
+            i=i,
+            h=h,
+            self_consistent_step=2,
+            dt=dt,
+            eta=None,
+            exponent_algorithm=True,
+            compiled=compiled,
+        )
+        magnetizations.append(torch.stack((x, y, z, omega_eff[0], h_eff[0])))
+    results[compiled] = torch.stack(magnetizations)
+
+# the magnetizations of the step are the ensamble averages of (x, y, z)
+x0, y0, z0 = compute_the_magnetization(psi=psi)
+x1, y1, z1 = compute_the_magnetization(psi=torch.conj(psi))
+assert torch.allclose(results[False][0, 0], 0.5 * (x0 + x1))
+assert torch.allclose(results[False][0, 2], 0.5 * (z0 + z1))
+
+error = (results[True] - results[False]).abs().max().item()
+print(f"ensamble step, compiled vs current: max error={error:.2e}")
+assert error < 1e-10
+
+# %% per step latency of the effective fields (1 x 2 x l input of the time loop)
+m = torch.rand((1, 2, l), dtype=torch.double)
+for name, result in benchmark_effective_fields(
+    m=m, h=h[:1], energy=energy, n_steps=1000
+).items():
+    print(
+        f"{name}: first call={result['first_call_s']:.3f} s, "
+        f"median={result['median_us']:.1f} us, grad error={result['max_grad_error']:.1e}"
+    )
+
+# %%
@@ -0,0 +1,152 @@
+# %% Check of the preallocated results of GradientDescent.checkpoints and of their store
+# 1) the buffers, the store data/gd_data/results_<session> and the eng_, density_ and history_ files
+# agree, with a chunk every flush_every instances
+# 2) an interrupted run leaves the results of the instances flushed so far
+# 3) a second run of the same session replaces the results of the first one
+import glob
+import os
+import tempfile
+import numpy as np
+import torch
+import torch.nn as nn
+from src.gradient_descent import GradientDescent
+from src.trajectory_store import TrajectoryStore
+from src.training.models_adiabatic import EnergyXXZX
+
+
+class Functional(nn.Module):
+    def __init__(self) -> None:
+        super().__init__()
+        self.conv = nn.Sequential(
+            nn.Conv1d(3, 8, 3, padding=1, padding_mode="circular"),
+            nn.Tanh(),
+            nn.Conv1d(8, 1, 3, padding=1, padding_mode="circular"),
+        )
+
+    def forward(self, z: torch.Tensor):
+        return self.conv(z)[:, 0].squeeze(0)
+
+
+class Interrupted(Exception):
+    pass
+
+
+torch.manual_seed(0)
+np.random.seed(0)
+l, n_instances, flush_every = 8, 7, 3
+energy = EnergyXXZX(model=Functional().double())
+n_init = np.random.uniform(-0.9, 0.9, (10000, 3, l))
+
+
+def make_gd(seed: int, stop: int = None) -> GradientDescent:
+    gd = GradientDescent(
+        n_instances=n_instances,
+        loglr=-2,
+        cut=2,
+        logdiffsoglia=-10,
+        n_ensambles=2,
+        target_path="target.npz",
+        energy=energy,
+        run_name="check",
+        epochs=300,
+        variable_lr=False,
+        final_lr=1e-3,
+        early_stopping=False,
+        L=l,
+        resolution=1,
+        seed=seed,
+        num_threads=1,
+        device="cpu",
+        n_init=n_init,
+        save=True,
+        flush_every=flush_every,
+    )
+    if stop is not None:
+        # the run is killed after the instance stop
+        checkpoints = gd.checkpoints
+
+        def interrupted_checkpoints(**kwargs):
+            checkpoints(**kwargs)
+            if kwargs["idx"] == stop:
+                raise Interrupted
+
+        gd.checkpoints = interrupted_checkpoints
+    return gd
+
+
+def saved_results():
+    """The results in the store and in the eng_, density_ and history_ files"""
+    (path,) = glob.glob("data/gd_data/results_check*")
+    session = os.path.basename(path)[len("results_") :]
+    store = TrajectoryStore(path=path).load_trajectory(0)
+    eng = np.load(f"data/gd_data/eng_{session}.npz")
+    density = np.load(f"data/gd_data/density_{session}.npz")
+    history = np.load(f"data/gd_data/history_{session}.npz")
+    return store, eng, density, history
+
+
+def check(gd: GradientDescent, n_results: int):
+    epoch = gd.epochs - 1
+    store, eng, density, history = saved_results()
+    results = {
+        "min_energy": gd.min_engs[epoch][:n_results],
+        "min_density": gd.min_ns[epoch][:n_results],
+        "gradient": gd.grads[epoch][:n_results],
+        "history": gd.min_hist[epoch][:n_results],
+    }
+    for key, value in results.items():
+        assert np.array_equal(store[key], value), key
+    assert np.array_equal(eng["min_energy"], results["min_energy"])
+    assert np.array_equal(eng["gs_energy"], gd.e_target[:n_results])
+    assert np.array_equal(
+        density["min_density"], results["min_density"].reshape(-1, l)
+    )
+    assert np.array_equal(density["gradient"], results["gradient"].reshape(-1, l))
+    assert np.array_equal(history["history"], results["history"])
+    return store["min_energy"]
+
+
+with tempfile.TemporaryDirectory() as tmp:
+    cwd = os.getcwd()
+    os.chdir(tmp)
+    os.makedirs("data/gd_data")
+    np.savez(
+        "target.npz",
+        density=np.random.uniform(-1, 1, (n_instances, 3, l)),
+        potential=np.random.uniform(0, 1, (n_instances, 3, l)),
+        energy=np.random.rand(n_instances),
+    )
+    try:
+        # 1) complete run
+        gd = make_gd(seed=1)
+        gd.run()
+        min_energy = check(gd, n_instances)
+        chunks = [length for _, length, _ in gd.results_store.chunks[0]]
+        print(f"complete run: chunks of {chunks} instances, min_energy={min_energy}")
+        assert chunks == [3, 3, 1]
+
+        # each row is the result of its instance alone
+        single = make_gd(seed=1)
+        single.n_instances = 1
+        single.save = False
+        single.run()
+        assert single.min_engs[299][0] == gd.min_engs[299][0]
+
+        # 2) interrupted run (another seed) after the instance 4
+        gd = make_gd(seed=2, stop=4)
+        try:
+            gd.run()
+        except Interrupted:
+            pass
+        min_energy = check(gd, 3)
+        print(f"run interrupted after 5 instances: saved min_energy={min_energy}")
+
+        # 3) the same session again with the seed of the interrupted run
+        gd = make_gd(seed=2)
+        gd.run()
+        min_energy = check(gd, n_instances)
+        print(f"run again: min_energy={min_energy}")
+    finally:
+        os.chdir(cwd)
+
+# %%
@@ -0,0 +1,82 @@
+# %% Check of the batched KohmShamPropagator against the single trajectory nonlinear_schrodinger_step
+# R quenches with different rates are evolved in a single batch and one by one, with a random (z,x) functional
+import torch
+import torch.nn as nn
+from src.training.models_adiabatic import EnergyXXZX
+from src.tddft_methods.kohm_sham_utils import (
+    initialize_psi_from_z,
+    compute_the_magnetization,
+    nonlinear_schrodinger_step,
+    quench_field,
+)
+from src.tddft_methods.kohm_sham_propagator import KohmShamPropagator
+
+
+class Functional(nn.Module):
+    def __init__(self) -> None:
+        super().__init__()
+        self.conv = nn.Sequential(
+            nn.Conv1d(2, 20, 3, padding=1, padding_mode="circular"),
+            nn.Tanh(),
+            nn.Conv1d(20, 1, 3, padding=1, padding_mode="circular"),
+        )
+
+    def forward(self, z: torch.Tensor):
+        return 3 * self.conv(z)[:, 0].squeeze(0)
+
+
+torch.manual_seed(0)
+l = 8
+dt = 0.05
+time = torch.linspace(0, 2, 41, dtype=torch.double)
+rates = [0.5, 1.0, 2.0, 4.0]
+energy = EnergyXXZX(model=Functional().double())
+energy.eval()
+
+h_i = 0.5 + 0.1 * torch.rand((2, l), dtype=torch.double)
+h_f = 1.5 + 0.1 * torch.rand((2, l), dtype=torch.double)
+# drivings of all the rates (R x time x channels x size) and the initial states (R x 2 x size)
+h = torch.stack([quench_field(h_i, h_f, rate, time) for rate in rates])
+psi0 = initialize_psi_from_z(z=0.8 * torch.rand(l, dtype=torch.double) - 0.4)
+psi = psi0.unsqueeze(0).repeat(len(rates), 1, 1)
+
+for self_consistent_step in [0, 2]:
+    propagator = KohmShamPropagator(
+        energy=energy, dt=dt, self_consistent_step=self_consistent_step
+    )
+    results = propagator.run(psi=psi.clone(), h=h)
+
+    error = 0.0
+    for q in range(len(rates)):
+        psi_q = psi0.clone()
+        for i in range(time.shape[0] - 1):
+            x, _, z = compute_the_magnetization(psi=psi_q)
+            error = max(
+                error,
+                (results["z"][q, i] - z).abs().max().item(),
+                (results["x"][q, i] - x).abs().max().item(),
+            )
+            psi_q, omega_eff, h_eff, eng, _, _, _ = nonlinear_schrodinger_step(
+                psi=psi_q,
+                energy=energy,
+                i=i,
+                h=h[q],
+                self_consistent_step=self_consistent_step,
+                dt=dt,
+                eta=None,
+                exponent_algorithm=True,
+            )
+            error = max(
+                error,
+                (results["omega_eff"][q, i] - omega_eff[0]).abs().max().item(),
+                (results["h_eff"][q, i] - h_eff[0]).abs().max().item(),
+            )
+        x, _, z = compute_the_magnetization(psi=psi_q)
+        error = max(error, (results["z"][q, -1] - z).abs().max().item())
+    print(
+        f"{len(rates)} rates, {self_consistent_step} corrector steps: "
+        f"batch vs single trajectories max error={error:.2e}"
+    )
+    assert error < 1e-12
+
+# %%
@@ -0,0 +1,92 @@
+# %% Check of the L-BFGS minimizer (BatchedLBFGS) of the ground state search
+# 1) a batch of random convex quadratics, each row with its own exact minimum
+# 2) GradientDescentKohmSham with optimizer="lbfgs" reaches the minimum of a long fixed lr gradient descent
+# with a small random functional in place of the trained one
+import contextlib
+import io
+import numpy as np
+import torch
+import torch.nn as nn
+from src.minimizers import BatchedLBFGS
+from src.gradient_descent import GradientDescentKohmSham, energy_and_gradient
+from src.training.models_adiabatic import EnergyXXZX
+
+
+class Functional(nn.Module):
+    def __init__(self) -> None:
+        super().__init__()
+        self.conv = nn.Sequential(
+            nn.Conv1d(3, 8, 3, padding=1, padding_mode="circular"),
+            nn.Tanh(),
+            nn.Conv1d(8, 1, 3, padding=1, padding_mode="circular"),
+        )
+
+    def forward(self, z: torch.Tensor):
+        return self.conv(z)[:, 0].squeeze(0)
+
+
+torch.manual_seed(0)
+np.random.seed(0)
+
+# 1) quadratics 0.5 x^T A x - b^T x (rows x n)
+rows, n = 6, 16
+q = torch.randn((rows, n, n), dtype=torch.double)
+a = q @ q.transpose(1, 2) + n * torch.eye(n, dtype=torch.double)
+b = torch.randn((rows, n), dtype=torch.double)
+
+
+def quadratic(x: torch.Tensor, idx: torch.Tensor):
+    ax = torch.einsum("rij,rj->ri", a[idx], x)
+    return (0.5 * (x * ax).sum(-1) - (b[idx] * x).sum(-1)), ax - b[idx]
+
+
+minimizer = BatchedLBFGS(gradient_tolerance=1e-8)
+x, eng, grad, _ = minimizer.minimize(
+    quadratic, torch.zeros((rows, n), dtype=torch.double)
+)
+x_exact = torch.linalg.solve(a, b)
+error = (x - x_exact).abs().max().item()
+print(f"quadratics: max error={error:.2e}, iterations={minimizer.iterations.tolist()}")
+assert error < 1e-8
+
+# 2) ground state of a random functional
+l = 8
+energy = EnergyXXZX(model=Functional().double())
+energy.eval()
+h = np.random.uniform(0, 1, (3, l))
+results = {}
+for optimizer, epochs in [("gd", 20000), ("lbfgs", 1000)]:
+    gd = GradientDescentKohmSham(
+        loglr=-1,
+        energy=energy,
+        epochs=epochs,
+        seed=1,
+        num_threads=1,
+        device="cpu",
+        n_init=np.full((3, l), 0.3),
+        h=h,
+        optimizer=optimizer,
+    )
+    with contextlib.redirect_stdout(io.StringIO()), contextlib.redirect_stderr(
+        io.StringIO()
+    ):
+        m = gd.run()
+    eng, grad = energy_and_gradient(
+        energy, torch.acos(torch.tensor(m)), torch.tensor(h).unsqueeze(0)
+    )
+    iterations = epochs if gd.minimizer is None else gd.minimizer.iterations[0].item()
+    results[optimizer] = (np.asarray(m), eng.item())
+    print(
+        f"{optimizer}: energy={eng.item():.10f}, "
+        f"max gradient={grad.abs().max().item():.1e}, iterations={iterations}"
+    )
+
+energy_error = abs(results["gd"][1] - results["lbfgs"][1])
+m_error = np.abs(results["gd"][0] - results["lbfgs"][0]).max()
+print(
+    f"lbfgs vs gd: energy error={energy_error:.2e}, magnetization error={m_error:.2e}"
+)
+assert energy_error < 1e-8
+assert m_error < 1e-4
+
+# %%
@@ -0,0 +1,84 @@
+# %% Check of the memory mapped data loader of make_data_loader_unet (npz_to_npy + MemmapDataset)
+# The train/valid batches must contain exactly the samples of the old loader, which loaded the whole .npz file
+# in tensors, permuted them and sliced the train/valid sets (same seed, so the same permutation)
+import os
+import tempfile
+import numpy as np
+import torch as pt
+from src.training.utils import make_data_loader_unet
+
+
+def old_data_sets(file_name, split, keys, time_interval, preprocessing):
+    """The train/valid tensors of the old make_data_loader_unet (in memory)"""
+    data = np.load(file_name)
+    k1 = pt.tensor(data[keys[0]])
+    k2 = pt.tensor(data[keys[1]])
+
+    p = np.random.permutation(np.arange(k1.shape[0]))
+    k1 = k1[p]
+    k2 = k2[p]
+    n_train = int(k1.shape[0] * split)
+    if preprocessing:
+        x = k1.view(k1.shape[0], k1.shape[-1], k1.shape[1])[:, :, :time_interval]
+        y = k2.view(k2.shape[0], k2.shape[-1], k2.shape[1])[:, :, :time_interval]
+    else:
+        x = k1[:, :time_interval]
+        y = k2[:, :time_interval]
+    return (x[:n_train], y[:n_train]), (x[n_train:], y[n_train:])
+
+
+def collect(dl):
+    """All the samples of a loader, sorted by their first entry"""
+    xs, ys = zip(*list(dl))
+    x, y = pt.cat(xs), pt.cat(ys)
+    order = pt.argsort(x.reshape(x.shape[0], -1)[:, 0])
+    return x[order], y[order]
+
+
+n_dataset, steps, l = 53, 20, 4
+density = np.random.rand(n_dataset, steps, l)
+potential = np.random.rand(n_dataset, steps, l)
+keys = ["potential", "density"]
+
+with tempfile.TemporaryDirectory() as tmp:
+    for save in [np.savez, np.savez_compressed]:
+        file_name = os.path.join(tmp, save.__name__ + ".npz")
+        save(file_name, density=density, potential=potential)
+        for preprocessing in [True, False]:
+            for num_workers in [0, 2]:
+                np.random.seed(0)
+                dls = make_data_loader_unet(
+                    file_name,
+                    0.8,
+                    7,
+                    keys,
+                    10,
+                    preprocessing,
+                    num_workers=num_workers,
+                )
+                np.random.seed(0)
+                old = old_data_sets(file_name, 0.8, keys, 10, preprocessing)
+                for name, dl, (x_old, y_old) in zip(["train", "valid"], dls, old):
+                    x, y = collect(dl)
+                    order = pt.argsort(x_old.reshape(x_old.shape[0], -1)[:, 0])
+                    equal = pt.equal(x, x_old[order]) and pt.equal(y, y_old[order])
+                    print(
+                        f"{save.__name__}, preprocessing={preprocessing}, "
+                        f"num_workers={num_workers}, {name}: {len(dl)} batches of "
+                        f"{tuple(x.shape)}, equal to the old loader={equal}"
+                    )
+                    assert equal
+
+    # the extracted .npy directory is accepted as the data file as well
+    np.random.seed(0)
+    dls = make_data_loader_unet(
+        os.path.join(tmp, "savez_compressed_npy"), 0.8, 7, keys, 10, False
+    )
+    np.random.seed(0)
+    old = old_data_sets(file_name, 0.8, keys, 10, False)
+    for dl, (x_old, y_old) in zip(dls, old):
+        x, y = collect(dl)
+        order = pt.argsort(x_old.reshape(x_old.shape[0], -1)[:, 0])
+        assert pt.equal(x, x_old[order]) and pt.equal(y, y_old[order])
+
+# %%
@@ -0,0 +1,125 @@
+# %% Check of the chunked, preallocated Nambu diagonalization against the old per-chunk accumulation
+# The reference is the loop of the old parallel_nambu_diagonalization_ising_model (np.append of each chunk),
+# in double precision (the old code built a float32 Nambu matrix) and with chunks of a single realization,
+# so that it also covers the realizations of the partial last chunk (dropped by the old code).
+import tempfile
+import numpy as np
+import torch
+from src.training.utils_h_k_map import (
+    parallel_nambu_diagonalization_ising_model,
+    nambu_diagonalization_ising_chunks,
+)
+from src.trajectory_store import TrajectoryStore
+
+
+def old_nambu_diagonalization(
+    nbatch, l: int, j_coupling: float, hs: np.array, device: str, pbc: bool
+):
+    n_dataset = hs.shape[0]
+
+    batch = int(n_dataset / nbatch)
+    hs = torch.tensor(hs, dtype=torch.double, device=device)
+
+    j_vec = j_coupling * torch.ones(l, dtype=torch.double, device=device)
+    j_vec_l = j_vec.clone()
+    if not (pbc):
+        j_vec_l[0] = 0
+    if pbc:
+        j_vec_l[0] = -1 * j_vec_l[0]
+
+    j_vec_r = j_vec.clone()
+    if not (pbc):
+        j_vec_r[-1] = 0
+    if pbc:
+        j_vec_r[-1] = -1 * j_vec_r[-1]
+
+    eye = torch.eye(l, dtype=torch.double, device=device)
+    j_l = torch.einsum("ij,j->ij", eye, j_vec_l)
+    j_l = torch.roll(j_l, shifts=-1, dims=1)
+    j_r = torch.einsum("ij,j->ij", eye, j_vec_r)
+    j_r = torch.roll(j_r, shifts=1, dims=1)
+    j = -0.5 * (j_r + j_l)
+    b = -0.5 * (j_r - j_l)
+
+    for i in range(nbatch):
+        h = hs[i * batch : (i + 1) * batch]
+        h_matrix = torch.einsum("ij,aj->aij", eye, h)
+        a = j + h_matrix
+
+        h_nambu = torch.zeros((batch, 2 * l, 2 * l), dtype=torch.double, device=device)
+        h_nambu[:, :l, :l] = a
+        h_nambu[:, :l, l:] = b
+        h_nambu[:, l:, :l] = -1 * torch.conj(b)
+        h_nambu[:, l:, l:] = -1 * torch.conj(a)
+
+        e, w = torch.linalg.eigh(h_nambu)
+        v = w.clone()[:, l:, :l]
+        u = w.clone()[:, :l, :l]
+        c_vv = torch.einsum("anl,aml->anm", v, torch.conj(v))
+        c_uu = torch.einsum("anl,aml->anm", u, torch.conj(u))
+        c_vu = torch.einsum("anl,aml->anm", v, torch.conj(u))
+        c_uv = torch.einsum("anl,aml->anm", u, torch.conj(v))
+        c = c_vv + c_vu - c_uu - c_uv
+
+        s_z = 1 - 2 * torch.einsum("aik,aik->ai", v, torch.conj(v))
+        s_z_different = torch.einsum("aik,aik->ai", u, torch.conj(u)) - torch.einsum(
+            "aik,aik->ai", v, torch.conj(v)
+        )
+
+        density_f = c[:, np.arange(l), (np.arange(l) + 1) % l]
+        density_f[:, -1] = -1 * density_f[:, -1]
+
+        e_0 = torch.sum(e[:, 0:l], dim=-1) / l
+        f = e_0 - torch.mean(h * s_z, dim=-1)
+
+        if i == 0:
+            magn_z = s_z
+            magn_z_diff = s_z_different
+            e_tot = e_0
+            f_tot = f
+            tot_density_f = density_f
+        else:
+            magn_z = np.append(magn_z, s_z, axis=0)
+            magn_z_diff = np.append(magn_z_diff, s_z_different, axis=0)
+            e_tot = np.append(e_tot, e_0)
+            f_tot = np.append(f_tot, f)
+            tot_density_f = np.append(tot_density_f, density_f, axis=0)
+
+    return hs, magn_z, magn_z_diff, f_tot, tot_density_f, e_tot
+
+
+np.random.seed(0)
+l = 8
+# 103 realizations in 10 chunks, the last chunk is partial
+n_dataset, nbatch = 103, 10
+hs = np.random.uniform(0, 2, size=(n_dataset, l))
+names = ["magn_z", "magn_z_diff", "f", "density_f", "e"]
+for pbc in [True, False]:
+    reference = old_nambu_diagonalization(n_dataset, l, 1.0, hs, device="cpu", pbc=pbc)
+    outcomes = parallel_nambu_diagonalization_ising_model(
+        nbatch, l, 1.0, hs, device="cpu", pbc=pbc
+    )
+    for name, x, x_ref in zip(names, outcomes[1:], reference[1:]):
+        error = np.abs(np.asarray(x) - np.asarray(x_ref)).max()
+        print(f"pbc={pbc} {name} max error={error:.2e}")
+        assert x.shape[0] == n_dataset and error < 1e-12
+
+    # the old chunking (it drops the 3 realizations of the partial chunk)
+    reference = old_nambu_diagonalization(nbatch, l, 1.0, hs, device="cpu", pbc=pbc)
+    for name, x, x_ref in zip(names, outcomes[1:], reference[1:]):
+        n_old = np.asarray(x_ref).shape[0]
+        assert n_old == 100 and np.abs(x[:n_old] - np.asarray(x_ref)).max() < 1e-12
+
+    # the chunks of the generator in a TrajectoryStore
+    with tempfile.TemporaryDirectory() as path:
+        store = TrajectoryStore(path=path)
+        for start, stop, *chunk in nambu_diagonalization_ising_chunks(
+            nbatch, l, 1.0, hs, device="cpu", pbc=pbc
+        ):
+            store.extend(0, **dict(zip(names, chunk)))
+        saved = store.load_trajectory(0)
+        for name, x in zip(names, outcomes[1:]):
+            assert np.array_equal(saved[name], x)
+        print(f"pbc={pbc} store of {len(store.chunks[0])} chunks equal to the outcomes")
+
+# %%
@@ -0,0 +1,83 @@
+# %% Cross check of parallel_nambu_dynamics_ising_model against qutip.sesolve
+# The BdG propagator evolves the quadratic model H(t) = sum_i j x_i x_{i+1} + sum_i h_i(t) z_i
+# (the xx + h(t) z model of tddft_zzx_run.py, not the z + x + h(t) z one, which is not quadratic
+# after the Jordan-Wigner mapping). <x_i> vanishes in the gaussian states of fixed parity, so the
+# check compares <z_i>, <x_i x_{i+1}> and <z_i z_{i+1}> (the last bond is zero with obc).
+import numpy as np
+import qutip
+from src.training.utils_h_k_map import parallel_nambu_dynamics_ising_model
+
+
+def site_operator(op: qutip.Qobj, i: int, l: int) -> qutip.Qobj:
+    ops = [qutip.qeye(2)] * l
+    ops[i] = op
+    return qutip.tensor(ops)
+
+
+def exact_dynamics(l: int, j: float, h: np.ndarray, time: np.ndarray, pbc: bool):
+    x = [site_operator(qutip.sigmax(), i, l) for i in range(l)]
+    z = [site_operator(qutip.sigmaz(), i, l) for i in range(l)]
+    bonds = l if pbc else l - 1
+    h_xx = sum(j * x[i] * x[(i + 1) % l] for i in range(bonds))
+
+    def hamiltonian(n: int):
+        return h_xx + sum(h[n, i] * z[i] for i in range(l))
+
+    # ground state of H(0) in the even parity sector (prod_i z_i=+1) as in the BdG propagator
+    parity = qutip.tensor([qutip.sigmaz()] * l)
+    engs, states = hamiltonian(0).eigenstates()
+    psi = [s for s in states if qutip.expect(parity, s) > 0][0]
+
+    observables = (
+        z
+        + [x[i] * x[(i + 1) % l] for i in range(l)]
+        + [z[i] * z[(i + 1) % l] for i in range(l)]
+    )
+    results = np.zeros((time.shape[0], 3 * l))
+    results[0] = qutip.expect(observables, psi)
+    # piecewise constant field, h[n] in [t_n, t_n+1]
+    for n in range(time.shape[0] - 1):
+        psi = qutip.sesolve(
+            hamiltonian(n),
+            psi,
+            [0.0, time[n + 1] - time[n]],
+            options={"atol": 1e-12, "rtol": 1e-10},
+        ).states[-1]
+        results[n + 1] = qutip.expect(observables, psi)
+    z_t, xx_t, zz_t = results[:, :l], results[:, l : 2 * l], results[:, 2 * l :]
+    if not (pbc):
+        xx_t[:, -1] = 0.0
+        zz_t[:, -1] = 0.0
+    return z_t, xx_t, zz_t
+
+
+np.random.seed(42)
+j = 1.0
+time = np.linspace(0, 2, 21)
+for l in [6, 8]:
+    for pbc in [True, False]:
+        # smooth random drivings around a paramagnetic field (non degenerate ground state)
+        hs = np.random.uniform(0.8, 1.6, size=(2, 1, l)) + 0.3 * np.sin(
+            time[None, :, None] * np.random.uniform(1, 3, size=(2, 1, l))
+        )
+        z, xx, zz, _ = parallel_nambu_dynamics_ising_model(
+            l=l, j_coupling=j, hs=hs, time=time, device="cpu", pbc=pbc
+        )
+        errors = []
+        for b in range(hs.shape[0]):
+            z_exact, xx_exact, zz_exact = exact_dynamics(l, j, hs[b], time, pbc)
+            errors.append(
+                [
+                    np.abs(z[b].numpy() - z_exact).max(),
+                    np.abs(xx[b].numpy() - xx_exact).max(),
+                    np.abs(zz[b].numpy() - zz_exact).max(),
+                ]
+            )
+        errors = np.max(errors, axis=0)
+        print(
+            f"l={l} pbc={pbc} max error z={errors[0]:.2e} "
+            f"xx={errors[1]:.2e} zz={errors[2]:.2e}"
+        )
+        assert np.all(errors < 1e-6)
+
+# %%
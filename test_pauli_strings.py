@@ -0,0 +1,99 @@
+# %% Check of the CSR construction of SpinOperator (pauli_strings.py) against the qutip.tensor products
+# Random sums of Pauli strings (with +, -, id and repeated sites) and the nearest neighbour Hamiltonians
+# of the datasets (pbc and obc) must give the same matrices of the old chain of qutip.tensor calls,
+# and the cache of the operator structures must stay within PAULI_CACHE_BYTES
+import numpy as np
+import qutip
+from src.qutip_lab import pauli_strings
+from src.qutip_lab.qutip_class import SpinOperator, SpinHamiltonian
+
+local_ops = {
+    "x": qutip.sigmax(),
+    "y": qutip.sigmay(),
+    "z": qutip.sigmaz(),
+    "+": qutip.sigmap(),
+    "-": qutip.sigmam(),
+    "id": qutip.identity(2),
+}
+
+
+def tensor_operator(index, coupling, size):
+    """sum_k coupling[k] * index[k] as qutip.tensor products of the local operators"""
+    op = 0
+    for string, c in zip(index, coupling):
+        chain = [qutip.identity(2) for i in range(size)]
+        for k in range(0, len(string), 2):
+            direction, idx = string[k], string[k + 1]
+            chain[idx] = chain[idx] * local_ops[direction]
+        op = op + c * qutip.tensor(chain)
+    return op
+
+
+rng = np.random.default_rng(0)
+error = 0.0
+for size in [1, 2, 5, 7]:
+    for sample in range(20):
+        index = []
+        for k in range(rng.integers(1, 6)):
+            n_ops = rng.integers(1, 4)
+            string = []
+            for direction in rng.choice(list(local_ops.keys()), n_ops):
+                string += [str(direction), int(rng.integers(size))]
+            index.append(tuple(string))
+        coupling = rng.normal(size=len(index)) + 1j * rng.normal(size=len(index))
+        op = SpinOperator(index=index, coupling=coupling, size=size).qutip_op
+        reference = tensor_operator(index, coupling, size)
+        assert op.dims == reference.dims
+        error = max(error, np.abs(op.full() - reference.full()).max())
+print(f"random Pauli strings: max error={error:.2e}")
+assert error < 1e-14
+
+# the Hamiltonians and the per sample fields of the datasets (same index, new couplings)
+l = 8
+for pbc in [True, False]:
+    for j, h in [(-1.0, rng.uniform(0, 2, l)), (1.0, rng.uniform(0, 2, l))]:
+        ham = SpinHamiltonian(
+            direction_couplings=[("x", "x")], pbc=pbc, coupling_values=[j], size=l
+        ).qutip_op
+        ham_ext_z = SpinOperator(
+            index=[("z", i) for i in range(l)], coupling=h, size=l
+        ).qutip_op
+        bonds = range(l) if pbc else range(l - 1)
+        reference = tensor_operator(
+            [("x", i, "x", (i + 1) % l) for i in bonds], [j] * len(bonds), l
+        ) + tensor_operator([("z", i) for i in range(l)], h, l)
+        error = np.abs((ham + ham_ext_z).full() - reference.full()).max()
+        print(f"xx + z field, pbc={pbc}, j={j}: max error={error:.2e}")
+        assert error < 1e-14
+
+# the cache is bounded in bytes: the least recently used structures are evicted, and a structure
+# larger than the bound is built on demand without being cached
+pauli_strings.clear_pauli_cache()
+pauli_strings.PAULI_CACHE_BYTES = 4 * 2**20
+l = 12
+operators = {}
+for direction in ["x", "y", "z"]:
+    index = [(direction, i, direction, (i + 1) % l) for i in range(l)]
+    operators[direction] = SpinOperator(index=index, coupling=[1.0] * l, size=l)
+    assert pauli_strings.pauli_cache_bytes() <= pauli_strings.PAULI_CACHE_BYTES
+print(
+    f"l={l}: {len(pauli_strings._pauli_sum_cache)} cached structures, "
+    f"{pauli_strings.pauli_cache_bytes() / 2**20:.1f} MB "
+    f"(bound {pauli_strings.PAULI_CACHE_BYTES / 2**20:.0f} MB)"
+)
+assert len(pauli_strings._pauli_sum_cache) < 3
+big = SpinOperator(
+    index=[("x", i) for i in range(14)], coupling=[1.0] * 14, size=14
+).qutip_op
+assert pauli_strings.pauli_cache_bytes() <= pauli_strings.PAULI_CACHE_BYTES
+assert all(size != 14 for _, size in pauli_strings._pauli_sum_cache)
+# the evicted structures are built again with the same matrices
+for direction, op in operators.items():
+    again = SpinOperator(
+        index=[(direction, i, direction, (i + 1) % l) for i in range(l)],
+        coupling=[1.0] * l,
+        size=l,
+    )
+    assert (again.qutip_op - op.qutip_op).norm() == 0
+
+# %%
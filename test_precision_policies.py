@@ -0,0 +1,60 @@
+# %% Check of the accuracy of the effective fields of a functional evaluated as in the dtype policies
+# effective_fields_precision_error evaluates the (z,x) functional with the parameters and the autocast of
+# the policy and compares the fields dE/dz, dE/dx with the float64 ones of compute_the_effective_fields
+import torch
+import torch.nn as nn
+from src.training.models_adiabatic import EnergyXXZX
+from src.tddft_methods.kohm_sham_utils import effective_fields_precision_error
+
+
+class ConvFunctional(nn.Module):
+    def __init__(self, hidden_channels: int = 40, n_layers: int = 4) -> None:
+        super().__init__()
+        layers = []
+        for k in range(n_layers):
+            layers.append(
+                nn.Conv1d(
+                    2 if k == 0 else hidden_channels,
+                    hidden_channels,
+                    3,
+                    padding=1,
+                    padding_mode="circular",
+                )
+            )
+            layers.append(nn.GELU())
+        layers.append(
+            nn.Conv1d(hidden_channels, 1, 3, padding=1, padding_mode="circular")
+        )
+        self.conv = nn.Sequential(*layers)
+
+    def forward(self, z: torch.Tensor):
+        return self.conv(z)[:, 0].squeeze(0)
+
+
+torch.manual_seed(0)
+batch, l = 8, 16
+energy = EnergyXXZX(model=ConvFunctional().double())
+energy.eval()
+m = 2 * torch.rand((batch, 2, l), dtype=torch.double) - 1
+h = torch.rand((batch, 2, l), dtype=torch.double)
+
+errors = {}
+for policy in ["float64", "float32", "bfloat16"]:
+    # the components of the (z,x) functional are the default for a 2 channel input
+    errors[policy] = effective_fields_precision_error(
+        m=m, h=h, energy=energy, policy=policy
+    )
+    print(
+        f"{policy}: field z rel error={errors[policy]['field_z_rel']:.1e}, "
+        f"field x rel error={errors[policy]['field_x_rel']:.1e}, "
+        f"energy rel error={errors[policy]['energy_rel']:.1e}"
+    )
+
+for key in ["field_z_rel", "field_x_rel"]:
+    assert errors["float64"][key] < 1e-14
+    assert errors["float32"][key] < 1e-5
+    assert errors["bfloat16"][key] < 5e-2
+    # the autocast of the bfloat16 policy is active
+    assert errors["bfloat16"][key] > 10 * errors["float32"][key]
+
+# %%
@@ -0,0 +1,110 @@
+# %% Check of the corrector of nonlinear_schrodinger_step (self_consistent_fields)
+# 1) without a tolerance the corrector is the fixed number of plain iterations of the original loop
+# 2) with a tolerance the Anderson mixing converges to the same fixed point of many plain iterations
+# (a strong functional and a large dt, so that the plain iteration is slow and the mixing is used)
+import torch
+import torch.nn as nn
+from src.training.models_adiabatic import EnergyXXZX
+from src.tddft_methods.kohm_sham_utils import (
+    initialize_psi_from_z,
+    compute_the_magnetization,
+    compute_the_effective_fields,
+    build_hamiltonian,
+    su2_exponentiation_algorithm,
+    nonlinear_schrodinger_step,
+    ZX_COMPONENTS,
+)
+
+
+class Functional(nn.Module):
+    def __init__(self) -> None:
+        super().__init__()
+        self.conv = nn.Sequential(
+            nn.Conv1d(2, 20, 3, padding=1, padding_mode="circular"),
+            nn.Tanh(),
+            nn.Conv1d(20, 1, 3, padding=1, padding_mode="circular"),
+        )
+
+    def forward(self, z: torch.Tensor):
+        return 30 * self.conv(z)[:, 0].squeeze(0)
+
+
+def effective_fields(psi: torch.Tensor, h: torch.Tensor):
+    x, _, z = compute_the_magnetization(psi=psi)
+    m = torch.stack((z, x)).unsqueeze(0)
+    (omega_eff, h_eff), _ = compute_the_effective_fields(
+        m=m, h=h.unsqueeze(0), energy=energy, components=ZX_COMPONENTS
+    )
+    return build_hamiltonian(field_x=-1 * omega_eff[0], field_z=-1 * h_eff[0])
+
+
+def plain_predictor_corrector(psi: torch.Tensor, i: int, self_consistent_step: int):
+    """The original loop: hamiltonian_plus <- H[m(psi(t+dt))] a fixed number of times"""
+    hamiltonian_minus = effective_fields(psi, h[i])
+    hamiltonian_plus = hamiltonian_minus.clone()
+    for step in range(self_consistent_step):
+        psi_plus = su2_exponentiation_algorithm(
+            hamiltonian=0.5 * (hamiltonian_minus + hamiltonian_plus), psi=psi, dt=dt
+        )
+        hamiltonian_plus = effective_fields(psi_plus, h[i + 1])
+    return su2_exponentiation_algorithm(
+        hamiltonian=0.5 * (hamiltonian_minus + hamiltonian_plus), psi=psi, dt=dt
+    )
+
+
+torch.manual_seed(0)
+l = 8
+dt = 0.6
+steps = 10
+energy = EnergyXXZX(model=Functional().double())
+energy.eval()
+h = 0.5 + 0.2 * torch.rand((steps, 2, l), dtype=torch.double)
+psi0 = initialize_psi_from_z(z=0.8 * torch.rand(l, dtype=torch.double) - 0.4)
+
+# 1) fixed number of iterations
+for self_consistent_step in [0, 1, 3]:
+    psi, psi_ref = psi0.clone(), psi0.clone()
+    for i in range(steps - 1):
+        psi = nonlinear_schrodinger_step(
+            psi=psi,
+            energy=energy,
+            i=i,
+            h=h,
+            self_consistent_step=self_consistent_step,
+            dt=dt,
+            eta=None,
+            exponent_algorithm=True,
+        )[0]
+        psi_ref = plain_predictor_corrector(psi_ref, i, self_consistent_step)
+    error = (psi - psi_ref).abs().max().item()
+    print(f"{self_consistent_step} plain iterations: max error={error:.2e}")
+    assert error < 1e-12
+
+# 2) converged corrector
+psi_anderson, psi_plain = psi0.clone(), psi0.clone()
+iterations, anderson = [], []
+for i in range(steps - 1):
+    report = []
+    psi_anderson = nonlinear_schrodinger_step(
+        psi=psi_anderson,
+        energy=energy,
+        i=i,
+        h=h,
+        self_consistent_step=50,
+        dt=dt,
+        eta=None,
+        exponent_algorithm=True,
+        tolerance=1e-12,
+        report=report,
+    )[0]
+    iterations.append(report[0]["iterations"])
+    anderson.append(report[0]["anderson"])
+    psi_plain = plain_predictor_corrector(psi_plain, i, 200)
+error = (psi_anderson - psi_plain).abs().max().item()
+print(
+    f"tolerance 1e-12: max error={error:.2e} with the corrector iterations {iterations}"
+    f" (Anderson mixing in {sum(anderson)} steps) against 200 plain iterations"
+)
+assert error < 1e-9
+
+# %%
@@ -0,0 +1,89 @@
+# %% Check of the symmetry sectors (symmetries.py) and of their use in ExactPropagator
+# 1) the spectra of the blocks of all the sectors add up to the spectrum of the full Hamiltonian
+# 2) a uniform quench evolved in the sector of the initial state equals the full space evolution
+import itertools
+import numpy as np
+from src.qutip_lab.qutip_class import SpinOperator, SpinHamiltonian, GroundStateSolver
+from src.qutip_lab.qutip_evolution import ExactPropagator
+from src.qutip_lab.symmetries import SymmetrySector
+
+l = 8
+j, omega = -1.0, 0.7
+ham0 = SpinHamiltonian(
+    direction_couplings=[("x", "x")], pbc=True, coupling_values=[j], size=l
+)
+ham_ext_x = SpinOperator(
+    index=[("x", i) for i in range(l)], coupling=[omega] * l, size=l
+)
+z_ops = [SpinOperator(index=[("z", i)], coupling=[1.0], size=l) for i in range(l)]
+ham_ext_z = SpinOperator(
+    index=[("z", i) for i in range(l)], coupling=[0.5] * l, size=l
+)
+
+# 1) xx + uniform x and z fields: translation and reflection,
+# xx + uniform z field: translation, reflection and z parity
+for name, ham_ext, expected, z_parities in [
+    (
+        "xx + x + z fields",
+        ham_ext_x.qutip_op,
+        ["translation", "reflection"],
+        [None],
+    ),
+    ("xx + z field", 0, ["translation", "reflection", "z_parity"], [1, -1]),
+]:
+    ham = ham0.qutip_op + ham_ext + ham_ext_z.qutip_op
+    propagator = ExactPropagator(
+        ham0.qutip_op + ham_ext, drivings=[z.qutip_op for z in z_ops]
+    )
+    print(f"symmetries of {name}: {propagator.symmetries}")
+    assert propagator.symmetries == expected
+
+    spectrum = np.linalg.eigvalsh(ham.full())
+    blocks, dimensions = [], []
+    for momentum, z_parity in itertools.product(range(l), z_parities):
+        parities = [1, -1] if momentum in [0, l // 2] else [None]
+        # the momenta k and -k are related by the reflection, both are taken
+        for reflection in parities:
+            sector = SymmetrySector(
+                size=l, momentum=momentum, reflection=reflection, z_parity=z_parity
+            )
+            block = sector.project_operator(ham).toarray()
+            assert np.abs(block - block.conj().T).max() < 1e-12
+            blocks.append(np.linalg.eigvalsh(block))
+            dimensions.append(sector.dimension)
+    sector_spectrum = np.sort(np.concatenate(blocks))
+    error = np.abs(sector_spectrum - spectrum).max()
+    print(
+        f"{name}: {len(blocks)} sectors of dimension {dimensions} (full {2**l}), "
+        f"spectrum max error={error:.2e}"
+    )
+    assert sum(dimensions) == 2**l
+    assert error < 1e-10
+
+# 2) uniform quench of the z field from the ground state, with and without the sectors
+time = np.linspace(0, 5, 101)
+fields = np.ones((time.shape[0], l)) * np.linspace(0.5, 1.5, time.shape[0])[:, None]
+e_ops = z_ops + [
+    SpinOperator(index=[("x", i, "x", (i + 1) % l)], coupling=[1.0], size=l)
+    for i in range(l)
+]
+_, psi0 = GroundStateSolver().ground_state(
+    ham0.qutip_op + ham_ext_x.qutip_op + ham_ext_z.qutip_op
+)
+results = {}
+for symmetries in [True, False]:
+    propagator = ExactPropagator(
+        ham0.qutip_op + ham_ext_x.qutip_op,
+        drivings=[z.qutip_op for z in z_ops],
+        e_ops=e_ops,
+        symmetries=symmetries,
+    )
+    results[symmetries], _ = propagator.evolve(psi0, time, fields)
+    for key, (sector, _) in propagator.sectors.items():
+        print(f"evolution in the sector {key} of dimension {sector.dimension}")
+assert len(propagator.sectors) == 0
+error = np.abs(results[True] - results[False]).max()
+print(f"sector vs full evolution: max error={error:.2e}")
+assert error < 1e-10
+
+# %%
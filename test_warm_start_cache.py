@@ -0,0 +1,82 @@
+# %% Check of the warm start cache of the ground state minimizations (WarmStartCache)
+# exact and nearest field hits, the default maximum distance of a nearest guess, the LRU eviction,
+# the save/load round trip and the model fingerprint
+import copy
+import os
+import tempfile
+import numpy as np
+import torch
+import torch.nn as nn
+from src.warm_start_cache import WarmStartCache, model_fingerprint
+
+rng = np.random.default_rng(0)
+l = 8
+# fields on the grid of the keys (resolution 1e-3)
+fields = [np.round(rng.uniform(0, 2, (2, l)), 3) for _ in range(4)]
+magnetizations = [rng.uniform(-1, 1, (3, l)) for _ in range(4)]
+
+# exact hit (same quantized field) and misses for another model or another shape
+cache = WarmStartCache(resolution=1e-3)
+cache.put(fields[0], "model", magnetizations[0])
+assert np.array_equal(cache.get(fields[0] + 2e-4, "model"), magnetizations[0])
+assert cache.get(fields[0], "other model") is None
+assert cache.get(np.ones((2, l + 1)), "model") is None
+assert (cache.hits, cache.nearest_hits, cache.misses) == (1, 0, 2)
+
+# nearest hit within the default distance (10 * resolution rms), miss beyond it
+assert cache.max_distance == 1e-2
+assert np.array_equal(cache.get(fields[0] + 5e-3, "model"), magnetizations[0])
+assert cache.get(fields[0] + 5e-2, "model") is None
+assert cache.get(fields[1], "model") is None
+assert (cache.hits, cache.nearest_hits, cache.misses) == (1, 1, 4)
+# the nearest of the cached fields
+cache.put(fields[0] + 8e-3, "model", magnetizations[1])
+assert np.array_equal(cache.get(fields[0] + 7e-3, "model"), magnetizations[1])
+assert np.array_equal(cache.get(fields[0] + 1e-3, "model"), magnetizations[0])
+# an explicit maximum distance
+far = WarmStartCache(max_distance=np.inf)
+far.put(fields[0], "model", magnetizations[0])
+assert np.array_equal(far.get(fields[1], "model"), magnetizations[0])
+
+# LRU eviction: the least recently used entry is removed
+cache = WarmStartCache(max_entries=3)
+for h, m in zip(fields[:3], magnetizations[:3]):
+    cache.put(h, "model", m)
+cache.get(fields[0], "model")
+cache.put(fields[3], "model", magnetizations[3])
+assert cache.get(fields[1], "model") is None
+for k in [0, 2, 3]:
+    assert np.array_equal(cache.get(fields[k], "model"), magnetizations[k])
+print(f"LRU eviction: {len(cache.entries)} entries after 4 insertions with max_entries=3")
+
+# save/load round trip, with the order of use
+with tempfile.TemporaryDirectory() as tmp:
+    path = os.path.join(tmp, "cache", "warm_start.npz")
+    cache = WarmStartCache(path=path)
+    for h, m in zip(fields, magnetizations):
+        cache.put(h, "model", m)
+    cache.put(fields[0], "another model", -magnetizations[0])
+    cache.get(fields[1], "model")
+    cache.save()
+    loaded = WarmStartCache(path=path)
+    assert list(loaded.entries.keys()) == list(cache.entries.keys())
+    for key, (h, m) in cache.entries.items():
+        assert np.array_equal(loaded.entries[key][0], h)
+        assert np.array_equal(loaded.entries[key][1], m)
+    print(f"save/load: {len(loaded.entries)} entries in the same order")
+
+# the fingerprint depends on the parameters and the buffers of the model
+torch.manual_seed(0)
+model = nn.Sequential(nn.Conv1d(2, 4, 3), nn.BatchNorm1d(4))
+fingerprint = model_fingerprint(model)
+assert model_fingerprint(copy.deepcopy(model)) == fingerprint
+changed = copy.deepcopy(model)
+with torch.no_grad():
+    changed[0].weight[0, 0, 0] += 1e-4
+assert model_fingerprint(changed) != fingerprint
+changed = copy.deepcopy(model)
+changed[1].running_mean += 1.0
+assert model_fingerprint(changed) != fingerprint
+print("fingerprint: equal for a copy, different after a change of a weight or a buffer")
+
+# %%
@@ -5,6 +5,8 @@ import random
 
 import numpy as np
 import torch as pt
+import torch.distributed as dist
+import torch.multiprocessing as mp
 import torch.nn as nn
 
 from src.training.models import (
@@ -17,7 +19,7 @@ from src.training.models import (
 from src.training.unet_recurrent import UnetLSTM_beta
 from src.training.model_unet import AutoEncoder, DenseAutoEncoder, REDENTnopooling2D
 from src.training.pixel_model import PixelCNN
-from src.training.train_module import fit
+from src.training.train_module import broadcast_parameters, fit
 from src.training.models_vae import VarAE
 from src.training.seq2seq import Seq2Seq
 from src.training.utils import (
@@ -26,6 +28,8 @@ from src.training.utils import (
     make_data_loader_unet,
 )
 from src.training.model_utils.utils_vae import VaeLoss
+from src.training.dtype_policy import DTypePolicy
+from src.training.dataset import npz_to_npy
 
 # %%
 
@@ -67,6 +71,13 @@ parser.add_argument(
     default=1,
 )
 
+parser.add_argument(
+    "--num_workers",
+    type=int,
+    help="the number of processes that load the batches (default=0)",
+    default=0,
+)
+
 parser.add_argument(
     "--seed",
     type=int,
@@ -82,6 +93,20 @@ parser.add_argument(
     default=("cuda" if pt.cuda.is_available() else "cpu"),
 )
 
+parser.add_argument(
+    "--n_processes",
+    type=int,
+    help="number of processes of the data parallel training on cpu, gloo backend (default=1)",
+    default=1,
+)
+
+parser.add_argument(
+    "--master_port",
+    type=str,
+    help="port of the process group of the data parallel training (default=29500)",
+    default="29500",
+)
+
 parser.add_argument(
     "--patiance",
     type=int,
@@ -219,6 +244,13 @@ parser.add_argument(
     default="AdiabaticTDDDFT",
 )
 
+parser.add_argument(
+    "--dtype_policy",
+    type=str,
+    help="precision of the training: float64, float32, float32_master64 or bfloat16 (default=float64, or the one of the loaded model)",
+    default=None,
+)
+
 parser.add_argument(
     "--keys",
     type=str,
@@ -242,7 +274,7 @@ parser.add_argument(
 )
 
 
-def main(args):
+def main(args, rank: int = 0, world_size: int = 1):
     # hyperparameters
 
     device = pt.device(args.device)
@@ -437,7 +469,14 @@ def main(args):
                 t_interval_range=time_interval,
             )
 
-    model = model.to(pt.double)
+    # precision of the training (saved in the checkpoints)
+    if args.dtype_policy is not None:
+        policy = DTypePolicy(args.dtype_policy)
+    elif load:
+        policy = DTypePolicy.from_model(model)
+    else:
+        policy = DTypePolicy("float64")
+    model = policy.cast_model(model)
     model = model.to(device=device)
 
     print(model)
@@ -455,11 +494,19 @@ def main(args):
             keys=args.keys,
             time_interval=args.time_interval,
             preprocessing=args.preprocessing,
+            num_workers=args.num_workers,
+            dtype=np.float32 if policy.param_dtype == pt.float32 else np.float64,
+            rank=rank,
+            world_size=world_size,
         )
         train_dls.append(train_dl)
         valid_dls.append(valid_dl)
 
-    opt = get_optimizer(lr=lr, model=model)
+    # all the processes start from the parameters of rank 0
+    if world_size > 1:
+        broadcast_parameters(model)
+
+    opt = get_optimizer(lr=lr, model=model, policy=policy)
     fit(
         supervised=True,
         model=model,
@@ -476,12 +523,32 @@ def main(args):
         patiance=patiance,
         early_stopping=early_stopping,
         device=device,
+        policy=policy,
     )
 
     print(model)
 
 
+def main_worker(rank: int, args):
+    """A process of the data parallel training: each one trains on its shard of the data and the gradients
+    are averaged at every step (see fit), rank 0 saves the model and the losses"""
+    os.environ.setdefault("MASTER_ADDR", "127.0.0.1")
+    os.environ.setdefault("MASTER_PORT", args.master_port)
+    dist.init_process_group("gloo", rank=rank, world_size=args.n_processes)
+    try:
+        main(args, rank=rank, world_size=args.n_processes)
+    finally:
+        dist.destroy_process_group()
+
+
 if __name__ == "__main__":
     args = parser.parse_args()
 
-    main(args)
+    if args.n_processes > 1:
+        # the .npy files of the datasets are extracted once before the processes start
+        for file_name in args.data_path:
+            npz_to_npy(file_name, keys=args.keys[:2])
+        args.device = "cpu"
+        mp.spawn(main_worker, args=(args,), nprocs=args.n_processes)
+    else:
+        main(args)